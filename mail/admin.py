@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from mail.models import DistributionList
+
+
+@admin.register(DistributionList)
+class DistributionListAdmin(admin.ModelAdmin):
+    list_display = ['name', 'address', 'version']
+    search_fields = ['name', 'address']
+    filter_horizontal = ['members', 'groups']
+    readonly_fields = ['version']
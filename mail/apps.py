@@ -1,5 +1,23 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, pre_delete
 
 class MailConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mail'
+
+    def ready(self):
+        from django.contrib.auth.models import Group
+        from mail.blobs import release_blob
+        from mail.databases import configure_sqlite
+        from mail.fanout import invalidate_for_deleted, invalidate_lists
+        from mail.models import Attachment, DistributionList, User
+        from mail.search import create_search_index
+        post_migrate.connect(create_search_index, sender=self)
+        connection_created.connect(configure_sqlite)
+        post_delete.connect(release_blob, sender=Attachment)
+        for through in (DistributionList.members.through,
+                        DistributionList.groups.through, User.groups.through):
+            m2m_changed.connect(invalidate_lists, sender=through)
+        pre_delete.connect(invalidate_for_deleted, sender=User)
+        pre_delete.connect(invalidate_for_deleted, sender=Group)
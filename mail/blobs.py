@@ -0,0 +1,209 @@
+import hashlib
+import logging
+import os
+import tempfile
+from collections import Counter
+from datetime import timedelta
+
+from django.core.files.base import ContentFile, File
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler, TemporaryFileUploadHandler)
+from django.db.models import Count, F, IntegerField, OuterRef, ProtectedError, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from mail.mime_stream import HashingSpool
+from mail.models import Attachment, Blob
+
+logger = logging.getLogger(__name__)
+
+# 引用数归零后至少保留这么久，避免与正在复用该 blob 的请求竞争
+GC_GRACE = timedelta(hours=24)
+
+
+class HashingMemoryFileUploadHandler(MemoryFileUploadHandler):
+    # 上传过程中顺带计算 SHA-256，结果放在 UploadedFile.sha256
+    def new_file(self, *args, **kwargs):
+        # 父类接管文件时会抛出 StopFutureHandlers，需先初始化
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+def _digest_of(content):
+    # 调用方已在流入时计算过哈希的直接复用，否则边读边算
+    if isinstance(content.file, HashingSpool):
+        return content.file.sha256.hexdigest()
+    digest = getattr(content, "sha256", None)
+    if isinstance(digest, str):
+        return digest
+    hasher = hashlib.sha256()
+    for chunk in content.chunks():
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _write_file(path, content):
+    # 先写同目录下的临时文件再改名：并发写入同一 digest 时，目标路径上只会出现完整的文件
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+        mode = Blob.file.field.storage.file_permissions_mode
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _set_file(blob, name):
+    # 条件更新：并发请求已经写好文件时保持原值，两边写的是同一个路径
+    Blob.objects.filter(pk=blob.pk, file="").update(file=name)
+    blob.file.name = name
+
+
+def store_blob(content):
+    # content 可以是 bytes、UploadedFile、HashingSpool 或其他文件对象
+    if isinstance(content, bytes):
+        content = ContentFile(content)
+    elif not isinstance(content, File):
+        content = File(content)
+    digest = _digest_of(content)
+
+    blob, created = Blob.objects.get_or_create(
+        sha256=digest, defaults={"size": content.size})
+    if not created:
+        Blob.objects.filter(pk=blob.pk).update(touched_at=timezone.now())
+    if not blob.file:
+        storage = blob.file.field.storage
+        name = blob.file.field.generate_filename(blob, digest)
+        if not storage.exists(name):
+            _write_file(storage.path(name), content)
+        _set_file(blob, name)
+    return blob
+
+
+def adopt_blob(name, digest, size):
+    # 已经写在存储中的文件（分片上传的结果）直接改名为 blob 文件，不再复制；
+    # 内容已存在时删除该文件
+    storage = Blob.file.field.storage
+    blob, created = Blob.objects.get_or_create(sha256=digest, defaults={"size": size})
+    if not created:
+        Blob.objects.filter(pk=blob.pk).update(touched_at=timezone.now())
+    if blob.file:
+        storage.delete(name)
+        return blob
+    target = blob.file.field.generate_filename(blob, digest)
+    if storage.exists(target):
+        storage.delete(name)
+    else:
+        os.makedirs(os.path.dirname(storage.path(target)), exist_ok=True)
+        os.replace(storage.path(name), storage.path(target))
+    _set_file(blob, target)
+    return blob
+
+
+def add_refs(blob_ids):
+    for blob_id, count in Counter(b for b in blob_ids if b).items():
+        Blob.objects.filter(pk=blob_id).update(ref_count=F("ref_count") + count)
+
+
+def release_blob(sender, instance, **kwargs):
+    # post_delete：附件删除（包括随邮件级联删除）时释放引用
+    if instance.blob_id:
+        Blob.objects.filter(pk=instance.blob_id).update(
+            ref_count=F("ref_count") - 1, touched_at=timezone.now())
+
+
+def attach_blob(email_obj, blob, filename):
+    attachment = Attachment.objects.create(
+        email=email_obj, blob=blob, file=blob.file.name,
+        filename=filename, size=blob.size)
+    add_refs([blob.pk])
+    return attachment
+
+
+def fetch_placeholders(attachments):
+    # 外部邮件中还没下载的占位附件先从 IMAP 拉取，副本才有文件可指向
+    placeholders = [att for att in attachments if att.is_placeholder]
+    if placeholders:
+        # imap_sync 导入了本模块，这里延迟导入
+        from mail.imap_sync import fetch_attachment
+        for att in placeholders:
+            fetch_attachment(att)
+
+
+def copy_attachments(attachments, email_obj):
+    # 转发附件只复制元数据，不复制文件；一次 bulk_create 完成
+    attachments = list(attachments)
+    fetch_placeholders(attachments)
+    copies = Attachment.objects.bulk_create([Attachment(
+        email=email_obj, blob_id=att.blob_id, file=att.file.name,
+        filename=att.filename, size=att.size) for att in attachments])
+    add_refs(att.blob_id for att in copies)
+    return copies
+
+
+def reconcile_refs():
+    # 以 Attachment 表为准重算引用数
+    counts = Attachment.objects.filter(blob=OuterRef("pk")).order_by().values(
+        "blob").annotate(c=Count("pk")).values("c")
+    return Blob.objects.update(ref_count=Coalesce(
+        Subquery(counts, output_field=IntegerField()), 0))
+
+
+def collect_garbage(grace=GC_GRACE, dry_run=False):
+    # 删除无引用且超过宽限期的 blob 及其文件，返回 (数量, 字节数)
+    cutoff = timezone.now() - grace
+    candidates = Blob.objects.filter(
+        ref_count__lte=0, touched_at__lt=cutoff, attachments__isnull=True)
+    removed = freed = 0
+    for blob in candidates.iterator():
+        if not dry_run:
+            try:
+                # 条件删除：期间被重新引用或复用的 blob 会被跳过
+                deleted, _ = Blob.objects.filter(
+                    pk=blob.pk, ref_count__lte=0, touched_at__lt=cutoff).delete()
+            except ProtectedError:
+                continue
+            if not deleted:
+                continue
+            if blob.file:
+                blob.file.storage.delete(blob.file.name)
+        removed += 1
+        freed += blob.size
+    logger.info("blob GC: removed %s blobs, %s bytes", removed, freed)
+    return removed, freed
@@ -0,0 +1,166 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils.dateparse import parse_datetime
+
+from mail.changes import SYNC_PAGE_SIZE, force_resync, record_changes
+from mail.counters import adjust
+from mail.models import Email, MailboxChange, MailboxCounter, PendingExpunge, RawMessage, Recipient
+from mail.notify import notify_users
+from mail.search import remove_emails
+
+INBOX = MailboxCounter.MAILBOX_INBOX
+EXTERNAL = MailboxCounter.MAILBOX_EXTERNAL
+FOLDERS = [folder for folder, _ in Recipient.FOLDER_CHOICES]
+
+# 超过该数量时不逐条记录变更，改为让客户端全量刷新
+BULK_CHANGE_LIMIT = SYNC_PAGE_SIZE
+# 删除外部邮件时每批处理的行数
+BULK_CHUNK_SIZE = 1000
+
+
+def _chunks(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _filter_q(filters, prefix, sender_field):
+    # filter 表达式：sender / subject 为包含匹配，unread 为布尔值，before / after 为 ISO 时间
+    q = Q()
+    if filters.get("sender"):
+        q &= Q(**{f"{prefix}{sender_field}__icontains": filters["sender"]})
+    if filters.get("subject"):
+        q &= Q(**{f"{prefix}subject__icontains": filters["subject"]})
+    if filters.get("unread") is not None:
+        q &= Q(is_read=not filters["unread"])
+    for key, lookup in (("before", "lt"), ("after", "gte")):
+        if filters.get(key):
+            value = parse_datetime(str(filters[key]))
+            if value is None:
+                raise ValueError(f"{key} 不是有效的时间")
+            q &= Q(**{f"{prefix}sent_at__{lookup}": value})
+    return q
+
+
+def select(user, mailbox, ids=None, filters=None):
+    # 返回待操作的集合：收件箱为 Recipient 查询，外部邮件为 Email 查询；只拼条件，不取行
+    if ids is None and filters is None:
+        raise ValueError("请指定 ids 或 filter")
+    if mailbox == INBOX:
+        queryset = Recipient.objects.filter(user=user)
+        id_field, prefix, sender_field = "email_id", "email__", "from_user__username"
+    elif mailbox == EXTERNAL:
+        queryset = Email.objects.filter(from_user=user, is_internal=False)
+        id_field, prefix, sender_field = "id", "", "from_external"
+    else:
+        raise ValueError("未知的邮箱")
+    if ids is not None:
+        return queryset.filter(**{f"{id_field}__in": ids})
+    if mailbox == INBOX:
+        folder = filters.get("folder", Recipient.FOLDER_INBOX)
+        if folder not in FOLDERS:
+            raise ValueError("未知的文件夹")
+        queryset = queryset.filter(folder=folder)
+    return queryset.filter(_filter_q(filters, prefix, sender_field))
+
+
+def _email_ids(queryset, limit=BULK_CHANGE_LIMIT):
+    field = "email_id" if queryset.model is Recipient else "id"
+    return list(queryset.values_list(field, flat=True)[:limit + 1])
+
+
+def _record(user_id, kind, email_ids):
+    if len(email_ids) > BULK_CHANGE_LIMIT:
+        force_resync([user_id])
+    else:
+        record_changes([(user_id, kind, email_id) for email_id in email_ids])
+
+
+def _done(user_id, count):
+    if count:
+        # 通知该用户的其他连接拉取增量
+        notify_users([user_id], {"type": "mailbox_changed"})
+    return count
+
+
+def mark_read(user, queryset, read=True):
+    # 一条 UPDATE 修改状态与目标不同的行；外部邮件同时标记待推送到 IMAP
+    targets = queryset.filter(is_read=not read)
+    sign = -1 if read else 1
+    kind = MailboxChange.KIND_READ if read else MailboxChange.KIND_UNREAD
+    with transaction.atomic():
+        email_ids = _email_ids(targets)
+        if not email_ids:
+            return 0
+        if targets.model is Recipient:
+            in_inbox = targets.filter(folder=Recipient.FOLDER_INBOX).count()
+            updated = targets.update(is_read=read)
+            adjust([(user.id, INBOX, 0, sign * in_inbox)])
+        else:
+            # 没有绑定账号的行（通过绑定账号发出的副本）不会被推送，标记无副作用
+            updated = targets.update(is_read=read, imap_flags_dirty=True)
+            adjust([(user.id, EXTERNAL, 0, sign * updated)])
+        _record(user.id, kind, email_ids)
+    return _done(user.id, updated)
+
+
+def delete(user, queryset, expunge=True):
+    # expunge=False 用于服务器上已不存在的邮件（UIDVALIDITY 变化），只清理本地
+    with transaction.atomic():
+        if queryset.model is Recipient:
+            # 只删除当前用户的收件记录，邮件本身仍属于发件人和其他收件人
+            stats = queryset.aggregate(
+                total=Count("pk", filter=Q(folder=Recipient.FOLDER_INBOX)),
+                unread=Count("pk", filter=Q(folder=Recipient.FOLDER_INBOX, is_read=False)))
+            email_ids = _email_ids(queryset)
+            deleted, _ = queryset.delete()
+            adjust([(user.id, INBOX, -stats["total"], -stats["unread"])])
+        else:
+            rows = list(queryset.values_list("id", "external_account_id", "external_uid", "is_read"))
+            if not rows:
+                return 0
+            if expunge:
+                # 记录服务器上的 UID，由 sync_imap 批量标记 \Deleted
+                PendingExpunge.objects.bulk_create([
+                    PendingExpunge(account_id=account_id, uid=int(uid))
+                    for _, account_id, uid, _ in rows if account_id and uid
+                ], batch_size=BULK_CHUNK_SIZE, ignore_conflicts=True)
+            expunged = defaultdict(list)
+            for _, account_id, uid, _ in rows:
+                if account_id and uid:
+                    expunged[account_id].append(int(uid))
+            for account_id, uids in expunged.items():
+                for chunk in _chunks(uids):
+                    RawMessage.objects.filter(account_id=account_id, uid__in=chunk).delete()
+            email_ids = [email_id for email_id, _, _, _ in rows]
+            for chunk in _chunks(email_ids):
+                Email.objects.filter(id__in=chunk).delete()
+                remove_emails(chunk)
+            deleted = len(rows)
+            unread = sum(1 for *_, is_read in rows if not is_read)
+            adjust([(user.id, EXTERNAL, -deleted, -unread),
+                    (user.id, MailboxCounter.MAILBOX_SENT, -deleted, 0)])
+        _record(user.id, MailboxChange.KIND_DELETED, email_ids)
+    return _done(user.id, deleted)
+
+
+def move(user, queryset, folder):
+    # 在收件箱、归档和回收站之间移动；变更记录以收件箱为准：移入为 new，移出为 deleted
+    if queryset.model is not Recipient:
+        raise ValueError("外部邮件不支持移动")
+    if folder not in FOLDERS:
+        raise ValueError("未知的文件夹")
+    targets = queryset.exclude(folder=folder)
+    if folder == Recipient.FOLDER_INBOX:
+        counted, sign, kind = targets, 1, MailboxChange.KIND_NEW
+    else:
+        counted, sign = targets.filter(folder=Recipient.FOLDER_INBOX), -1
+        kind = MailboxChange.KIND_DELETED
+    with transaction.atomic():
+        stats = counted.aggregate(total=Count("pk"), unread=Count("pk", filter=Q(is_read=False)))
+        email_ids = _email_ids(counted)
+        updated = targets.update(folder=folder)
+        adjust([(user.id, INBOX, sign * stats["total"], sign * stats["unread"])])
+        _record(user.id, kind, email_ids)
+    return _done(user.id, updated)
@@ -0,0 +1,101 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from mail.models import Email, MailboxChange, MailboxState
+from mail.serializers import EmailSummarySerializer
+
+# 每次分配序列号 / 写入变更处理的用户数
+CHANGE_CHUNK_SIZE = 1000
+# 一次增量同步最多返回的变更数
+SYNC_PAGE_SIZE = 500
+
+
+def record_changes(changes):
+    # changes: [(user_id, kind, email_id), ...]；为每个用户分配连续递增的序列号。
+    # 需要在写邮件的同一事务中调用，保证变更与数据一起提交
+    by_user = defaultdict(list)
+    for user_id, kind, email_id in changes:
+        by_user[user_id].append((kind, email_id))
+    # 固定加锁顺序，避免并发发信时死锁
+    user_ids = sorted(by_user)
+    now = timezone.now()
+    with transaction.atomic():
+        for start in range(0, len(user_ids), CHANGE_CHUNK_SIZE):
+            chunk = user_ids[start:start + CHANGE_CHUNK_SIZE]
+            MailboxState.objects.bulk_create(
+                [MailboxState(user_id=user_id) for user_id in chunk], ignore_conflicts=True)
+            counts = Counter({user_id: len(by_user[user_id]) for user_id in chunk})
+            # 群发时每个用户的变更数相同，一条 UPDATE 即可
+            for count in set(counts.values()):
+                MailboxState.objects.filter(
+                    user_id__in=[u for u in chunk if counts[u] == count],
+                ).update(last_seq=F("last_seq") + count)
+            rows = []
+            for user_id, last_seq in MailboxState.objects.filter(
+                    user_id__in=chunk).values_list("user_id", "last_seq"):
+                first = last_seq - counts[user_id] + 1
+                rows += [MailboxChange(user_id=user_id, seq=first + i, kind=kind,
+                                       email_id=email_id, created_at=now)
+                         for i, (kind, email_id) in enumerate(by_user[user_id])]
+            MailboxChange.objects.bulk_create(rows, batch_size=CHANGE_CHUNK_SIZE)
+
+
+def force_resync(user_ids):
+    # 批量操作涉及的邮件过多时不逐条记录：推进序列号并视为已清理，
+    # 客户端下次同步时收到 resync
+    user_ids = sorted(set(user_ids))
+    with transaction.atomic():
+        MailboxState.objects.bulk_create(
+            [MailboxState(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+        MailboxState.objects.filter(user_id__in=user_ids).update(
+            last_seq=F("last_seq") + 1, pruned_seq=F("last_seq") + 1)
+
+
+def changes_since(user_id, since, limit=SYNC_PAGE_SIZE):
+    # 返回 (变更列表, 当前最新序列号, 是否还有更多)；since 早于已清理的序列号时变更列表为 None
+    state = MailboxState.objects.filter(user_id=user_id).values_list(
+        "last_seq", "pruned_seq").first() or (0, 0)
+    last_seq, pruned_seq = state
+    if since < pruned_seq or since > last_seq:
+        return None, last_seq, False
+    changes = list(MailboxChange.objects.filter(
+        user_id=user_id, seq__gt=since).order_by("seq").values(
+        "seq", "kind", "email_id")[:limit + 1])
+    return changes[:limit], last_seq, len(changes) > limit
+
+
+def serialize_changes(user_id, changes):
+    # new 类变更附带列表摘要，客户端无需再请求 emails/inbox/
+    new_ids = [c["email_id"] for c in changes if c["kind"] == MailboxChange.KIND_NEW]
+    emails = EmailSummarySerializer.setup_eager_loading(
+        Email.objects.filter(id__in=new_ids), user_id).in_bulk(new_ids) if new_ids else {}
+    result = []
+    for change in changes:
+        item = dict(change)
+        if change["kind"] == MailboxChange.KIND_NEW:
+            email = emails.get(change["email_id"])
+            if email is None:
+                # 已被删除，后面会有对应的 deleted 变更
+                continue
+            item["email"] = EmailSummarySerializer(email).data
+        result.append(item)
+    return result
+
+
+def prune_changes(days=None):
+    # 删除超过保留期的变更，并记录每个用户已清理到的序列号
+    days = days if days is not None else getattr(settings, "MAILBOX_CHANGE_RETENTION_DAYS", 30)
+    cutoff = timezone.now() - timedelta(days=days)
+    expired = MailboxChange.objects.filter(created_at__lt=cutoff)
+    with transaction.atomic():
+        for user_id, max_seq in expired.values("user_id").annotate(
+                max_seq=Max("seq")).values_list("user_id", "max_seq"):
+            MailboxState.objects.filter(user_id=user_id, pruned_seq__lt=max_seq).update(
+                pruned_seq=max_seq)
+        deleted, _ = expired.delete()
+    return deleted
@@ -1,23 +1,97 @@
+import asyncio
 import json
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from mail import presence
+from mail.changes import changes_since, serialize_changes
+from mail.counters import get_counters
+
+
+@database_sync_to_async
+def _changes_since(user_id, since):
+    changes, last_seq, more = changes_since(user_id, since)
+    return (None if changes is None else serialize_changes(user_id, changes)), last_seq, more
+
 
 class MailConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.username = self.scope['url_route']['kwargs']['username']
-        self.room_group_name = f"user_{self.username}"
+        self.user = self.scope.get('user')
+        self.heartbeat = None
+        self.seq = None
+        username = self.scope['url_route']['kwargs'].get('username')
+        if (self.user is None or not self.user.is_authenticated
+                or (username and username != self.user.username)):
+            await self.close(code=4401)
+            return
+        self.room_group_name = f"user_{self.user.username}"
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
+        # 登记在线状态，发信时只推送给在线用户
+        await sync_to_async(presence.mark_online)(self.user.id)
+        self.heartbeat = asyncio.create_task(self._refresh_presence())
+        await self.counters({})
 
     async def disconnect(self, close_code):
+        if self.heartbeat is None:
+            return
+        self.heartbeat.cancel()
+        await sync_to_async(presence.mark_offline)(self.user.id)
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
+    async def _refresh_presence(self):
+        while True:
+            await asyncio.sleep(presence.PRESENCE_TTL / 2)
+            await sync_to_async(presence.refresh)(self.user.id)
+
     async def receive(self, text_data):
-        pass
+        # 客户端重连后发送 {"type": "sync", "since": <最后收到的 seq>}，只补发之后的变更
+        try:
+            message = json.loads(text_data)
+            since = int(message.get('since', 0))
+        except (TypeError, ValueError, AttributeError):
+            return
+        if message.get('type') == 'sync':
+            await self.send_changes(since)
+
+    async def send_changes(self, since):
+        while True:
+            changes, last_seq, more = await _changes_since(self.user.id, since)
+            if changes is None:
+                # 序列号已被清理或不属于当前邮箱，需要全量刷新
+                self.seq = last_seq
+                await self.send(text_data=json.dumps({'type': 'resync', 'seq': last_seq}))
+                return
+            if changes:
+                since = changes[-1]['seq']
+            elif not more:
+                since = max(since, last_seq)
+            self.seq = since
+            await self.send(text_data=json.dumps({
+                'type': 'changes', 'changes': changes, 'seq': since, 'more': more,
+            }, default=str))
+            if not more:
+                return
 
     async def new_mail(self, event):
+        # 短时间内的多封新邮件会合并为一条，count 为邮件数
         await self.send(text_data=json.dumps({
             'type': 'new_mail',
             'subject': event['subject'],
             'from': event['from_email'],
+            'count': event.get('count', 1),
         }))
+        # 已同步过的连接直接推送增量
+        if self.seq is not None:
+            await self.send_changes(self.seq)
+
+    async def mailbox_changed(self, event):
+        # 其他设备上的批量操作
+        if self.seq is not None:
+            await self.send_changes(self.seq)
+
+    async def counters(self, event):
+        # 计数变化只通知一次，由连接自己读取当前用户的计数行
+        counters = await database_sync_to_async(get_counters)(self.user.id)
+        await self.send(text_data=json.dumps({'type': 'counters', 'counters': counters}))
@@ -0,0 +1,111 @@
+from collections import defaultdict
+
+from django.db.models import Count, F, Q
+
+from mail.models import Email, MailboxCounter, Recipient
+from mail.notify import notify_users
+from mail.versions import bump_versions
+
+# 每条 UPDATE / 每次校正处理的用户数
+COUNTER_CHUNK_SIZE = 1000
+
+# 邮箱 -> (查询, 用户字段, 已读字段, 额外过滤)，与 inbox / sent / fetch-inbox 列表的查询一致；
+# 已读字段为 None 的邮箱不统计未读数
+_SOURCES = {
+    MailboxCounter.MAILBOX_INBOX: (Recipient.objects, "user_id", "is_read",
+                                   {"folder": Recipient.FOLDER_INBOX}),
+    MailboxCounter.MAILBOX_SENT: (Email.objects, "from_user_id", None, {}),
+    MailboxCounter.MAILBOX_EXTERNAL: (Email.objects, "from_user_id", "is_read", {"is_internal": False}),
+}
+
+
+def _chunks(items, size=COUNTER_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def count_mailbox(mailbox, user_ids):
+    # 按邮件表实际统计，返回 {user_id: (total, unread)}；只用于初始化和校正
+    queryset, user_field, read_field, extra = _SOURCES[mailbox]
+    annotations = {"total": Count("pk")}
+    if read_field:
+        annotations["unread"] = Count("pk", filter=Q(**{read_field: False}))
+    rows = queryset.filter(**{f"{user_field}__in": user_ids}, **extra).order_by().values(
+        user_field).annotate(**annotations)
+    return {row[user_field]: (row["total"], row.get("unread", 0)) for row in rows}
+
+
+def mailbox_deltas(email_obj, recipient_ids=()):
+    # 新邮件对各邮箱计数的影响：[(user_id, mailbox, total, unread), ...]；
+    # 新的收件人记录都在收件箱且未读
+    unread = 0 if email_obj.is_read else 1
+    deltas = [(user_id, MailboxCounter.MAILBOX_INBOX, 1, 1) for user_id in recipient_ids]
+    deltas.append((email_obj.from_user_id, MailboxCounter.MAILBOX_SENT, 1, 0))
+    if not email_obj.is_internal:
+        deltas.append((email_obj.from_user_id, MailboxCounter.MAILBOX_EXTERNAL, 1, unread))
+    return deltas
+
+
+def adjust(deltas):
+    # deltas: [(user_id, mailbox, total, unread), ...]，在写邮件的同一事务中调用。
+    # 增量相同的用户合并为一条 UPDATE；还没有计数行的用户在首次读取时统计
+    totals = defaultdict(lambda: [0, 0])
+    for user_id, mailbox, total, unread in deltas:
+        totals[(user_id, mailbox)][0] += total
+        totals[(user_id, mailbox)][1] += unread
+    groups = defaultdict(list)
+    for (user_id, mailbox), (total, unread) in totals.items():
+        if total or unread:
+            groups[(mailbox, total, unread)].append(user_id)
+    for (mailbox, total, unread), user_ids in groups.items():
+        for chunk in _chunks(sorted(user_ids)):
+            MailboxCounter.objects.filter(user_id__in=chunk, mailbox=mailbox).update(
+                total=F("total") + total, unread=F("unread") + unread)
+    # 影响邮件列表的写入都会经过这里，顺带让列表缓存失效
+    user_ids = {user_id for user_id, _ in totals}
+    bump_versions(user_ids)
+    notify_users(user_ids, {"type": "counters"})
+
+
+def get_counters(user_id):
+    # 读取计数行，只按主键查询，与邮箱大小无关
+    rows = MailboxCounter.objects.filter(user_id=user_id)
+    counters = {mailbox: {"total": total, "unread": unread}
+                for mailbox, total, unread in rows.values_list("mailbox", "total", "unread")}
+    missing = [mailbox for mailbox in _SOURCES if mailbox not in counters]
+    if missing:
+        # 首次读取时统计一次并保存；并发创建时以先写入的为准
+        MailboxCounter.objects.bulk_create([
+            MailboxCounter(user_id=user_id, mailbox=mailbox,
+                           total=counts[0], unread=counts[1])
+            for mailbox in missing
+            for counts in [count_mailbox(mailbox, [user_id]).get(user_id, (0, 0))]
+        ], ignore_conflicts=True)
+        return get_counters(user_id)
+    return counters
+
+
+def reconcile_counters():
+    # 按邮件表校正已有计数行，返回修正的行数。先读计数再统计，
+    # 用条件更新写回：期间有增量更新的行会被跳过，留给下一次校正
+    repaired = 0
+    user_ids = MailboxCounter.objects.order_by("user_id").values_list(
+        "user_id", flat=True).distinct()
+    for chunk in _chunks(user_ids):
+        stored = {(user_id, mailbox): (total, unread)
+                  for user_id, mailbox, total, unread in MailboxCounter.objects.filter(
+                      user_id__in=chunk).values_list("user_id", "mailbox", "total", "unread")}
+        actual = {mailbox: count_mailbox(mailbox, chunk) for mailbox in _SOURCES}
+        changed = set()
+        for (user_id, mailbox), (total, unread) in stored.items():
+            counts = actual.get(mailbox, {}).get(user_id, (0, 0))
+            if counts == (total, unread):
+                continue
+            if MailboxCounter.objects.filter(
+                    user_id=user_id, mailbox=mailbox, total=total, unread=unread,
+            ).update(total=counts[0], unread=counts[1]):
+                repaired += 1
+                changed.add(user_id)
+        notify_users(changed, {"type": "counters"})
+    return repaired
@@ -0,0 +1,116 @@
+import contextvars
+import logging
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils.functional import SimpleLazyObject, empty
+
+logger = logging.getLogger(__name__)
+
+# 写入都到主库；HTTP 请求中的 GET/HEAD/OPTIONS 读副本，以下情况改读主库：
+# 本次请求已经写过、处于事务中、该用户刚写过（STICKY 秒内，覆盖副本延迟）。
+# 请求之外（sync_imap 等 worker、WebSocket consumer）始终读主库
+PRIMARY = "default"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_state = contextvars.ContextVar("mail_db_state", default=None)
+
+
+class _RequestState:
+    def __init__(self, request, replica):
+        self.request = request
+        self.replica = replica
+        self.wrote = False
+        # None 表示还不知道用户（DRF 认证之前）
+        self.pinned = None
+
+
+def replicas():
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+def _pin_key(user_id):
+    return f"mail:db-primary:{user_id}"
+
+
+def pin_primary(user_ids):
+    # 这些用户在 STICKY 秒内的读请求走主库，保证写后能读到自己的写入
+    if not replicas():
+        return
+    timeout = getattr(settings, "DATABASE_REPLICA_STICKY", 5)
+    try:
+        cache.set_many({_pin_key(user_id): 1 for user_id in user_ids}, timeout)
+    except Exception as e:
+        logger.warning("主库粘滞标记写入失败: %s", e)
+
+
+def _is_pinned(user_id):
+    try:
+        return cache.get(_pin_key(user_id)) is not None
+    except Exception:
+        # 缓存不可用时无法判断，读主库
+        return True
+
+
+def _user_id(request):
+    # 不触发延迟加载：认证之前查用户本身也会经过路由
+    user = request.__dict__.get("user")
+    if user is None or (isinstance(user, SimpleLazyObject) and user._wrapped is empty):
+        return None
+    return user.pk if user.is_authenticated else None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.replica is None or state.wrote:
+            return PRIMARY
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        if state.pinned is None:
+            user_id = _user_id(state.request)
+            if user_id is not None:
+                state.pinned = _is_pinned(user_id)
+        return PRIMARY if state.pinned else state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 副本与主库数据相同
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # 每个请求固定使用一个副本，同一请求内的读取互相一致
+        pool = replicas()
+        replica = random.choice(pool) if pool and request.method in SAFE_METHODS else None
+        state = _RequestState(request, replica)
+        token = _state.set(state)
+        try:
+            return self.get_response(request)
+        finally:
+            _state.reset(token)
+            if state.wrote:
+                user_id = _user_id(request)
+                if user_id is not None:
+                    pin_primary([user_id])
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    # connection_created：为新的 SQLite 连接设置 WAL 等参数
+    if connection.vendor != "sqlite":
+        return
+    pragmas = getattr(settings, "SQLITE_PRAGMAS", {})
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
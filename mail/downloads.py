@@ -0,0 +1,109 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_etags, parse_http_date_safe, quote_etag
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# 分段响应每次读取的字节数
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    # 只支持单个区间；返回 (start, end)，无法满足时返回 False，没有或不支持的格式返回 None
+    match = RANGE_RE.match(header.replace(" ", "")) if header else None
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N：最后 N 个字节
+        length = int(last)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _if_range_matches(request, etag, last_modified):
+    # If-Range 与当前版本不一致时忽略 Range，返回完整文件
+    value = request.META.get("HTTP_IF_RANGE")
+    if not value:
+        return True
+    if value.startswith(('"', 'W/')):
+        return etag in parse_etags(value) and not value.startswith("W/")
+    date = parse_http_date_safe(value)
+    return date is not None and int(last_modified) <= date
+
+
+def _read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(RANGE_CHUNK_SIZE, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+
+
+def _offload(path, headers):
+    # 权限检查通过后交给前端代理发送文件，worker 立即返回；Range 由代理处理
+    mode = getattr(settings, "ATTACHMENT_OFFLOAD", None)
+    if mode == "x-accel":
+        relative = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, "/")
+        prefix = getattr(settings, "ATTACHMENT_ACCEL_PREFIX", "/protected-media/")
+        headers["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + quote(relative)
+    elif mode == "x-sendfile":
+        headers["X-Sendfile"] = path
+    else:
+        return None
+    return HttpResponse(headers=headers)
+
+
+def serve_file(request, path, filename, etag=None):
+    # 带 ETag / Last-Modified / Range 的文件下载；etag 为空时由大小和修改时间生成
+    stat = os.stat(path)
+    size, last_modified = stat.st_size, stat.st_mtime
+    etag = quote_etag(etag or f"{size:x}-{int(last_modified):x}")
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Accept-Ranges": "bytes",
+    }
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if not_modified is not None:
+        for name, value in headers.items():
+            not_modified.headers.setdefault(name, value)
+        return not_modified
+
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    disposition = content_disposition_header(True, filename)
+
+    offloaded = _offload(path, {**headers, "Content-Type": content_type,
+                                "Content-Disposition": disposition})
+    if offloaded is not None:
+        return offloaded
+
+    byte_range = None
+    if _if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(request.META.get("HTTP_RANGE"), size)
+    if byte_range is False:
+        return HttpResponse(status=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    if byte_range is None:
+        return FileResponse(open(path, "rb"), as_attachment=True, filename=filename,
+                            content_type=content_type, headers=headers)
+
+    start, end = byte_range
+    return StreamingHttpResponse(
+        _read_range(path, start, end - start + 1), status=206, content_type=content_type,
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}",
+                 "Content-Length": str(end - start + 1), "Content-Disposition": disposition})
@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+
+from mail.changes import record_changes
+from mail.counters import adjust, mailbox_deltas
+from mail.models import DistributionList, MailboxChange, Recipient, User
+
+# 每次 bulk_create 写入的收件人关联行数，同时用于分块查询地址
+FANOUT_CHUNK_SIZE = 1000
+
+
+def _chunks(items, size=FANOUT_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _cache_key(dist_list):
+    return f"mail:dl:{dist_list.pk}:{dist_list.version}"
+
+
+def expand_list(dist_list):
+    # 返回分发列表的用户 id；按 version 缓存，成员变化后自动失效
+    key = _cache_key(dist_list)
+    user_ids = cache.get(key)
+    if user_ids is None:
+        user_ids = list(User.objects.filter(
+            Q(distribution_lists=dist_list) | Q(groups__distribution_lists=dist_list),
+            is_active=True,
+        ).order_by().values_list("id", flat=True).distinct())
+        cache.set(key, user_ids, getattr(settings, "DISTRIBUTION_LIST_CACHE_TIMEOUT", 300))
+    return user_ids
+
+
+def resolve_recipients(addresses):
+    # 返回 (内部用户 id 集合, 外部地址集合)；分发列表地址展开为成员
+    addresses = {address.strip() for address in addresses if address and address.strip()}
+    user_ids, known = set(), set()
+    for chunk in _chunks(addresses):
+        for user_id, email in User.objects.filter(email__in=chunk).values_list("id", "email"):
+            user_ids.add(user_id)
+            known.add(email)
+        for dist_list in DistributionList.objects.filter(address__in=chunk).only(
+                "id", "address", "version"):
+            user_ids.update(expand_list(dist_list))
+            known.add(dist_list.address)
+    return user_ids, addresses - known
+
+
+def deliver_internal(email_obj, user_ids, chunk_size=FANOUT_CHUNK_SIZE):
+    # 分块批量写入收件人关联表，代替 recipients.set() 的逐行比较和插入
+    for chunk in _chunks(sorted(user_ids), chunk_size):
+        Recipient.objects.bulk_create(
+            [Recipient(email_id=email_obj.id, user_id=user_id, sent_at=email_obj.sent_at)
+             for user_id in chunk],
+            ignore_conflicts=True)
+    record_changes([(user_id, MailboxChange.KIND_NEW, email_obj.id) for user_id in user_ids])
+    adjust(mailbox_deltas(email_obj, user_ids))
+
+
+def _bump(queryset):
+    queryset.update(version=F("version") + 1)
+
+
+def invalidate_lists(sender, instance, action, reverse, model, pk_set, **kwargs):
+    # m2m_changed：分发列表成员、分发列表的组、用户所属组变化时让缓存失效
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    lists = DistributionList.objects.all()
+    if isinstance(instance, DistributionList):
+        _bump(lists.filter(pk=instance.pk))
+    elif model is DistributionList:
+        _bump(lists.filter(pk__in=pk_set) if pk_set else lists)
+    elif isinstance(instance, User):
+        # user.groups 变化
+        _bump(lists.filter(groups__in=pk_set) if pk_set else lists.filter(groups__isnull=False))
+    else:
+        # group.user_set 变化
+        _bump(lists.filter(groups=instance))
+
+
+def invalidate_for_deleted(sender, instance, **kwargs):
+    # pre_delete：用户或组被删除时，级联删除不会触发 m2m_changed
+    lists = DistributionList.objects.all()
+    if isinstance(instance, User):
+        _bump(lists.filter(Q(members=instance) | Q(groups__user=instance)))
+    else:
+        _bump(lists.filter(groups=instance))
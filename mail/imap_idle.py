@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import re
+import ssl
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+
+from mail.imap_sync import sync_account
+from mail.models import BoundEmailAccount
+from mail.utils import decrypt
+
+logger = logging.getLogger(__name__)
+
+# RFC 2177 建议客户端每 29 分钟内重新发起 IDLE
+IDLE_TIMEOUT = 29 * 60
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+# 定期检查新增/解绑的账号
+ACCOUNT_REFRESH_INTERVAL = 60
+
+LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n$")
+EXISTS_RE = re.compile(rb"^\* (\d+) EXISTS")
+FETCH_RE = re.compile(rb"^\* (\d+) FETCH ")
+STATUS_RE = re.compile(rb"\[(UIDVALIDITY|UIDNEXT) (\d+)\]")
+
+
+def _quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class IdleClient:
+    # 基于 asyncio 的极简 IMAP 客户端：LOGIN / SELECT / IDLE，其余命令原样发送
+
+    def __init__(self, bound):
+        self.bound = bound
+        self.reader = None
+        self.writer = None
+        self.tag_seq = 0
+        self.status = {}
+        self.exists = 0
+        self.capabilities = ()
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.bound.use_ssl else None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.bound.imap_server, self.bound.imap_port, ssl=context)
+        await self._readline()  # 服务器问候
+        await self.command(
+            f"LOGIN {_quote(self.bound.email_address)} "
+            f"{_quote(decrypt(self.bound.password_encrypted))}")
+        for line in await self.command("CAPABILITY"):
+            if isinstance(line, bytes) and line.upper().startswith(b"* CAPABILITY "):
+                self.capabilities = tuple(line[13:].decode(errors="ignore").upper().split())
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await asyncio.wait_for(self.command("LOGOUT"), 5)
+        except Exception:
+            pass
+        self.writer.close()
+
+    async def _readline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("IMAP 连接已关闭")
+        return line
+
+    async def _read_response(self):
+        # 返回与 imaplib 相同的结构：literal 为 (meta, data) 元组，其余为 bytes
+        line = await self._readline()
+        match = LITERAL_RE.search(line)
+        if not match:
+            return line.rstrip(b"\r\n")
+        literal = await self.reader.readexactly(int(match.group(1)))
+        return (line.rstrip(b"\r\n"), literal)
+
+    async def command(self, line):
+        self.tag_seq += 1
+        tag = f"Y{self.tag_seq}".encode()
+        self.writer.write(tag + b" " + line.encode() + b"\r\n")
+        await self.writer.drain()
+        return await self._collect(tag)
+
+    async def _collect(self, tag):
+        untagged = []
+        while True:
+            item = await self._read_response()
+            if isinstance(item, bytes) and item.startswith(tag + b" "):
+                if not item[len(tag) + 1:].startswith(b"OK"):
+                    raise ConnectionError(item.decode(errors="ignore"))
+                return untagged
+            if isinstance(item, bytes):
+                match = STATUS_RE.search(item)
+                if match:
+                    self.status[match.group(1).decode()] = int(match.group(2))
+            untagged.append(item)
+
+    async def select(self, mailbox="INBOX", readonly=True):
+        self.status = {}
+        for line in await self.command(f"{'EXAMINE' if readonly else 'SELECT'} {mailbox}"):
+            match = isinstance(line, bytes) and EXISTS_RE.match(line)
+            if match:
+                self.exists = int(match.group(1))
+        return self.status.get("UIDVALIDITY"), self.status.get("UIDNEXT")
+
+    async def idle(self, timeout=IDLE_TIMEOUT):
+        # 阻塞直到收到 EXISTS 或超时；返回是否有新邮件
+        self.tag_seq += 1
+        tag = f"Y{self.tag_seq}".encode()
+        self.writer.write(tag + b" IDLE\r\n")
+        await self.writer.drain()
+        line = await self._readline()
+        if not line.startswith(b"+"):
+            raise ConnectionError(f"服务器不支持 IDLE: {line!r}")
+
+        has_new = False
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while not has_new:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    line = await asyncio.wait_for(self._readline(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                has_new = bool(EXISTS_RE.match(line))
+        finally:
+            self.writer.write(b"DONE\r\n")
+            await self.writer.drain()
+        await self._collect(tag)
+        return has_new
+
+
+def _fetch_data(untagged):
+    # 转成 imaplib 的 data：FETCH 响应去掉 "* " 和 FETCH，literal 之后的续行保留，
+    # 其他 untagged 响应（EXISTS、EXPUNGE 等）丢弃
+    data = []
+    for item in untagged:
+        line = item[0] if isinstance(item, tuple) else item
+        match = FETCH_RE.match(line)
+        if match:
+            line = match.group(1) + b" " + line[match.end():]
+        elif line.startswith(b"* "):
+            continue
+        data.append((line, item[1]) if isinstance(item, tuple) else line)
+    return data
+
+
+class SyncSession:
+    # sync_account 用到的 imaplib 接口子集，命令在 IDLE 所在的连接上执行，
+    # 收到 EXISTS 后不再另外登录。只能在 database_sync_to_async 的线程中调用
+    def __init__(self, client):
+        self.client = client
+        self.capabilities = client.capabilities
+
+    def select(self, mailbox="INBOX", readonly=False):
+        async_to_sync(self.client.select)(mailbox, readonly)
+        return "OK", [str(self.client.exists).encode()]
+
+    def response(self, name):
+        value = self.client.status.get(name)
+        return name, [None if value is None else str(value).encode()]
+
+    def uid(self, command, *args):
+        untagged = async_to_sync(self.client.command)(" ".join(("UID", command, *args)))
+        return "OK", _fetch_data(untagged)
+
+    def logout(self):
+        # 连接属于 watch_account
+        pass
+
+
+@database_sync_to_async
+def _load_account(account_id):
+    return BoundEmailAccount.objects.select_related("user").get(pk=account_id)
+
+
+def _sync(bound, client):
+    return sync_account(bound, imap=SyncSession(client))
+
+
+async def watch_account(account_id):
+    delay = RECONNECT_MIN_DELAY
+    while True:
+        client = None
+        try:
+            bound = await _load_account(account_id)
+            client = IdleClient(bound)
+            await client.connect()
+            await client.select()
+            has_new = True  # 连接建立后先追平积压
+            while True:
+                if has_new:
+                    # 入库复用批量同步：只拉取 last_uid 之后的 UID，大邮件流式解析；
+                    # 新邮件通知由 bulk_store 在提交后发出。
+                    # 与 sync_imap 一样在线程前后关闭失效的数据库连接
+                    await database_sync_to_async(_sync, thread_sensitive=False)(bound, client)
+                delay = RECONNECT_MIN_DELAY
+                has_new = await client.idle()
+        except asyncio.CancelledError:
+            raise
+        except BoundEmailAccount.DoesNotExist:
+            return
+        except Exception:
+            logger.exception("IDLE 监听账号 %s 出错，%s 秒后重连", account_id, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        finally:
+            if client is not None:
+                await client.close()
+
+
+@database_sync_to_async
+def _account_ids(account_ids=None):
+    qs = BoundEmailAccount.objects.all()
+    if account_ids:
+        qs = qs.filter(pk__in=account_ids)
+    return set(qs.values_list("pk", flat=True))
+
+
+async def run_listeners(account_ids=None):
+    # 单个事件循环中为每个账号维持一条 IDLE 连接
+    tasks = {}
+    try:
+        while True:
+            wanted = await _account_ids(account_ids)
+            for account_id in wanted - tasks.keys():
+                tasks[account_id] = asyncio.create_task(watch_account(account_id))
+            for account_id in list(tasks):
+                if account_id not in wanted or tasks[account_id].done():
+                    tasks.pop(account_id).cancel()
+            await asyncio.sleep(ACCOUNT_REFRESH_INTERVAL)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
@@ -0,0 +1,174 @@
+import re
+
+from urllib.parse import unquote
+
+from mail.utils import safe_decode_header
+
+# 解析 imaplib 返回的 FETCH 响应（含 ENVELOPE / BODYSTRUCTURE 等嵌套结构）
+
+TOKEN_RE = re.compile(
+    rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    rb'|(?P<atom>[^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?))')
+LITERAL_SUFFIX_RE = re.compile(rb"\{\d+\}$")
+
+
+class Literal(bytes):
+    pass
+
+
+def _tokens(data):
+    for item in data or []:
+        if isinstance(item, tuple):
+            text, literal = item
+            text = LITERAL_SUFFIX_RE.sub(b"", text.rstrip())
+        else:
+            text, literal = item, None
+        pos = 0
+        while pos < len(text or b""):
+            match = TOKEN_RE.match(text, pos)
+            if not match or match.end() == pos:
+                break
+            pos = match.end()
+            if match.group("open"):
+                yield "("
+            elif match.group("close"):
+                yield ")"
+            elif match.group("quoted") is not None:
+                yield re.sub(rb"\\(.)", rb"\1", match.group("quoted"))
+            elif match.group("atom"):
+                atom = match.group("atom")
+                yield None if atom.upper() == b"NIL" else atom.decode(errors="ignore")
+        if literal is not None:
+            yield Literal(literal)
+
+
+def parse_fetch(data):
+    # 返回 [{"UID": 1, "FLAGS": [...], "ENVELOPE": [...], ...}, ...]
+    messages = []
+    stack = []
+    for token in _tokens(data):
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            if not stack:
+                continue
+            finished = stack.pop()
+            if stack:
+                stack[-1].append(finished)
+            else:
+                messages.append(_pairs(finished))
+        elif stack:
+            stack[-1].append(token)
+        # 括号外的 token 是消息序号，忽略
+    return messages
+
+
+def _pairs(items):
+    result = {}
+    for key, value in zip(items[0::2], items[1::2]):
+        if not isinstance(key, str):
+            continue
+        key = key.upper()
+        if key in ("UID", "RFC822.SIZE"):
+            value = int(value)
+        elif isinstance(value, bytes) and not isinstance(value, Literal):
+            value = value.decode(errors="ignore")
+        result[key] = value
+    return result
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="ignore")
+    return safe_decode_header(value)
+
+
+def envelope_fields(envelope):
+    # ENVELOPE: (date subject from sender reply-to to cc bcc in-reply-to message-id)
+    date_, subject, from_ = (envelope + [None] * 3)[:3]
+    sender = ""
+    if from_:
+        name, _, mailbox, host = (from_[0] + [None] * 4)[:4]
+        address = f"{_text(mailbox)}@{_text(host)}" if mailbox else ""
+        name = _text(name)
+        sender = f"{name} <{address}>" if name else address
+    return _text(date_), _text(subject), sender
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    params = {}
+    for key, val in zip(value[0::2], value[1::2]):
+        if isinstance(key, (bytes, str)):
+            key = key.decode() if isinstance(key, bytes) else key
+            params[key.lower()] = _raw(val)
+    return params
+
+
+def _raw(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="ignore")
+    return value or ""
+
+
+def _filename(params):
+    if "filename*" in params:
+        # RFC 2231: charset'language'percent-encoded
+        charset, _, value = (params["filename*"].split("'", 2) + ["", ""])[:3]
+        try:
+            return unquote(value, encoding=charset or "utf-8", errors="replace")
+        except LookupError:
+            return unquote(value)
+    for key in ("filename", "name"):
+        if params.get(key):
+            return _text(params[key])
+    return ""
+
+
+def body_parts(structure, section=""):
+    # 展开 BODYSTRUCTURE，返回叶子节点列表：
+    # {"section", "type", "encoding", "charset", "size", "disposition", "filename"}
+    if structure and isinstance(structure[0], list):
+        parts = []
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            parts += body_parts(child, f"{section}.{index}" if section else str(index))
+        return parts
+
+    fields = structure + [None] * 12
+    maintype, subtype = _raw(fields[0]).lower(), _raw(fields[1]).lower()
+    params = _params(fields[2])
+    encoding = _raw(fields[5]).lower()
+    try:
+        size = int(fields[6] or 0)
+    except (TypeError, ValueError):
+        size = 0
+
+    # 扩展字段位置随类型不同：text 多一个 lines，message/rfc822 多 envelope/body/lines
+    if maintype == "text":
+        ext = 8
+    elif maintype == "message" and subtype == "rfc822":
+        ext = 10
+    else:
+        ext = 7
+    disposition = fields[ext + 1]
+    disposition_type, disposition_params = "", {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _raw(disposition[0]).lower()
+        disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+
+    return [{
+        "section": section or "1",
+        "type": f"{maintype}/{subtype}",
+        "encoding": encoding,
+        "charset": params.get("charset", ""),
+        "size": size,
+        "disposition": disposition_type,
+        "filename": _filename(disposition_params) or _filename(params),
+    }]
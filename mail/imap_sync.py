@@ -0,0 +1,634 @@
+import email
+import imaplib
+import logging
+import re
+import tempfile
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from mail import bulk
+from mail.imap_response import body_parts, envelope_fields, parse_fetch
+from mail.blobs import add_refs, store_blob
+from mail.mime_stream import HashingSpool, decode_chunks, parse_message_stream
+from mail.changes import record_changes
+from mail.counters import adjust, mailbox_deltas
+from mail.models import Attachment, BoundEmailAccount, Email, MailboxChange, PendingExpunge, RawMessage
+from mail.notify import notify_users
+from mail.raw_store import append_messages, replay
+from mail.search import index_emails
+from mail.versions import bump_versions
+from mail.utils import decrypt, make_snippet, parse_date_header, safe_decode_header
+
+logger = logging.getLogger(__name__)
+
+# 超过该时间仍处于 syncing 状态视为上次同步异常退出，可重新抢占
+SYNC_LOCK_TIMEOUT = timedelta(minutes=30)
+# 每条 UID STORE 携带的 UID 数
+STORE_BATCH_SIZE = 500
+
+
+def open_imap(bound):
+    password = decrypt(bound.password_encrypted)
+    if bound.use_ssl:
+        imap = imaplib.IMAP4_SSL(bound.imap_server, bound.imap_port)
+    else:
+        imap = imaplib.IMAP4(bound.imap_server, bound.imap_port)
+    imap.login(bound.email_address, password)
+    return imap
+
+
+def _status_value(imap, name):
+    # SELECT 之后服务器以 untagged OK [UIDVALIDITY n] 等形式返回邮箱状态
+    typ, data = imap.response(name)
+    if data and data[-1]:
+        try:
+            return int(data[-1])
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def parse_message(raw_email):
+    msg = email.message_from_bytes(raw_email)
+
+    subject = safe_decode_header(msg["Subject"])
+    from_ = safe_decode_header(msg.get("From"))
+    date_ = parse_date_header(msg.get("Date"))
+
+    body = ""
+    attachments = []
+
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get("Content-Disposition"))
+            charset = part.get_content_charset() or 'utf-8'
+
+            if content_type == "text/plain" and "attachment" not in content_disposition:
+                payload = part.get_payload(decode=True) or b""
+                try:
+                    body += payload.decode(charset, errors="ignore")
+                except Exception:
+                    body += payload.decode("utf-8", errors="ignore")
+            elif "attachment" in content_disposition:
+                filename = part.get_filename()
+                if filename:
+                    filename = safe_decode_header(filename)
+                else:
+                    filename = "unknown"
+                content = part.get_payload(decode=True) or b""
+                attachments.append((filename, content))
+    else:
+        charset = msg.get_content_charset() or 'utf-8'
+        payload = msg.get_payload(decode=True) or b""
+        try:
+            body = payload.decode(charset, errors="ignore")
+        except Exception:
+            body = payload.decode("utf-8", errors="ignore")
+
+    return subject, from_, date_, body, attachments
+
+
+# 先用一条 FETCH 取得所有新邮件的 UID 和大小，再按数量和字节数分批：
+# 小邮件每批一条 FETCH 连同标记取回正文，大邮件分段取回并流式解析
+SCAN_ITEMS = "(UID RFC822.SIZE)"
+BODY_ITEMS = "(UID FLAGS INTERNALDATE BODY.PEEK[])"
+# 两阶段同步：只取信封和结构，正文/附件在首次访问时按 section 拉取
+ENVELOPE_ITEMS = "(UID FLAGS INTERNALDATE RFC822.SIZE ENVELOPE BODYSTRUCTURE)"
+
+UID_RE = re.compile(rb"UID (\d+)")
+SIZE_RE = re.compile(rb"RFC822\.SIZE (\d+)")
+FLAGS_RE = re.compile(rb"FLAGS \(([^)]*)\)")
+INTERNALDATE_RE = re.compile(rb'INTERNALDATE "([^"]+)"')
+
+
+def uid_set(uids):
+    # [1, 2, 3, 7, 9, 10] -> "1:3,7,9:10"
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def parse_fetch_response(data):
+    # imaplib 把每封邮件拆成 (meta, literal) 元组加若干 bytes 片段，
+    # 按元组重新分组，返回 [(meta, literal), ...]
+    messages = []
+    for item in data or []:
+        if isinstance(item, tuple):
+            messages.append([item[0], item[1]])
+        elif item and messages:
+            messages[-1][0] += b" " + item
+    return [(meta, literal) for meta, literal in messages]
+
+
+def _meta_uid(meta):
+    match = UID_RE.search(meta)
+    return int(match.group(1)) if match else None
+
+
+def _meta_flags(meta):
+    match = FLAGS_RE.search(meta)
+    return match.group(1).decode() if match else ""
+
+
+def _meta_internaldate(meta):
+    match = INTERNALDATE_RE.search(meta)
+    return _internaldate(match.group(1).decode()) if match else None
+
+
+def _internaldate(value):
+    try:
+        return datetime.strptime(value or "", "%d-%b-%Y %H:%M:%S %z")
+    except ValueError:
+        return None
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _fetch_sizes_since(imap, last_uid):
+    # 返回 [(uid, size)]；UID FETCH n:* 在没有新邮件时仍会返回最后一封，需要再过滤一次
+    typ, data = imap.uid("FETCH", f"{last_uid + 1}:*", SCAN_ITEMS)
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH 失败: {data}")
+    sizes = {}
+    for item in data or []:
+        meta = (item[0] if isinstance(item, tuple) else item) or b""
+        uid = _meta_uid(meta)
+        if uid is not None and uid > last_uid:
+            sizes[uid] = _meta_size(meta)
+    return sorted(sizes.items())
+
+
+def _fetch_batches(sizes, count, max_bytes, threshold):
+    # 每批不超过 count 封、正文合计不超过 max_bytes；大邮件分段拉取，不计入批次字节数
+    batch, total = [], 0
+    for uid, size in sizes:
+        weight = size if size <= threshold else 0
+        if batch and (len(batch) >= count or total + weight > max_bytes):
+            yield batch
+            batch, total = [], 0
+        batch.append((uid, size))
+        total += weight
+    if batch:
+        yield batch
+
+
+def _meta_size(meta):
+    match = SIZE_RE.search(meta)
+    return int(match.group(1)) if match else 0
+
+
+def _stream_threshold():
+    return getattr(settings, "IMAP_STREAM_THRESHOLD", 5 * 1024 * 1024)
+
+
+def _fetch_spooled(imap, uid, size):
+    # 用 BODY.PEEK[]<offset.length> 分段拉取，单次内存占用不超过一个分段；
+    # 标记和日期随第一段一起取回。返回 (meta, 文件对象)
+    chunk_size = getattr(settings, "IMAP_STREAM_CHUNK_SIZE", 1024 * 1024)
+    spool = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+    meta = b""
+    offset = 0
+    while offset < size:
+        items = f"BODY.PEEK[]<{offset}.{chunk_size}>"
+        if not offset:
+            items = f"UID FLAGS INTERNALDATE {items}"
+        typ, data = imap.uid("FETCH", str(uid), f"({items})")
+        if typ != "OK":
+            raise imaplib.IMAP4.error(f"UID FETCH 失败: {data}")
+        parts = parse_fetch_response(data)
+        if not offset and parts:
+            meta = parts[0][0]
+        chunk = parts[0][1] if parts else b""
+        if not chunk:
+            break
+        spool.write(chunk)
+        offset += len(chunk)
+    spool.seek(0)
+    return meta, spool
+
+
+def fetch_batch(imap, batch):
+    # batch: [(uid, size)]；返回 [(uid, meta, source)]，source 为 bytes 或已定位到开头的文件对象
+    threshold = _stream_threshold()
+    small = {uid for uid, size in batch if size <= threshold}
+    messages = []
+    if small:
+        typ, data = imap.uid("FETCH", uid_set(small), BODY_ITEMS)
+        if typ != "OK":
+            raise imaplib.IMAP4.error(f"UID FETCH 失败: {data}")
+        for meta, raw_email in parse_fetch_response(data):
+            uid = _meta_uid(meta)
+            if uid in small and raw_email:
+                messages.append((uid, meta, raw_email))
+    for uid, size in batch:
+        if uid not in small:
+            meta, spool = _fetch_spooled(imap, uid, size)
+            messages.append((uid, meta, spool))
+    return sorted(messages, key=lambda m: m[0])
+
+
+def _build_message(bound, uid, source, flags, internal_date=None):
+    # 只构造对象，不写库；附件文件先写入存储
+    if isinstance(source, bytes):
+        subject, from_, date_, body, attachments = parse_message(source)
+    else:
+        subject, from_, date_, body, attachments = parse_message_stream(source)
+    email_obj = Email(
+        from_user=bound.user,
+        from_external=from_,
+        subject=subject,
+        body=body,
+        snippet=make_snippet(body),
+        is_internal=False,
+        is_read="\\Seen" in flags,
+        sent_at=date_ or internal_date or timezone.now(),
+        external_uid=str(uid),
+        external_account=bound
+    )
+    atts = []
+    for filename, content in attachments:
+        if isinstance(content, bytes):
+            blob = store_blob(content)
+        else:
+            with content:
+                blob = store_blob(content)
+        atts.append(Attachment(email=email_obj, filename=filename, blob=blob,
+                               file=blob.file.name, size=blob.size))
+    return email_obj, atts
+
+
+def _build_envelope(bound, item):
+    date_str, subject, from_ = envelope_fields(item.get("ENVELOPE") or [])
+    parts = body_parts(item.get("BODYSTRUCTURE") or [])
+    email_obj = Email(
+        from_user=bound.user,
+        from_external=from_,
+        subject=subject,
+        body="",
+        is_internal=False,
+        is_read="\\Seen" in (item.get("FLAGS") or []),
+        sent_at=(parse_date_header(date_str)
+                 or _internaldate(item.get("INTERNALDATE")) or timezone.now()),
+        external_uid=str(item["UID"]),
+        external_account=bound,
+        body_fetched=False,
+        imap_body_parts=[
+            {"section": p["section"], "encoding": p["encoding"], "charset": p["charset"]}
+            for p in parts
+            if p["type"] == "text/plain" and p["disposition"] != "attachment"],
+    )
+    atts = [Attachment(
+        email=email_obj,
+        filename=part["filename"] or "unknown",
+        imap_section=part["section"],
+        imap_encoding=part["encoding"],
+        size=part["size"],
+    ) for part in parts if part["disposition"] == "attachment"]
+    return email_obj, atts
+
+
+def _existing_uids(bound, uids):
+    # 只查询本批次的 UID，重复由 (external_account, external_uid) 唯一约束兜底
+    return set(Email.objects.filter(
+        external_account=bound, external_uid__in=[str(u) for u in uids],
+    ).values_list("external_uid", flat=True))
+
+
+def bulk_store(bound, built, last_uid, raw=()):
+    # 一个批次在同一事务中 bulk_create 邮件、附件和原始邮件索引，并推进 last_uid
+    emails = [email_obj for email_obj, _ in built]
+    uids = [e.external_uid for e in emails]
+    with transaction.atomic():
+        # ignore_conflicts 不回填主键，插入后只能按 UID 回查；回查结果里插入前就存在的行
+        # （其他 worker 先入库）和同一批里重复的 UID 都不是这次新建的，不能再挂附件、计数和通知
+        seen = set(Email.objects.filter(
+            external_account=bound, external_uid__in=uids,
+        ).values_list("external_uid", flat=True))
+        Email.objects.bulk_create(emails, batch_size=500, ignore_conflicts=True)
+        RawMessage.objects.bulk_create(raw, batch_size=500, ignore_conflicts=True)
+        ids = dict(Email.objects.filter(
+            external_account=bound, external_uid__in=uids,
+        ).values_list("external_uid", "id"))
+        attachments = []
+        new = []
+        for email_obj, atts in built:
+            email_obj.pk = None
+            if email_obj.external_uid in seen or email_obj.external_uid not in ids:
+                continue
+            seen.add(email_obj.external_uid)
+            email_obj.pk = ids[email_obj.external_uid]
+            new.append(email_obj)
+            attachments += atts
+        Attachment.objects.bulk_create(attachments, batch_size=500)
+        add_refs(att.blob_id for att in attachments)
+        bound.last_uid = max(bound.last_uid, last_uid)
+        bound.save(update_fields=["last_uid"])
+        new_ids = [e.pk for e in new]
+        index_emails(new_ids)
+        record_changes([(bound.user_id, MailboxChange.KIND_NEW, email_id) for email_id in new_ids])
+        adjust([delta for e in new for delta in mailbox_deltas(e)])
+        if new_ids:
+            # 无论由 sync_imap 还是 IDLE 入库都在提交后推送；一批合并为一条，count 为邮件数
+            latest = max(new, key=lambda e: (e.sent_at, e.pk))
+            notify_users([bound.user_id], {
+                "type": "new_mail",
+                "subject": latest.subject,
+                "from_email": latest.from_external,
+                "count": len(new_ids),
+            })
+    return new_ids
+
+
+def claim(bound):
+    # 同一账号同一时间只允许一个 worker 同步
+    stale = timezone.now() - SYNC_LOCK_TIMEOUT
+    return BoundEmailAccount.objects.filter(pk=bound.pk).filter(
+        ~Q(sync_status=BoundEmailAccount.SYNC_RUNNING)
+        | Q(sync_started_at__lt=stale)
+    ).update(sync_status=BoundEmailAccount.SYNC_RUNNING,
+             sync_started_at=timezone.now()) == 1
+
+
+def release(bound, error=None):
+    if error is not None:
+        bound.sync_status = BoundEmailAccount.SYNC_ERROR
+        bound.sync_error = str(error)
+    else:
+        bound.sync_status = BoundEmailAccount.SYNC_IDLE
+        bound.sync_error = ""
+        bound.last_synced_at = timezone.now()
+    bound.save(update_fields=[
+        "uid_next", "sync_status", "sync_error", "last_synced_at"])
+
+
+def store_messages(bound, messages, last_uid=0):
+    # 保存 fetch_batch 的结果，返回新建邮件 id
+    existing = _existing_uids(bound, [uid for uid, _, _ in messages])
+    built = []
+    sources = []
+    try:
+        for uid, meta, source in messages:
+            if uid <= bound.last_uid or str(uid) in existing:
+                continue
+            built.append(_build_message(
+                bound, uid, source, _meta_flags(meta), _meta_internaldate(meta)))
+            sources.append((uid, source))
+        # 保留原始邮件，以后解析新字段时可以本地重放，不必重新下载
+        raw = append_messages(bound, sources)
+    finally:
+        for _, _, source in messages:
+            if not isinstance(source, bytes):
+                source.close()
+    last_uid = max([last_uid] + [uid for uid, _, _ in messages])
+    return bulk_store(bound, built, last_uid, raw)
+
+
+def store_envelopes(bound, imap, batch):
+    typ, data = imap.uid("FETCH", uid_set(batch), ENVELOPE_ITEMS)
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH 失败: {data}")
+    items = [item for item in parse_fetch(data) if item.get("UID")]
+    existing = _existing_uids(bound, [item["UID"] for item in items])
+    built = [_build_envelope(bound, item) for item in items
+             if item["UID"] > bound.last_uid and str(item["UID"]) not in existing]
+    return bulk_store(bound, built, batch[-1])
+
+
+def _reparse_batch(batch):
+    keys = {(entry.account_id, str(entry.uid)): raw for entry, raw in batch}
+    emails = Email.objects.filter(
+        external_account_id__in={account_id for account_id, _ in keys},
+        external_uid__in={uid for _, uid in keys})
+    changed = []
+    for email_obj in emails:
+        raw = keys.get((email_obj.external_account_id, email_obj.external_uid))
+        if raw is None:
+            continue
+        subject, from_, _, body, _ = parse_message(raw)
+        email_obj.subject, email_obj.from_external = subject, from_
+        email_obj.body, email_obj.snippet = body, make_snippet(body)
+        email_obj.body_fetched = True
+        changed.append(email_obj)
+    with transaction.atomic():
+        Email.objects.bulk_update(
+            changed, ["subject", "from_external", "body", "snippet", "body_fetched"], batch_size=500)
+        index_emails([e.pk for e in changed])
+        bump_versions({e.from_user_id for e in changed})
+    return len(changed)
+
+
+def reparse_raw(entries=None, batch_size=500):
+    # 从本地保存的原始邮件重新解析并更新邮件字段和搜索索引，不访问 IMAP；返回更新的邮件数
+    updated = 0
+    batch = []
+    for item in replay(entries):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            updated += _reparse_batch(batch)
+            batch = []
+    if batch:
+        updated += _reparse_batch(batch)
+    return updated
+
+
+def check_uid_validity(bound, uid_validity):
+    if uid_validity != bound.uid_validity:
+        # UIDVALIDITY 变化（或首次同步）时旧 UID 全部失效，重新拉取。
+        # 与用户删除走同一路径：计数、变更记录和搜索索引一起清理
+        bulk.delete(bound.user, Email.objects.filter(external_account=bound), expunge=False)
+        PendingExpunge.objects.filter(account=bound).delete()
+        RawMessage.objects.filter(account=bound).delete()
+        bump_versions([bound.user_id])
+        bound.uid_validity = uid_validity
+        bound.last_uid = 0
+        bound.save(update_fields=["uid_validity", "last_uid"])
+
+
+def has_pending_flags(bound):
+    return (Email.objects.filter(external_account=bound, imap_flags_dirty=True).exists()
+            or PendingExpunge.objects.filter(account=bound).exists())
+
+
+def _store(imap, uids, action, flags):
+    typ, data = imap.uid("STORE", uid_set(uids), action, flags)
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"UID STORE 失败: {data}")
+
+
+def push_flags(bound, imap):
+    # 把本地的已读/删除批量写回服务器：按目标状态分组，每批一条 UID STORE，
+    # UID 压缩为序列集合。需要以读写方式 SELECT
+    dirty = list(Email.objects.filter(external_account=bound, imap_flags_dirty=True).values_list(
+        "id", "external_uid", "is_read"))
+    for read in (True, False):
+        group = [(pk, int(uid)) for pk, uid, is_read in dirty if is_read == read and uid]
+        for batch in _batches(group, STORE_BATCH_SIZE):
+            _store(imap, [uid for _, uid in batch],
+                   "+FLAGS.SILENT" if read else "-FLAGS.SILENT", r"(\Seen)")
+            # 推送期间又被修改的邮件保持 dirty，下次再推
+            Email.objects.filter(pk__in=[pk for pk, _ in batch], is_read=read).update(
+                imap_flags_dirty=False)
+
+    pending = list(PendingExpunge.objects.filter(account=bound).values_list("id", "uid"))
+    for batch in _batches(pending, STORE_BATCH_SIZE):
+        uids = [uid for _, uid in batch]
+        _store(imap, uids, "+FLAGS.SILENT", r"(\Deleted)")
+        if "UIDPLUS" in imap.capabilities:
+            # 只清除这些 UID，不影响用户在其他客户端标记删除的邮件
+            imap.uid("EXPUNGE", uid_set(uids))
+        PendingExpunge.objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+
+
+def sync_account(bound, batch_size=None, mode=None, imap=None):
+    # 增量同步：只拉取 UID 大于 last_uid 的邮件，返回新建邮件 id
+    # mode 为 "full" 时下载完整邮件，为 "envelope" 时只同步信封。
+    # imap 为调用方已登录的会话（IDLE 监听）时直接复用，不另行登录和注销
+    batch_size = batch_size or getattr(settings, "IMAP_FETCH_BATCH_SIZE", 100)
+    mode = mode or getattr(settings, "IMAP_SYNC_MODE", "full")
+    if not claim(bound):
+        logger.info("账号 %s 正在同步，跳过", bound.email_address)
+        return []
+
+    bound.refresh_from_db()
+    new_ids = []
+    try:
+        owned = imap is None
+        if owned:
+            imap = open_imap(bound)
+        try:
+            # 有待推送的标记时才以读写方式打开
+            pending = has_pending_flags(bound)
+            typ, data = imap.select("INBOX", readonly=not pending)
+            exists = int(data[0]) if typ == "OK" and data and data[0] else 0
+            check_uid_validity(bound, _status_value(imap, "UIDVALIDITY"))
+            if pending:
+                push_flags(bound, imap)
+            uid_next = _status_value(imap, "UIDNEXT")
+
+            # 空邮箱上 UID FETCH n:* 会报错
+            if exists and (uid_next is None or uid_next > bound.last_uid + 1):
+                # 按批次 UID FETCH，避免每封邮件单独往返
+                sizes = _fetch_sizes_since(imap, bound.last_uid)
+                if mode == "envelope":
+                    batches = _batches(sizes, batch_size)
+                else:
+                    batches = _fetch_batches(
+                        sizes, batch_size,
+                        getattr(settings, "IMAP_FETCH_BATCH_BYTES", 20 * 1024 * 1024),
+                        _stream_threshold())
+                for batch in batches:
+                    if mode == "envelope":
+                        new_ids += store_envelopes(bound, imap, [uid for uid, _ in batch])
+                    else:
+                        new_ids += store_messages(
+                            bound, fetch_batch(imap, batch), batch[-1][0])
+
+            bound.uid_next = uid_next
+        finally:
+            if owned:
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+    except Exception as e:
+        logger.exception("同步账号 %s 失败", bound.email_address)
+        release(bound, error=e)
+    else:
+        release(bound)
+    return new_ids
+
+
+def _open_mailbox(bound):
+    imap = open_imap(bound)
+    imap.select("INBOX", readonly=True)
+    if _status_value(imap, "UIDVALIDITY") != bound.uid_validity:
+        imap.logout()
+        raise imaplib.IMAP4.error("UIDVALIDITY 已变化，请等待重新同步")
+    return imap
+
+
+def fetch_email_body(email_obj):
+    # 按需拉取信封模式邮件的正文（BODY.PEEK 不改变服务器上的已读状态）
+    parts = email_obj.imap_body_parts or []
+    body = ""
+    if parts:
+        imap = _open_mailbox(email_obj.external_account)
+        try:
+            items = " ".join(f"BODY.PEEK[{p['section']}]" for p in parts)
+            typ, data = imap.uid("FETCH", email_obj.external_uid, f"(UID {items})")
+            if typ != "OK":
+                raise imaplib.IMAP4.error(f"UID FETCH 失败: {data}")
+            fetched = parse_fetch(data)
+        finally:
+            imap.logout()
+        values = fetched[0] if fetched else {}
+        for part in parts:
+            raw = values.get(f"BODY[{part['section']}]") or b""
+            if isinstance(raw, str):
+                raw = raw.encode()
+            decoded = b"".join(decode_chunks([raw], part["encoding"]))
+            try:
+                body += decoded.decode(part["charset"] or "utf-8", errors="ignore")
+            except LookupError:
+                body += decoded.decode("utf-8", errors="ignore")
+
+    email_obj.body = body
+    email_obj.body_fetched = True
+    email_obj.save(update_fields=["body", "body_fetched"])
+    index_emails([email_obj.id])
+    # 列表中的 snippet 随正文更新
+    bump_versions([email_obj.from_user_id])
+    return email_obj
+
+
+def fetch_attachment(attachment):
+    # 按需分段拉取占位附件，边解码边写入临时文件后保存到存储
+    email_obj = attachment.email
+    chunk_size = getattr(settings, "IMAP_STREAM_CHUNK_SIZE", 1024 * 1024)
+    imap = _open_mailbox(email_obj.external_account)
+
+    def chunks():
+        offset = 0
+        while True:
+            typ, data = imap.uid(
+                "FETCH", email_obj.external_uid,
+                f"(BODY.PEEK[{attachment.imap_section}]<{offset}.{chunk_size}>)")
+            if typ != "OK":
+                raise imaplib.IMAP4.error(f"UID FETCH 失败: {data}")
+            fetched = parse_fetch(data)
+            raw = next((v for k, v in (fetched[0] if fetched else {}).items()
+                        if k.startswith("BODY[")), b"") or b""
+            if isinstance(raw, str):
+                raw = raw.encode()
+            if not raw:
+                return
+            yield raw
+            offset += len(raw)
+            if len(raw) < chunk_size:
+                return
+
+    spool = HashingSpool(chunk_size)
+    try:
+        for piece in decode_chunks(chunks(), attachment.imap_encoding):
+            spool.write(piece)
+    finally:
+        imap.logout()
+    with spool:
+        blob = store_blob(spool)
+    attachment.blob = blob
+    attachment.file = blob.file.name
+    attachment.save(update_fields=["blob", "file"])
+    add_refs([blob.pk])
+    return attachment
@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from mail.blobs import GC_GRACE, collect_garbage, reconcile_refs
+from mail.raw_store import drop_dead_segments
+from mail.uploads import expire_uploads
+
+
+class Command(BaseCommand):
+    help = "Remove attachment blobs that are no longer referenced"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=float, default=GC_GRACE.total_seconds() / 3600,
+                            help="引用数归零后保留的小时数")
+        parser.add_argument("--reconcile", action="store_true",
+                            help="回收前按 Attachment 表重算引用数")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="只统计，不删除")
+
+    def handle(self, *args, **options):
+        if not options["dry_run"]:
+            self.stdout.write(f"expired {expire_uploads()} upload sessions")
+            self.stdout.write(f"dropped {drop_dead_segments()} raw message segments")
+        if options["reconcile"]:
+            self.stdout.write(f"reconciled {reconcile_refs()} blobs")
+        removed, freed = collect_garbage(
+            timedelta(hours=options["grace"]), dry_run=options["dry_run"])
+        action = "would remove" if options["dry_run"] else "removed"
+        self.stdout.write(f"{action} {removed} blobs ({freed} bytes)")
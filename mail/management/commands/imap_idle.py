@@ -0,0 +1,19 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from mail.imap_idle import run_listeners
+
+
+class Command(BaseCommand):
+    help = "Hold IMAP IDLE connections and push new mail to WebSocket clients"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", type=int, action="append",
+                            help="只监听指定 BoundEmailAccount id，可重复")
+
+    def handle(self, *args, **options):
+        try:
+            asyncio.run(run_listeners(options["account"]))
+        except KeyboardInterrupt:
+            pass
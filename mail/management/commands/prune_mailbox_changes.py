@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from mail.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = "Delete mailbox change records older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="保留天数，默认 MAILBOX_CHANGE_RETENTION_DAYS")
+
+    def handle(self, *args, **options):
+        deleted = prune_changes(options["days"])
+        self.stdout.write(f"pruned {deleted} mailbox changes")
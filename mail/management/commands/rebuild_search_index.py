@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from mail.search import REBUILD_BATCH, create_search_index, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index for all emails"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS,
+                            help="要重建索引的数据库别名")
+        parser.add_argument("--batch-size", type=int, default=REBUILD_BATCH,
+                            help="每批处理的邮件数")
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        create_search_index(using)
+        count = rebuild_index(using, batch_size=options["batch_size"])
+        self.stdout.write(f"indexed {count} emails")
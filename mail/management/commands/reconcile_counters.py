@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from mail.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Recount mailbox counters from the email tables and repair drift"
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"repaired {reconcile_counters()} mailbox counters")
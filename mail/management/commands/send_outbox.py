@@ -0,0 +1,52 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.notify import coalescer
+from mail.outbox import claim_batch, deliver
+from mail.smtp_pool import smtp_pool
+
+
+class Command(BaseCommand):
+    help = "Deliver queued outbound mail with retry and backoff"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true",
+                            help="持续运行，队列为空时每隔 --interval 秒检查一次")
+        parser.add_argument("--interval", type=float, default=1.0)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=50,
+                            help="每次领取的消息数")
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            while True:
+                batch = claim_batch(options["batch_size"])
+                for message in pool.map(self.deliver, batch):
+                    self.stdout.write(
+                        f"outbox {message.pk}: {message.status} "
+                        f"(attempt {message.attempts})")
+                if batch:
+                    continue
+                if not options["loop"]:
+                    break
+                # 队列空闲时给池中连接发送 NOOP 保活，并关闭超时连接
+                smtp_pool.reap()
+                time.sleep(options["interval"])
+        stats = smtp_pool.stats()
+        smtp_pool.close_all()
+        # 合并窗口中的通知在退出前发出
+        coalescer.flush()
+        self.stdout.write(
+            f"smtp pool: {stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate']:.0%}), {stats['expired']} expired, "
+            f"{stats['recycled']} recycled, {stats['noop_failures']} failed NOOP")
+
+    @staticmethod
+    def deliver(message):
+        try:
+            return deliver(message)
+        finally:
+            close_old_connections()
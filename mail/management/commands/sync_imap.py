@@ -0,0 +1,62 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.imap_sync import sync_account
+from mail.models import BoundEmailAccount
+from mail.notify import coalescer
+
+
+class Command(BaseCommand):
+    help = "Incrementally sync bound IMAP accounts in the background"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", type=int, action="append",
+                            help="只同步指定 BoundEmailAccount id，可重复")
+        parser.add_argument("--loop", action="store_true",
+                            help="持续运行，每隔 --interval 秒同步一次")
+        parser.add_argument("--interval", type=int, default=60)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="每次 UID FETCH 的邮件数，默认 IMAP_FETCH_BATCH_SIZE")
+        parser.add_argument("--mode", choices=["full", "envelope"], default=None,
+                            help="同步模式，默认 IMAP_SYNC_MODE")
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                self.sync_once(options["account"], options["workers"],
+                               options["batch_size"], options["mode"])
+                if not options["loop"]:
+                    break
+                time.sleep(options["interval"])
+        finally:
+            # 合并窗口中的新邮件通知在退出前发出
+            coalescer.flush()
+
+    def sync_once(self, account_ids, workers, batch_size=None, mode=None):
+        accounts = BoundEmailAccount.objects.select_related("user")
+        if account_ids:
+            accounts = accounts.filter(pk__in=account_ids)
+
+        def run(bound):
+            started = time.monotonic()
+            try:
+                return bound, len(sync_account(bound, batch_size, mode)), time.monotonic() - started
+            finally:
+                close_old_connections()
+
+        total, started = 0, time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for bound, created, elapsed in pool.map(run, list(accounts)):
+                total += created
+                self.stdout.write(
+                    f"{bound.email_address}: {created} new in {elapsed:.2f}s "
+                    f"({created / elapsed if elapsed else 0:.1f} msg/s), "
+                    f"status={bound.sync_status}")
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"synced {total} messages in {elapsed:.2f}s "
+            f"({total / elapsed if elapsed else 0:.1f} msg/s)")
@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Email.recipients 原来是自动生成的多对多表 mail_email_recipients，这里把它接管为 Recipient 模型：
+# 状态中新建模型并改为 through='mail.Recipient'，数据库中只在原表上加列并回填，不重建表。
+# 原来的已读状态在 mail_email.is_read 上，回填到每个收件人各自的行
+def _new_columns():
+    columns = [
+        ('is_read', models.BooleanField(default=False)),
+        ('folder', models.CharField(max_length=16, default='inbox')),
+        ('sent_at', models.DateTimeField(null=True, blank=True)),
+    ]
+    for name, field in columns:
+        field.set_attributes_from_name(name)
+    return columns
+
+
+def add_columns(apps, schema_editor):
+    # 直接 ADD COLUMN：SQLite 的 add_field 会按历史模型重建表，丢掉前面刚加的列
+    through = apps.get_model('mail', 'Email').recipients.through
+    for _, field in _new_columns():
+        definition, params = schema_editor.column_sql(through, field, include_default=True)
+        schema_editor.execute(schema_editor.sql_create_column % {
+            'table': schema_editor.quote_name(through._meta.db_table),
+            'column': schema_editor.quote_name(field.column),
+            'definition': definition,
+        }, params)
+
+
+def remove_columns(apps, schema_editor):
+    through = apps.get_model('mail', 'Email').recipients.through
+    for _, field in reversed(_new_columns()):
+        schema_editor.remove_field(through, field)
+
+
+BACKFILL = """
+UPDATE mail_email_recipients SET
+    is_read = (SELECT e.is_read FROM mail_email e WHERE e.id = mail_email_recipients.email_id),
+    sent_at = (SELECT e.sent_at FROM mail_email e WHERE e.id = mail_email_recipients.email_id)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_columns, remove_columns),
+                migrations.RunSQL(BACKFILL, migrations.RunSQL.noop),
+            ],
+            state_operations=[
+                migrations.CreateModel(
+                    name='Recipient',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('is_read', models.BooleanField(default=False)),
+                        ('folder', models.CharField(choices=[('inbox', 'Inbox'), ('archive', 'Archive'), ('trash', 'Trash')], default='inbox', max_length=16)),
+                        ('sent_at', models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True)),
+                        ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipient_states', to='mail.email')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_entries', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'mail_email_recipients',
+                        # 与自动生成的表上已有的唯一约束一致，后续迁移再换成命名约束
+                        'unique_together': {('email', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='email',
+                    name='recipients',
+                    field=models.ManyToManyField(related_name='received_emails', through='mail.Recipient', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+    ]
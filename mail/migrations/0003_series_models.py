@@ -0,0 +1,305 @@
+# Generated by Django 4.2.9 on 2026-10-18 09:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import mail.models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('mail', '0002_recipient_through'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(blank=True, upload_to=mail.models.blob_directory_path)),
+                ('size', models.BigIntegerField(default=0)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('touched_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DistributionList',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('address', models.EmailField(max_length=254, unique=True)),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MailboxChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('new', 'New'), ('read', 'Read'), ('unread', 'Unread'), ('deleted', 'Deleted')], max_length=16)),
+                ('email_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MailboxCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mailbox', models.CharField(choices=[('inbox', 'Inbox'), ('sent', 'Sent'), ('external', 'External')], max_length=16)),
+                ('total', models.BigIntegerField(default=0)),
+                ('unread', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MailboxState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mailbox_state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('last_seq', models.BigIntegerField(default=0)),
+                ('pruned_seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OutboundMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_address', models.EmailField(max_length=254)),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField(blank=True, default='')),
+                ('message_id', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('partial', 'Partially sent'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OutboundRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.EmailField(max_length=254)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('smtp_code', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PendingExpunge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RawMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid', models.BigIntegerField()),
+                ('segment', models.IntegerField()),
+                ('offset', models.BigIntegerField()),
+                ('length', models.BigIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('stored_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('received', models.BigIntegerField(default=0)),
+                ('sha256', models.CharField(blank=True, default='', max_length=64)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='recipient',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='imap_encoding',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='imap_section',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boundemailaccount',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boundemailaccount',
+            name='last_uid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='boundemailaccount',
+            name='sync_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='boundemailaccount',
+            name='sync_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boundemailaccount',
+            name='sync_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('syncing', 'Syncing'), ('idle', 'Idle'), ('error', 'Error')], default='pending', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='boundemailaccount',
+            name='uid_next',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boundemailaccount',
+            name='uid_validity',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='body_fetched',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='imap_body_parts',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='imap_flags_dirty',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='snippet',
+            field=models.CharField(blank=True, default='', max_length=160),
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='file',
+            field=models.FileField(blank=True, upload_to=mail.models.user_directory_path),
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='sent_at',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True, verbose_name='sent at'),
+        ),
+        migrations.AddConstraint(
+            model_name='email',
+            constraint=models.UniqueConstraint(fields=('external_account', 'external_uid'), name='unique_external_account_uid'),
+        ),
+        migrations.AddConstraint(
+            model_name='recipient',
+            constraint=models.UniqueConstraint(fields=('email', 'user'), name='unique_email_recipient'),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='email',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='mail.email'),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='rawmessage',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='raw_messages', to='mail.boundemailaccount'),
+        ),
+        migrations.AddField(
+            model_name='pendingexpunge',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_expunges', to='mail.boundemailaccount'),
+        ),
+        migrations.AddField(
+            model_name='outboundrecipient',
+            name='message',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='mail.outboundmessage'),
+        ),
+        migrations.AddField(
+            model_name='outboundmessage',
+            name='attachments',
+            field=models.ManyToManyField(blank=True, related_name='+', to='mail.attachment'),
+        ),
+        migrations.AddField(
+            model_name='outboundmessage',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbound_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='mailboxcounter',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_counters', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='mailboxchange',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_changes', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='distributionlist',
+            name='groups',
+            field=models.ManyToManyField(blank=True, related_name='distribution_lists', to='auth.group'),
+        ),
+        migrations.AddField(
+            model_name='distributionlist',
+            name='members',
+            field=models.ManyToManyField(blank=True, related_name='distribution_lists', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='attachments', to='mail.blob'),
+        ),
+        migrations.AddIndex(
+            model_name='rawmessage',
+            index=models.Index(fields=['segment', 'offset'], name='mail_rawmes_segment_d76a36_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='rawmessage',
+            constraint=models.UniqueConstraint(fields=('account', 'uid'), name='unique_raw_message'),
+        ),
+        migrations.AddConstraint(
+            model_name='pendingexpunge',
+            constraint=models.UniqueConstraint(fields=('account', 'uid'), name='unique_pending_expunge'),
+        ),
+        migrations.AddIndex(
+            model_name='outboundmessage',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='mail_outbou_status_f3733b_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailboxcounter',
+            constraint=models.UniqueConstraint(fields=('user', 'mailbox'), name='unique_mailbox_counter'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailboxchange',
+            constraint=models.UniqueConstraint(fields=('user', 'seq'), name='unique_mailbox_change_seq'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+BATCH_SIZE = 500
+
+
+def backfill_sent_at(apps, schema_editor):
+    # 早期版本发出的邮件没有 sent_at。按 id 顺序取它前面最近一封邮件的时间，保持原来的先后；
+    # 最前面的几封取第一封有时间的邮件，全都没有时间时取当前时间
+    Email = apps.get_model('mail', 'Email')
+    Recipient = apps.get_model('mail', 'Recipient')
+    if Email.objects.filter(sent_at__isnull=True).exists():
+        updates = defaultdict(list)
+        previous, head = None, []
+        for pk, sent_at in Email.objects.order_by('id').values_list('id', 'sent_at').iterator(
+                chunk_size=2000):
+            if sent_at is not None:
+                if head:
+                    updates[sent_at] += head
+                    head = []
+                previous = sent_at
+            elif previous is None:
+                head.append(pk)
+            else:
+                updates[previous].append(pk)
+        if head:
+            updates[django.utils.timezone.now()] += head
+        for sent_at, ids in updates.items():
+            for start in range(0, len(ids), BATCH_SIZE):
+                Email.objects.filter(id__in=ids[start:start + BATCH_SIZE]).update(sent_at=sent_at)
+    # 收件记录上的副本与邮件一致
+    Recipient.objects.filter(sent_at__isnull=True).update(sent_at=Subquery(
+        Email.objects.filter(pk=OuterRef('email_id')).values('sent_at')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0003_series_models'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_sent_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='email',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='sent at'),
+        ),
+        migrations.AlterField(
+            model_name='recipient',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
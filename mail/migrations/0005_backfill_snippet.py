@@ -0,0 +1,31 @@
+from django.db import migrations
+
+from mail.utils import make_snippet
+
+BATCH_SIZE = 500
+
+
+def backfill_snippet(apps, schema_editor):
+    # snippet 字段加入之前的邮件都是空预览，按 id 分批从正文生成；正文为空的不用处理
+    Email = apps.get_model('mail', 'Email')
+    pending = Email.objects.filter(snippet='').exclude(body='').order_by('id')
+    last = 0
+    while True:
+        batch = list(pending.filter(id__gt=last).only('id', 'body')[:BATCH_SIZE])
+        if not batch:
+            break
+        for email in batch:
+            email.snippet = make_snippet(email.body)
+        Email.objects.bulk_update(batch, ['snippet'])
+        last = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0004_sent_at_not_null'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_snippet, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# 邮件列表的组合索引：列表按 (sent_at, id) 降序分页，索引顺序即结果顺序。
+# 被组合索引前缀或唯一约束覆盖的单列索引一并删除。放在数据回填之后，建索引只做一次
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0005_backfill_snippet'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='email',
+            name='external_uid',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='from_user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_emails', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='recipient',
+            name='email',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='recipient_states', to='mail.email'),
+        ),
+        migrations.AlterField(
+            model_name='recipient',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='mailbox_entries', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['from_user', 'sent_at', 'id'], name='mail_email_from_us_fd7abc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['from_user', 'is_internal', 'sent_at', 'id'], name='mail_email_from_us_19ec17_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipient',
+            index=models.Index(fields=['user', 'folder', 'sent_at', 'email'], name='mail_email__user_id_58557b_idx'),
+        ),
+    ]
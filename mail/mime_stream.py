@@ -0,0 +1,218 @@
+import binascii
+import hashlib
+import tempfile
+from email.parser import BytesHeaderParser
+
+from mail.utils import parse_date_header, safe_decode_header
+
+# 单行最长读取长度，防止没有换行的二进制内容一次读入内存
+LINE_LIMIT = 64 * 1024
+# 附件小于该值时留在内存，否则落到临时文件
+SPOOL_SIZE = 1024 * 1024
+
+
+class HashingSpool(tempfile.SpooledTemporaryFile):
+    # 写入的同时计算 SHA-256，供内容寻址存储直接使用
+    def __init__(self, max_size=SPOOL_SIZE):
+        super().__init__(max_size=max_size)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return super().write(data)
+
+
+class Base64Decoder:
+    def __init__(self):
+        self.pending = b""
+
+    def feed(self, data):
+        data = self.pending + b"".join(data.split())
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        return binascii.a2b_base64(data[:usable]) if usable else b""
+
+    def flush(self):
+        pending, self.pending = self.pending, b""
+        if not pending:
+            return b""
+        try:
+            return binascii.a2b_base64(pending + b"=" * (-len(pending) % 4))
+        except binascii.Error:
+            return b""
+
+
+class QuotedPrintableDecoder:
+    # quoted-printable 按行解码；以 "=" 结尾的行是软换行，随后的换行符丢弃
+    def __init__(self):
+        self.soft = False
+
+    def feed(self, data):
+        if data in (b"\r\n", b"\n"):
+            if self.soft:
+                self.soft = False
+                return b""
+            return data
+        self.soft = data.endswith(b"=")
+        return binascii.a2b_qp(data)
+
+    def flush(self):
+        return b""
+
+
+class IdentityDecoder:
+    def feed(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+def decoder_for(encoding):
+    encoding = (encoding or "").strip().lower()
+    if encoding == "base64":
+        return Base64Decoder()
+    if encoding == "quoted-printable":
+        return QuotedPrintableDecoder()
+    return IdentityDecoder()
+
+
+def _decoder(headers):
+    return decoder_for(headers.get("Content-Transfer-Encoding"))
+
+
+def decode_chunks(chunks, encoding):
+    # 对任意切分的编码数据流逐块解码（按行切分以保证 quoted-printable 正确）
+    decoder = decoder_for(encoding)
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(b"\n") else b""
+        for line in lines:
+            content = line.rstrip(b"\r\n")
+            yield decoder.feed(content)
+            yield decoder.feed(line[len(content):])
+    if pending:
+        yield decoder.feed(pending)
+    yield decoder.flush()
+
+
+class StreamingMessage:
+    # 逐行解析 RFC822 数据流：正文收集为文本，附件边解码边写入临时文件，
+    # 内存占用与附件大小无关
+    def __init__(self, fp):
+        self.fp = fp
+        self.body = []
+        self.attachments = []
+
+    def _readline(self):
+        return self.fp.readline(LINE_LIMIT)
+
+    def _read_headers(self):
+        lines = []
+        while True:
+            line = self._readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+            lines.append(line)
+        return BytesHeaderParser().parsebytes(b"".join(lines))
+
+    @staticmethod
+    def _boundary_match(line, boundaries):
+        # 返回 (boundary, 是否结束边界)；不是边界行返回 None
+        if not line.startswith(b"--"):
+            return None
+        stripped = line.rstrip(b"\r\n \t")
+        for boundary in reversed(boundaries):
+            marker = b"--" + boundary
+            if stripped == marker:
+                return boundary, False
+            if stripped == marker + b"--":
+                return boundary, True
+        return None
+
+    def _read_part_body(self, boundaries, write):
+        # 读到下一个边界为止；边界前的换行属于边界，需要延迟一行写出
+        decoder = None if write is None else write[1]
+        sink = None if write is None else write[0]
+        held = b""
+        line_start = True
+        while True:
+            line = self._readline()
+            if not line:
+                match = None
+                break
+            match = self._boundary_match(line, boundaries) if line_start else None
+            if match:
+                break
+            line_start = line.endswith(b"\n")
+            if sink is not None:
+                if held:
+                    sink(decoder.feed(held))
+                if line.endswith(b"\r\n"):
+                    body, held = line[:-2], b"\r\n"
+                elif line.endswith(b"\n"):
+                    body, held = line[:-1], b"\n"
+                else:
+                    body, held = line, b""
+                sink(decoder.feed(body))
+        if sink is not None:
+            sink(decoder.flush())
+        return match
+
+    def _parse_entity(self, headers, boundaries):
+        if headers.get_content_maintype() == "multipart":
+            boundary = headers.get_param("boundary")
+            if not boundary:
+                return self._read_part_body(boundaries, None)
+            inner = boundaries + [boundary.encode("latin-1", "ignore")]
+            # 跳过 preamble
+            match = self._read_part_body(inner, None)
+            while match and match[0] == inner[-1] and not match[1]:
+                match = self._parse_entity(self._read_headers(), inner)
+            if match and match[0] == inner[-1]:
+                # 跳过 epilogue，直到外层边界
+                return self._read_part_body(boundaries, None)
+            return match
+
+        disposition = str(headers.get("Content-Disposition"))
+        if "attachment" in disposition:
+            filename = headers.get_filename()
+            filename = safe_decode_header(filename) if filename else "unknown"
+            spool = HashingSpool()
+            match = self._read_part_body(boundaries, (spool.write, _decoder(headers)))
+            spool.seek(0)
+            self.attachments.append((filename, spool))
+            return match
+
+        if headers.get_content_type() == "text/plain":
+            chunks = []
+            match = self._read_part_body(boundaries, (chunks.append, _decoder(headers)))
+            charset = headers.get_content_charset() or "utf-8"
+            raw = b"".join(chunks)
+            try:
+                self.body.append(raw.decode(charset, errors="ignore"))
+            except LookupError:
+                self.body.append(raw.decode("utf-8", errors="ignore"))
+            return match
+
+        return self._read_part_body(boundaries, None)
+
+    def parse(self):
+        headers = self._read_headers()
+        self._parse_entity(headers, [])
+        return headers
+
+
+def parse_message_stream(fp):
+    # 与 imap_sync.parse_message 返回相同结构，附件为已定位到开头的临时文件
+    parser = StreamingMessage(fp)
+    headers = parser.parse()
+
+    date_ = parse_date_header(headers.get("Date"))
+
+    return (safe_decode_header(headers["Subject"]),
+            safe_decode_header(headers.get("From")),
+            date_, "".join(parser.body), parser.attachments)
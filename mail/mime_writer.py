@@ -0,0 +1,143 @@
+import base64
+import logging
+import mimetypes
+import os
+import smtplib
+import uuid
+from email.message import EmailMessage
+from email.policy import SMTP
+from email.utils import formatdate, make_msgid
+
+logger = logging.getLogger(__name__)
+
+# 每次读取 57 的整数倍字节，base64 编码后正好是完整的 76 字符行
+READ_SIZE = 57 * 1024
+
+
+def _headers(message):
+    return b"".join(SMTP.fold_binary(name, value) for name, value in message.items())
+
+
+def _set_text(part, body):
+    # 非 ASCII 正文用 quoted-printable：整封邮件保持 7bit，不依赖服务器支持 8BITMIME
+    body = body or ""
+    part.set_content(body, cte=None if body.isascii() else "quoted-printable")
+
+
+def _text_part(body):
+    part = EmailMessage(policy=SMTP)
+    _set_text(part, body)
+    del part["MIME-Version"]
+    return part.as_bytes()
+
+
+def _attachment_headers(file_path, filename):
+    mime_type, _ = mimetypes.guess_type(filename or file_path)
+    part = EmailMessage(policy=SMTP)
+    part["Content-Type"] = mime_type or "application/octet-stream"
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=filename)
+    return _headers(part) + b"\r\n"
+
+
+def _base64_file(file_path):
+    with open(file_path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return
+            yield base64.encodebytes(data).replace(b"\n", b"\r\n")
+
+
+def compose(from_addr, to, subject, body, attachments=None, message_id=None):
+    # 逐块生成 RFC 5322 邮件；附件边读边 base64 编码，内存占用与附件大小无关
+    head = EmailMessage(policy=SMTP)
+    head["Subject"] = subject or ""
+    head["From"] = from_addr
+    head["To"] = to
+    head["Date"] = formatdate(localtime=True)
+    head["Message-ID"] = message_id or make_msgid(domain="ymail.com")
+    head["MIME-Version"] = "1.0"
+
+    existing = []
+    for file_path, filename in attachments or []:
+        if os.path.exists(file_path):
+            existing.append((file_path, filename))
+        else:
+            logger.warning("Attachment file not found: %s", file_path)
+    if not existing:
+        text = EmailMessage(policy=SMTP)
+        for name, value in head.items():
+            if name != "MIME-Version":
+                text[name] = value
+        _set_text(text, body)
+        yield text.as_bytes()
+        return
+
+    boundary = f"=_{uuid.uuid4().hex}"
+    head["Content-Type"] = f'multipart/mixed; boundary="{boundary}"'
+    delimiter = f"--{boundary}\r\n".encode()
+    yield _headers(head) + b"\r\n" + delimiter + _text_part(body)
+    for file_path, filename in existing:
+        yield b"\r\n" + delimiter + _attachment_headers(file_path, filename)
+        yield from _base64_file(file_path)
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def _dot_stuff(chunk, at_line_start):
+    stuffed = chunk.replace(b"\n.", b"\n..")
+    if at_line_start and stuffed.startswith(b"."):
+        stuffed = b"." + stuffed
+    return stuffed
+
+
+def _rset(smtp):
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def send_streaming(smtp, from_addr, to_addrs, chunks):
+    # 与 smtplib.SMTP.sendmail 流程一致，但 DATA 阶段逐块写入 socket；
+    # 返回被拒绝的收件人 {address: (code, resp)}
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(from_addr)
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            _rset(smtp)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for address in to_addrs:
+        code, resp = smtp.rcpt(address)
+        if code not in (250, 251):
+            refused[address] = (code, resp)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        _rset(smtp)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    smtp.putcmd("data")
+    code, resp = smtp.getreply()
+    if code != 354:
+        _rset(smtp)
+        raise smtplib.SMTPDataError(code, resp)
+    at_line_start = True
+    for chunk in chunks:
+        if chunk:
+            smtp.send(_dot_stuff(chunk, at_line_start))
+            at_line_start = chunk.endswith(b"\n")
+    smtp.send(b".\r\n" if at_line_start else b"\r\n.\r\n")
+    code, resp = smtp.getreply()
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            _rset(smtp)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
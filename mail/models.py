@@ -1,7 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
+from django.utils import timezone
 from datetime import datetime
+import uuid
+
+from mail.utils import make_snippet
 
 
 # 用户模型
@@ -12,29 +16,127 @@ class User(AbstractUser):
         return self.email
 
 
+# 分发列表：发往 address 的邮件展开给全部成员，包括所属组中的用户
+class DistributionList(models.Model):
+    name = models.CharField(max_length=255)
+    address = models.EmailField(unique=True)
+    members = models.ManyToManyField(
+        User, blank=True, related_name='distribution_lists')
+    groups = models.ManyToManyField(
+        'auth.Group', blank=True, related_name='distribution_lists')
+    # 成员变化时递增，作为展开结果缓存 key 的一部分
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.address
+
+
 # 邮件模型
 class Email(models.Model):
+    # 单列索引由下面的 (from_user, ...) 组合索引的前缀代替
     from_user = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_emails')
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_emails',
+        db_index=False)
     recipients = models.ManyToManyField(
-        settings.AUTH_USER_MODEL, related_name='received_emails')
+        settings.AUTH_USER_MODEL, through='Recipient', related_name='received_emails')
     to_external = models.EmailField(null=True, blank=True)  # 外部收件人地址
     from_external = models.CharField(max_length=255, blank=True, null=True)
     subject = models.CharField(max_length=255)
     body = models.TextField()
+    snippet = models.CharField(max_length=160, blank=True, default='')
     is_internal = models.BooleanField(default=True)
-    sent_at = models.DateTimeField("sent at", null=True, blank=True)
+    # 不允许为空：列表按 (sent_at, id) 做游标分页，NULL 既无法编码为游标也匹配不到范围条件
+    sent_at = models.DateTimeField("sent at", default=timezone.now)
     is_read = models.BooleanField(default=False)
 
-    external_uid = models.CharField(
-        max_length=100, null=True, blank=True, db_index=True)
+    # 按 UID 查询总是带着账号，由 (external_account, external_uid) 唯一约束的索引覆盖
+    external_uid = models.CharField(max_length=100, null=True, blank=True)
     external_account = models.ForeignKey(
         'BoundEmailAccount', null=True, blank=True, on_delete=models.CASCADE)
+    # 仅同步信封时为 False，正文在首次查看时按 imap_body_parts 拉取
+    body_fetched = models.BooleanField(default=True)
+    imap_body_parts = models.JSONField(null=True, blank=True)
+    # 外部邮件的 is_read 尚未同步到 IMAP 服务器（\Seen），由 sync_imap 批量推送
+    imap_flags_dirty = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            # 同一外部账号的 UID 只能入库一次，由数据库拒绝重复
+            models.UniqueConstraint(
+                fields=['external_account', 'external_uid'],
+                name='unique_external_account_uid'),
+        ]
+        # 列表按 (sent_at, id) 降序分页，索引顺序即结果顺序，不需要排序
+        indexes = [
+            # 已发送：from_user = ?
+            models.Index(fields=['from_user', 'sent_at', 'id']),
+            # 外部邮件：from_user = ? AND is_internal = false
+            models.Index(fields=['from_user', 'is_internal', 'sent_at', 'id']),
+        ]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'body' in update_fields:
+            self.snippet = make_snippet(self.body)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'snippet'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.from_user} -> {self.to_user or self.to_external}'
 
 
+# 收件人关联表：每个收件人各自的已读状态和文件夹
+class Recipient(models.Model):
+    FOLDER_INBOX = 'inbox'
+    FOLDER_ARCHIVE = 'archive'
+    FOLDER_TRASH = 'trash'
+    FOLDER_CHOICES = [
+        (FOLDER_INBOX, 'Inbox'),
+        (FOLDER_ARCHIVE, 'Archive'),
+        (FOLDER_TRASH, 'Trash'),
+    ]
+
+    # 两个外键的单列索引分别由 (email, user) 唯一约束和 (user, folder, ...) 索引的前缀代替
+    email = models.ForeignKey(
+        Email, on_delete=models.CASCADE, related_name='recipient_states', db_index=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='mailbox_entries',
+        db_index=False)
+    is_read = models.BooleanField(default=False)
+    folder = models.CharField(max_length=16, choices=FOLDER_CHOICES, default=FOLDER_INBOX)
+    # 邮件 sent_at 的副本，创建收件记录时写入：收件箱只读这张表的索引就能按时间分页
+    sent_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # 沿用自动生成的多对多表名
+        db_table = 'mail_email_recipients'
+        constraints = [
+            models.UniqueConstraint(fields=['email', 'user'], name='unique_email_recipient'),
+        ]
+        # 收件箱按 (sent_at, email) 降序分页；索引不含 is_read：批量标记已读时无需改写索引
+        indexes = [models.Index(fields=['user', 'folder', 'sent_at', 'email'])]
+
+
+def blob_directory_path(instance, filename):
+    digest = instance.sha256
+    return f'blobs/{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+# 内容寻址存储：相同内容的附件共享同一个文件，ref_count 为引用它的附件数
+class Blob(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=blob_directory_path, blank=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # 最近一次被复用或释放的时间，GC 只回收超过宽限期的 blob
+    touched_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.sha256
+
+
 def user_directory_path(instance, filename):
     user = instance.email.from_user
     today = datetime.today()
@@ -45,15 +147,60 @@ def user_directory_path(instance, filename):
 class Attachment(models.Model):
     email = models.ForeignKey(
         Email, related_name='attachments', on_delete=models.CASCADE)
-    file = models.FileField(upload_to=user_directory_path)
+    file = models.FileField(upload_to=user_directory_path, blank=True)
+    # 有 blob 时 file 指向 blob 的文件，转发附件只复制元数据
+    blob = models.ForeignKey(
+        Blob, null=True, blank=True, on_delete=models.PROTECT, related_name='attachments')
     filename = models.CharField(max_length=255, default="")
     uploaded_at = models.DateTimeField("upload at", auto_now_add=True)
+    # 外部邮件的占位附件：file 为空，下载时按 IMAP section 拉取
+    imap_section = models.CharField(max_length=64, blank=True, default="")
+    imap_encoding = models.CharField(max_length=32, blank=True, default="")
+    size = models.BigIntegerField(default=0)
+
+    @property
+    def is_placeholder(self):
+        return not self.file and bool(self.imap_section)
 
     def __str__(self):
         return self.filename
 
 
+# 分片上传：客户端按偏移量逐片 PUT，中断后从 received 处续传，完成后转为 blob 附件
+class UploadSession(models.Model):
+    token = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    # 客户端声明的 SHA-256，完成时校验；可为空
+    sha256 = models.CharField(max_length=64, blank=True, default='')
+    # 正在写入分片的请求持有的锁，同一会话同时只接受一个 PUT
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def part_name(self):
+        return f'uploads/{self.token}.part'
+
+    def __str__(self):
+        return f'{self.filename} ({self.received}/{self.size})'
+
+
 class BoundEmailAccount(models.Model):
+    SYNC_PENDING = 'pending'
+    SYNC_RUNNING = 'syncing'
+    SYNC_IDLE = 'idle'
+    SYNC_ERROR = 'error'
+    SYNC_STATUS_CHOICES = [
+        (SYNC_PENDING, 'Pending'),
+        (SYNC_RUNNING, 'Syncing'),
+        (SYNC_IDLE, 'Idle'),
+        (SYNC_ERROR, 'Error'),
+    ]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     email_address = models.EmailField()
     smtp_server = models.CharField(max_length=255)
@@ -64,5 +211,168 @@ class BoundEmailAccount(models.Model):
     password_encrypted = models.TextField()
     added_at = models.DateTimeField(auto_now_add=True)
 
+    # 增量同步状态：只拉取 UID 大于 last_uid 的邮件
+    uid_validity = models.BigIntegerField(null=True, blank=True)
+    uid_next = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(default=0)
+    sync_status = models.CharField(
+        max_length=16, choices=SYNC_STATUS_CHOICES, default=SYNC_PENDING)
+    sync_started_at = models.DateTimeField(null=True, blank=True)
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    sync_error = models.TextField(blank=True, default='')
+
     class Meta:
         unique_together = ("user", "email_address")
+
+
+# 外部邮件发件箱：接口只负责入队，由 send_outbox worker 异步投递
+class OutboundMessage(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_PARTIAL = 'partial'  # 部分收件人永久失败
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_PARTIAL, 'Partially sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='outbound_messages')
+    from_address = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField(blank=True, default='')
+    attachments = models.ManyToManyField(Attachment, blank=True, related_name='+')
+    # 重试时沿用同一个 Message-ID，便于收件方去重
+    message_id = models.CharField(max_length=255)
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.from_address}: {self.subject} ({self.status})'
+
+
+class OutboundRecipient(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    message = models.ForeignKey(
+        OutboundMessage, on_delete=models.CASCADE, related_name='recipients')
+    address = models.EmailField()
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    smtp_code = models.IntegerField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.address} ({self.status})'
+
+
+# 每个用户邮箱的变更序列号；WebSocket 断线重连后按序列号增量同步
+class MailboxState(models.Model):
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name='mailbox_state')
+    last_seq = models.BigIntegerField(default=0)
+    # 已清理的最大序列号，客户端序列号小于它时只能全量刷新
+    pruned_seq = models.BigIntegerField(default=0)
+
+
+class MailboxChange(models.Model):
+    KIND_NEW = 'new'
+    KIND_READ = 'read'
+    KIND_UNREAD = 'unread'
+    KIND_DELETED = 'deleted'
+    KIND_CHOICES = [
+        (KIND_NEW, 'New'),
+        (KIND_READ, 'Read'),
+        (KIND_UNREAD, 'Unread'),
+        (KIND_DELETED, 'Deleted'),
+    ]
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='mailbox_changes')
+    seq = models.BigIntegerField()
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    # 不用外键：邮件删除后变更记录仍需保留
+    email_id = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'seq'], name='unique_mailbox_change_seq'),
+        ]
+
+
+# 每个用户各邮箱的邮件数和未读数，随发信、同步和已读状态增量更新，
+# reconcile_counters 定期按邮件表校正
+class MailboxCounter(models.Model):
+    MAILBOX_INBOX = 'inbox'
+    MAILBOX_SENT = 'sent'
+    MAILBOX_EXTERNAL = 'external'
+    MAILBOX_CHOICES = [
+        (MAILBOX_INBOX, 'Inbox'),
+        (MAILBOX_SENT, 'Sent'),
+        (MAILBOX_EXTERNAL, 'External'),
+    ]
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='mailbox_counters')
+    mailbox = models.CharField(max_length=16, choices=MAILBOX_CHOICES)
+    total = models.BigIntegerField(default=0)
+    unread = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'mailbox'], name='unique_mailbox_counter'),
+        ]
+
+
+# 原始邮件在段文件中的位置（见 mail/raw_store.py），按 (账号, UID) 索引
+class RawMessage(models.Model):
+    account = models.ForeignKey(
+        BoundEmailAccount, on_delete=models.CASCADE, related_name='raw_messages')
+    uid = models.BigIntegerField()
+    segment = models.IntegerField()
+    offset = models.BigIntegerField()
+    # 压缩后长度和原始长度
+    length = models.BigIntegerField()
+    size = models.BigIntegerField()
+    stored_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'uid'], name='unique_raw_message'),
+        ]
+        indexes = [models.Index(fields=['segment', 'offset'])]
+
+
+# 本地删除的外部邮件，等待 sync_imap 在服务器上标记 \Deleted 并 UID EXPUNGE
+class PendingExpunge(models.Model):
+    account = models.ForeignKey(
+        BoundEmailAccount, on_delete=models.CASCADE, related_name='pending_expunges')
+    uid = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'uid'], name='unique_pending_expunge'),
+        ]
@@ -0,0 +1,112 @@
+import asyncio
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from mail.models import User
+from mail.presence import online_users
+
+logger = logging.getLogger(__name__)
+
+# 每批查询的用户数和并发 group_send 数
+NOTIFY_BATCH_SIZE = 500
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mail-notify")
+
+
+class Coalescer:
+    # 窗口期内发给同一用户的同类事件合并为一条，count 为合并前的事件数。
+    # window 为 None 时每次读取 NOTIFY_COALESCE_WINDOW
+    def __init__(self, window=None):
+        self._window = window
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def window(self):
+        if self._window is not None:
+            return self._window
+        return getattr(settings, "NOTIFY_COALESCE_WINDOW", 1.0)
+
+    def add(self, user_ids, event):
+        with self._lock:
+            for user_id in user_ids:
+                self._pending.setdefault((user_id, event["type"]), []).append(event)
+            if self._timer is None and self.window > 0:
+                self._timer = threading.Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if self.window <= 0:
+            self._flush()
+
+    def flush(self):
+        # 在当前线程发送窗口中的事件：定时器是守护线程，一次性命令退出时来不及触发
+        with self._lock:
+            timer = self._timer
+        if timer is not None:
+            timer.cancel()
+        pending = self.take()
+        if pending:
+            _deliver(pending)
+
+    def take(self):
+        with self._lock:
+            pending, self._pending, self._timer = self._pending, {}, None
+        return pending
+
+    def _flush(self):
+        pending = self.take()
+        if pending:
+            _executor.submit(_deliver, pending)
+
+
+def _merge(events):
+    event = dict(events[-1])
+    if len(events) > 1:
+        event["count"] = sum(e.get("count", 1) for e in events)
+    return event
+
+
+async def _group_send_many(channel_layer, sends):
+    await asyncio.gather(*(channel_layer.group_send(group, event) for group, event in sends))
+
+
+def _deliver(pending):
+    try:
+        # 只给有 WebSocket 连接的用户推送
+        online = sorted(online_users({user_id for user_id, _ in pending}))
+        if not online:
+            return
+        usernames = {}
+        for start in range(0, len(online), NOTIFY_BATCH_SIZE):
+            usernames.update(User.objects.filter(
+                id__in=online[start:start + NOTIFY_BATCH_SIZE]).values_list("id", "username"))
+        sends = [(f"user_{usernames[user_id]}", _merge(events))  # 与 MailConsumer 中 group 名称对应
+                 for (user_id, _), events in pending.items() if user_id in usernames]
+        channel_layer = get_channel_layer()
+        for start in range(0, len(sends), NOTIFY_BATCH_SIZE):
+            async_to_sync(_group_send_many)(
+                channel_layer, sends[start:start + NOTIFY_BATCH_SIZE])
+    except Exception:
+        logger.exception("新邮件通知发送失败")
+    finally:
+        close_old_connections()
+
+
+coalescer = Coalescer()
+# 兜底：管理命令之外的短进程（shell、脚本）退出时也发送剩余事件
+atexit.register(coalescer.flush)
+
+
+def notify_users(user_ids, event):
+    # 事务提交后进入合并窗口，再由后台线程分批推送，不阻塞请求
+    user_ids = list(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: coalescer.add(user_ids, event))
@@ -0,0 +1,144 @@
+import logging
+import random
+import smtplib
+from datetime import timedelta
+from email.utils import make_msgid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from mail.mime_writer import compose, send_streaming
+from mail.models import OutboundMessage, OutboundRecipient
+from mail.smtp_pool import smtp_pool
+
+logger = logging.getLogger(__name__)
+
+# worker 崩溃后，超过该时间仍处于 sending 的消息会被重新领取
+OUTBOX_LOCK_TIMEOUT = timedelta(minutes=10)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue(user, recipients, subject, body, attachments=()):
+    with transaction.atomic():
+        message = OutboundMessage.objects.create(
+            user=user,
+            from_address=user.email,
+            subject=subject or "",
+            body=body or "",
+            message_id=make_msgid(domain="ymail.com"),
+        )
+        OutboundRecipient.objects.bulk_create([
+            OutboundRecipient(message=message, address=address) for address in recipients])
+        if attachments:
+            message.attachments.set(attachments)
+    return message
+
+
+def _claimable(now):
+    return (Q(status=OutboundMessage.STATUS_QUEUED, next_attempt_at__lte=now)
+            | Q(status=OutboundMessage.STATUS_SENDING,
+                locked_at__lt=now - OUTBOX_LOCK_TIMEOUT))
+
+
+def claim_batch(limit=50):
+    # 与 imap_sync.claim 相同，用条件 update 保证一条消息只被一个 worker 领取
+    now = timezone.now()
+    candidates = OutboundMessage.objects.filter(_claimable(now)).order_by(
+        "next_attempt_at").values_list("pk", flat=True)[:limit]
+    claimed = [pk for pk in candidates if OutboundMessage.objects.filter(
+        _claimable(now), pk=pk).update(
+        status=OutboundMessage.STATUS_SENDING, locked_at=now) == 1]
+    return list(OutboundMessage.objects.filter(pk__in=claimed).prefetch_related("attachments"))
+
+
+def retry_delay(attempts):
+    # 指数退避，带少量抖动避免同一时刻集中重试
+    base = _setting("OUTBOX_RETRY_BASE", 60)
+    delay = min(base * 2 ** max(attempts - 1, 0), _setting("OUTBOX_RETRY_MAX", 3600))
+    return timedelta(seconds=delay * random.uniform(1, 1.2))
+
+
+def open_smtp():
+    # 从连接池取连接，批量投递时不再为每封邮件握手
+    return smtp_pool.connection(
+        _setting("OUTBOX_SMTP_HOST", "localhost"), _setting("OUTBOX_SMTP_PORT", 25))
+
+
+def _send(message, pending):
+    # 返回 {address: (code, error)}，只包含被拒绝的收件人
+    chunks = compose(
+        message.from_address,
+        ", ".join(r.address for r in message.recipients.all()),
+        message.subject,
+        message.body,
+        [(att.file.path, att.filename) for att in message.attachments.all()],
+        message_id=message.message_id,
+    )
+    addresses = [r.address for r in pending]
+    try:
+        with open_smtp() as smtp:
+            return send_streaming(smtp, message.from_address, addresses, chunks)
+    except smtplib.SMTPRecipientsRefused as e:
+        return e.recipients
+    except smtplib.SMTPResponseException as e:
+        return {address: (e.smtp_code, e.smtp_error) for address in addresses}
+    except (smtplib.SMTPException, OSError) as e:
+        # 连接类错误没有响应码，全部按临时失败处理
+        return {address: (None, str(e)) for address in addresses}
+
+
+def _error_text(error):
+    if isinstance(error, bytes):
+        return error.decode(errors="ignore")
+    return str(error)
+
+
+def deliver(message):
+    pending = list(message.recipients.filter(status=OutboundRecipient.STATUS_PENDING))
+    refused = _send(message, pending) if pending else {}
+
+    now = timezone.now()
+    message.attempts += 1
+    max_attempts = _setting("OUTBOX_MAX_ATTEMPTS", 8)
+    for recipient in pending:
+        if recipient.address not in refused:
+            recipient.status = OutboundRecipient.STATUS_SENT
+            recipient.smtp_code = 250
+            recipient.error = ""
+            recipient.delivered_at = now
+            continue
+        code, error = refused[recipient.address]
+        recipient.smtp_code = code
+        recipient.error = _error_text(error)
+        # 5xx 为永久失败；4xx 和连接错误留待重试，超过次数后放弃
+        if (code or 0) >= 500 or message.attempts >= max_attempts:
+            recipient.status = OutboundRecipient.STATUS_FAILED
+    OutboundRecipient.objects.bulk_update(
+        pending, ["status", "smtp_code", "error", "delivered_at"])
+
+    statuses = set(message.recipients.values_list("status", flat=True))
+    message.locked_at = None
+    message.last_error = "; ".join(
+        f"{address}: {_error_text(error)}" for address, (_, error) in refused.items())
+    if OutboundRecipient.STATUS_PENDING in statuses:
+        message.status = OutboundMessage.STATUS_QUEUED
+        message.next_attempt_at = now + retry_delay(message.attempts)
+    else:
+        if statuses == {OutboundRecipient.STATUS_SENT}:
+            message.status = OutboundMessage.STATUS_SENT
+        elif OutboundRecipient.STATUS_SENT in statuses:
+            message.status = OutboundMessage.STATUS_PARTIAL
+        else:
+            message.status = OutboundMessage.STATUS_FAILED
+        message.finished_at = now
+    message.save(update_fields=[
+        "status", "attempts", "next_attempt_at", "locked_at", "last_error", "finished_at"])
+    if refused:
+        logger.warning("outbox %s attempt %s: %s", message.pk, message.attempts,
+                       message.last_error)
+    return message
@@ -0,0 +1,112 @@
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    # 按 (sent_at, id) 降序的游标分页，深页与首页代价相同（不使用 OFFSET）
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    # (查询字段, 实例属性)，均按降序排列；最后一个字段必须唯一
+    ordering = (('sent_at', 'sent_at'), ('id', 'id'))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor['r'])
+
+        if cursor:
+            queryset = queryset.filter(self._seek(cursor['v'], reverse))
+
+        order = [f if reverse else f'-{f}' for f, _ in self.ordering]
+        rows = list(queryset.order_by(*order)[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, cursor is not None
+
+        self.next_cursor = None
+        self.previous_cursor = None
+        if rows and has_next:
+            self.next_cursor = self.encode_cursor(rows[-1], reverse=False)
+        if rows and has_previous:
+            self.previous_cursor = self.encode_cursor(rows[0], reverse=True)
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self._link(self.next_cursor),
+            'previous': self._link(self.previous_cursor),
+            'results': data,
+        })
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def _seek(self, values, reverse):
+        # 构造 (a, b) < (x, y) 的等价条件；先给出 a <= x 以便走索引范围扫描
+        (first, _), (second, _) = self.ordering
+        x, y = values
+        if reverse:
+            return Q(**{f'{first}__gte': x}) & (
+                Q(**{f'{first}__gt': x}) | Q(**{f'{second}__gt': y}))
+        return Q(**{f'{first}__lte': x}) & (
+            Q(**{f'{first}__lt': x}) | Q(**{f'{second}__lt': y}))
+
+    def encode_cursor(self, obj, reverse):
+        values = []
+        for _, attr in self.ordering:
+            value = getattr(obj, attr)
+            if hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            values.append(value)
+        raw = json.dumps({'v': values, 'r': int(reverse)}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            cursor = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            first, second = cursor['v']
+            # 游标来自客户端：第一个值必须是时间，第二个必须是 id，否则过滤时才报错会变成 500
+            if not isinstance(first, str) or type(second) is not int:
+                raise ValueError
+            first = parse_datetime(first)
+            if first is None:
+                raise ValueError
+            return {'v': (first, second), 'r': bool(cursor.get('r'))}
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def _link(self, cursor):
+        url = self.request.build_absolute_uri()
+        if cursor is None:
+            return None
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+
+class InboxPagination(KeysetPagination):
+    # 收件箱按收件记录上的 sent_at 和 email_id 排序，与 (user, folder, sent_at, email) 索引一致。
+    # 查询需要把这两列 annotate 出来：条件和排序引用注解才会复用过滤收件人时的 JOIN
+    ordering = (('recipient_sent_at', 'recipient_sent_at'), ('recipient_email_id', 'id'))
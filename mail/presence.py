@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.cache import cache
+
+# 在线状态保存在共享缓存中：每个用户一个计数器，记录打开的 WebSocket 数量。
+# MailConsumer 定期刷新 TTL，进程异常退出时计数会在 TTL 后自动过期
+PRESENCE_TTL = getattr(settings, "PRESENCE_TTL", 120)
+# 一次 get_many 查询的用户数
+PRESENCE_BATCH_SIZE = 1000
+
+
+def _key(user_id):
+    return f"mail:presence:{user_id}"
+
+
+def mark_online(user_id):
+    key = _key(user_id)
+    if cache.add(key, 1, PRESENCE_TTL):
+        return
+    try:
+        cache.incr(key)
+    except ValueError:
+        # 刚好过期
+        cache.add(key, 1, PRESENCE_TTL)
+    cache.touch(key, PRESENCE_TTL)
+
+
+def mark_offline(user_id):
+    key = _key(user_id)
+    try:
+        if cache.decr(key) <= 0:
+            cache.delete(key)
+    except ValueError:
+        pass
+
+
+def refresh(user_id):
+    cache.touch(_key(user_id), PRESENCE_TTL)
+
+
+def online_users(user_ids):
+    # 返回其中在线的用户 id；每批一次 get_many（Redis 上为一次 MGET）
+    user_ids = list(user_ids)
+    online = set()
+    for start in range(0, len(user_ids), PRESENCE_BATCH_SIZE):
+        chunk = user_ids[start:start + PRESENCE_BATCH_SIZE]
+        found = cache.get_many([_key(user_id) for user_id in chunk])
+        online.update(user_id for user_id in chunk if (found.get(_key(user_id)) or 0) > 0)
+    return online
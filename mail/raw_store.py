@@ -0,0 +1,237 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from mail.models import RawMessage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 原始邮件（RFC822 源码）压缩后追加写入段文件，位置记录在 RawMessage 中。
+# 每条记录：头部（魔数、压缩方式、账号、UID、压缩后长度、原始长度、CRC32）+ 压缩数据，
+# 头部让段文件脱离数据库也能校验和遍历
+MAGIC = b"YMRW"
+_HEADER = struct.Struct(">4sBQQQQI")
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+
+# 段文件超过该大小后新建下一个段
+SEGMENT_SIZE = 256 * 1024 * 1024
+# 压缩结果超过该大小时落到临时文件
+SPOOL_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+# 每个进程保留的段文件映射数
+MAP_CACHE_SIZE = 16
+# 段文件最后写入后至少保留这么久：追加完成到索引提交之间，新记录还没有索引
+SEGMENT_GRACE = 3600
+
+_maps = OrderedDict()
+_maps_lock = threading.Lock()
+
+
+class RawStoreError(Exception):
+    pass
+
+
+def _directory():
+    return (getattr(settings, "RAW_MESSAGE_DIR", None)
+            or os.path.join(settings.MEDIA_ROOT, "raw_messages"))
+
+
+def _segment_path(segment):
+    return os.path.join(_directory(), f"{segment:08d}.seg")
+
+
+def _segments():
+    try:
+        names = os.listdir(_directory())
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-4]) for name in names
+                  if name.endswith(".seg") and name[:-4].isdigit())
+
+
+def _codec():
+    # 默认 zstd，没有安装 zstandard 时退回 zlib；两种格式的记录可以混在同一个段中
+    if getattr(settings, "RAW_MESSAGE_CODEC", "zstd") == "zstd" and zstandard is not None:
+        return CODEC_ZSTD
+    return CODEC_ZLIB
+
+
+def _compressor(codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6)
+
+
+def _decompress(codec, data, size):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RawStoreError("读取 zstd 压缩的原始邮件需要安装 zstandard")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    return zlib.decompress(data)
+
+
+def _source_chunks(source):
+    if isinstance(source, bytes):
+        yield source
+        return
+    source.seek(0)
+    while True:
+        data = source.read(READ_SIZE)
+        if not data:
+            return
+        yield data
+
+
+def _compress(source, codec):
+    # 在加锁之前压缩：返回 (临时文件, 压缩后长度, 原始长度, CRC32)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    compressor = _compressor(codec)
+    size = crc = 0
+    for chunk in _source_chunks(source):
+        size += len(chunk)
+        out = compressor.compress(chunk)
+        if out:
+            spool.write(out)
+            crc = zlib.crc32(out, crc)
+    out = compressor.flush()
+    spool.write(out)
+    crc = zlib.crc32(out, crc)
+    length = spool.tell()
+    spool.seek(0)
+    return spool, length, size, crc
+
+
+@contextmanager
+def _append_lock():
+    # 多个同步进程共用一个目录，追加和换段时持有文件锁
+    os.makedirs(_directory(), exist_ok=True)
+    with open(os.path.join(_directory(), ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def append_messages(account, messages):
+    # messages: [(uid, source)]，source 为 bytes 或文件对象；返回未保存的 RawMessage，
+    # 由调用方在写邮件的事务中 bulk_create。写入后 fsync，索引只指向已落盘的记录
+    if not messages:
+        return []
+    codec = _codec()
+    compressed = [(uid, *_compress(source, codec)) for uid, source in messages]
+    entries = []
+    try:
+        with _append_lock():
+            segments = _segments()
+            segment = segments[-1] if segments else 1
+            f = open(_segment_path(segment), "ab")
+            try:
+                for uid, spool, length, size, crc in compressed:
+                    if f.tell() >= SEGMENT_SIZE:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        f.close()
+                        segment += 1
+                        f = open(_segment_path(segment), "ab")
+                    offset = f.tell()
+                    f.write(_HEADER.pack(MAGIC, codec, account.pk, uid, length, size, crc))
+                    while True:
+                        data = spool.read(READ_SIZE)
+                        if not data:
+                            break
+                        f.write(data)
+                    entries.append(RawMessage(account=account, uid=uid, segment=segment,
+                                              offset=offset, length=length, size=size))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+    finally:
+        for _, spool, *_ in compressed:
+            spool.close()
+    return entries
+
+
+def _map(segment, end):
+    # 段文件只追加，缓存的映射比需要的位置短时重新映射
+    with _maps_lock:
+        mapped = _maps.pop(segment, None)
+    if mapped is None or len(mapped) < end:
+        try:
+            with open(_segment_path(segment), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            raise RawStoreError(f"段文件 {segment} 不存在或为空")
+        if len(mapped) < end:
+            raise RawStoreError(f"段文件 {segment} 被截断")
+    with _maps_lock:
+        _maps[segment] = mapped
+        while len(_maps) > MAP_CACHE_SIZE:
+            _maps.popitem(last=False)
+    return mapped
+
+
+def read_raw(entry):
+    # 按索引从映射中取出一条记录，校验头部与 CRC 后解压
+    start = entry.offset + _HEADER.size
+    mapped = _map(entry.segment, start + entry.length)
+    magic, codec, account_id, uid, length, size, crc = _HEADER.unpack_from(mapped, entry.offset)
+    if magic != MAGIC or (account_id, uid, length) != (entry.account_id, entry.uid, entry.length):
+        raise RawStoreError(f"原始邮件索引与段文件不一致: {entry.account_id}/{entry.uid}")
+    payload = mapped[start:start + length]
+    if zlib.crc32(payload) != crc:
+        raise RawStoreError(f"原始邮件校验失败: {entry.account_id}/{entry.uid}")
+    return _decompress(codec, payload, size)
+
+
+def get_raw(account, uid):
+    entry = RawMessage.objects.filter(account=account, uid=uid).first()
+    return read_raw(entry) if entry is not None else None
+
+
+def replay(entries=None):
+    # 按段文件中的顺序遍历，生成 (RawMessage, 原始邮件)；读取基本是顺序 I/O
+    entries = RawMessage.objects.all() if entries is None else entries
+    segment = None
+    for entry in entries.order_by("segment", "offset").iterator(chunk_size=2000):
+        if entry.segment != segment:
+            segment = entry.segment
+            mapped = _map(segment, entry.offset + _HEADER.size + entry.length)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+        yield entry, read_raw(entry)
+
+
+def drop_dead_segments(grace=SEGMENT_GRACE):
+    # 删除已没有任何索引指向的段文件（当前追加的段除外），返回删除的数量。
+    # 段内部分记录失效（邮件被删除、UIDVALIDITY 变化）造成的空间不回收
+    cutoff = time.time() - grace
+    with _append_lock():
+        segments = _segments()
+        live = set(RawMessage.objects.values_list("segment", flat=True).distinct())
+        dead = [segment for segment in segments[:-1] if segment not in live
+                and os.path.getmtime(_segment_path(segment)) < cutoff]
+        for segment in dead:
+            with _maps_lock:
+                _maps.pop(segment, None)
+            os.remove(_segment_path(segment))
+    if dead:
+        logger.info("dropped %s raw message segments", len(dead))
+    return len(dead)
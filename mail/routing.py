@@ -1,6 +1,7 @@
 from django.urls import path
-from . import consumers
+from . import consumer
 
 websocket_urlpatterns = [
-    path("ws/mailbox/<str:username>/", consumers.MailConsumer.as_asgi()),
+    path("ws/mailbox/", consumer.MailConsumer.as_asgi()),
+    path("ws/mailbox/<str:username>/", consumer.MailConsumer.as_asgi()),
 ]
@@ -0,0 +1,214 @@
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+
+from mail.models import Attachment, Email
+
+# SQLite 使用 FTS5 虚拟表，Postgres 使用 tsvector + GIN 索引
+FTS_TABLE = 'mail_email_fts'
+PG_TABLE = 'mail_email_search'
+
+# 字段权重：subject, body, sender, attachments
+SQLITE_WEIGHTS = (10.0, 1.0, 5.0, 2.0)
+
+
+# 重建索引时每批处理的邮件数
+REBUILD_BATCH = 500
+
+# trigram 分词器只能用 MATCH 匹配不少于 3 个字符的词
+TRIGRAM_MIN = 3
+
+# 中日韩文字不以空格分词；Postgres 的 simple 配置会把整段当成一个词
+CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+
+def _index_exists(connection):
+    table = FTS_TABLE if connection.vendor == 'sqlite' else PG_TABLE
+    return table in connection.introspection.table_names()
+
+
+def _drop_stale_fts(connection):
+    # 早期版本用 unicode61 分词建表，中文整句是一个词无法按子串检索，删掉按 trigram 重建
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+        row = cursor.fetchone()
+        if row and 'trigram' not in row[0]:
+            cursor.execute(f"DROP TABLE {FTS_TABLE}")
+
+
+def _segment(text, query=False):
+    # Postgres：中日韩文字切成单字和相邻两字，建索引和查询用同样的切法；
+    # 查询时两字以上只用双字词，多个词 AND 起来近似子串匹配
+    def split(match):
+        run = match.group()
+        bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+        if query:
+            return ' ' + ' '.join(bigrams or [run]) + ' '
+        return ' ' + ' '.join(list(run) + bigrams) + ' '
+    return CJK_RE.sub(split, text)
+
+
+def create_search_index(using='default', **kwargs):
+    # post_migrate：首次建表时为已有邮件补建索引，之后由 index_emails 增量维护
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        _drop_stale_fts(connection)
+    if connection.vendor not in ('sqlite', 'postgresql') or _index_exists(connection):
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # trigram 按三字符切分，中文等不带空格的文字也能按子串检索
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                "subject, body, sender, attachments, tokenize = 'trigram')")
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {PG_TABLE} ("
+                f"email_id bigint PRIMARY KEY REFERENCES {Email._meta.db_table}(id) "
+                "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "document tsvector NOT NULL)")
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {PG_TABLE}_document_gin "
+                f"ON {PG_TABLE} USING GIN (document)")
+    rebuild_index(using)
+
+
+def rebuild_index(using='default', batch_size=REBUILD_BATCH):
+    # 按 id 分批重建全部文档，返回处理的邮件数；索引与邮件表不一致时可随时重跑
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid NOT IN "
+                f"(SELECT id FROM {Email._meta.db_table})")
+    total = last = 0
+    while True:
+        ids = list(Email.objects.using(using).filter(id__gt=last).order_by('id')
+                   .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        index_emails(ids, using=using)
+        total += len(ids)
+        last = ids[-1]
+
+
+def _documents(email_ids, using):
+    emails = Email.objects.using(using).filter(id__in=email_ids).select_related(
+        'from_user').only('id', 'subject', 'body', 'from_external',
+                          'from_user__username', 'from_user__email')
+    names = {}
+    for email_id, filename in Attachment.objects.using(using).filter(
+            email_id__in=email_ids).values_list('email_id', 'filename'):
+        names.setdefault(email_id, []).append(filename)
+
+    for email in emails:
+        sender = ' '.join(filter(None, [
+            email.from_external, email.from_user.username, email.from_user.email]))
+        yield (email.id, email.subject or '', email.body or '', sender,
+               ' '.join(names.get(email.id, [])))
+
+
+def index_emails(email_ids, using=None):
+    # 增量维护：新建邮件或新增附件后调用，重复调用会覆盖旧文档
+    email_ids = list(email_ids)
+    if not email_ids:
+        return
+    using = using or router.db_for_write(Email)
+    connection = connections[using]
+    rows = list(_documents(email_ids, using))
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            placeholders = ', '.join(['%s'] * len(email_ids))
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", email_ids)
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, subject, body, sender, attachments) "
+                "VALUES (%s, %s, %s, %s, %s)", rows)
+        elif connection.vendor == 'postgresql':
+            rows = [(row[0], *map(_segment, row[1:])) for row in rows]
+            cursor.executemany(
+                f"INSERT INTO {PG_TABLE} (email_id, document) VALUES (%s, "
+                "setweight(to_tsvector('simple', %s), 'A') || "
+                "setweight(to_tsvector('simple', %s), 'D') || "
+                "setweight(to_tsvector('simple', %s), 'B') || "
+                "setweight(to_tsvector('simple', %s), 'C')) "
+                "ON CONFLICT (email_id) DO UPDATE SET document = EXCLUDED.document",
+                rows)
+
+
+def remove_emails(email_ids, using=None):
+    email_ids = list(email_ids)
+    if not email_ids:
+        return
+    using = using or router.db_for_write(Email)
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        # Postgres 由外键级联删除
+        return
+    placeholders = ', '.join(['%s'] * len(email_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", email_ids)
+
+
+def _fts5_query(text):
+    # 返回 (MATCH 表达式, 短词列表)：每个词加引号防止注入 FTS 语法，trigram 下按子串匹配；
+    # 不足 3 个字符的词（如常见的两字中文词）MATCH 查不到，改为逐行比较
+    terms = text.split()
+    match = ' '.join('"{}"'.format(t.replace('"', '""')) for t in terms if len(t) >= TRIGRAM_MIN)
+    return match, [t for t in terms if len(t) < TRIGRAM_MIN]
+
+
+def search_emails(user, text, limit=20, offset=0, using=None):
+    # 返回按相关度排序的 [(email_id, score), ...]，仅包含用户收发的邮件
+    using = using or router.db_for_read(Email)
+    connection = connections[using]
+    email_table = Email._meta.db_table
+    through = Email.recipients.through._meta.db_table
+
+    if connection.vendor == 'sqlite':
+        match, short = _fts5_query(text)
+        if not match and not short:
+            return []
+        conditions, params = [], []
+        if match:
+            weights = ', '.join(str(w) for w in SQLITE_WEIGHTS)
+            score = f"bm25({FTS_TABLE}, {weights})"
+            conditions.append(f"{FTS_TABLE} MATCH %s")
+            params.append(match)
+        else:
+            # bm25 只能配合 MATCH 使用
+            score = "0.0"
+        for term in short:
+            conditions.append(
+                "instr(lower(subject || ' ' || body || ' ' || sender || ' ' || attachments), "
+                "lower(%s)) > 0")
+            params.append(term)
+        sql = (
+            f"SELECT rowid, {score} AS score FROM {FTS_TABLE} "
+            f"WHERE {' AND '.join(conditions)} AND rowid IN ("
+            f"SELECT id FROM {email_table} WHERE from_user_id = %s "
+            f"UNION ALL SELECT email_id FROM {through} WHERE user_id = %s) "
+            "ORDER BY score, rowid LIMIT %s OFFSET %s")
+        params += [user.id, user.id, limit, offset]
+    elif connection.vendor == 'postgresql':
+        sql = (
+            f"SELECT s.email_id, ts_rank_cd(s.document, q) AS score "
+            f"FROM {PG_TABLE} s, websearch_to_tsquery('simple', %s) q "
+            "WHERE s.document @@ q AND s.email_id IN ("
+            f"SELECT id FROM {email_table} WHERE from_user_id = %s "
+            f"UNION ALL SELECT email_id FROM {through} WHERE user_id = %s) "
+            "ORDER BY score DESC, s.email_id LIMIT %s OFFSET %s")
+        params = [_segment(text, query=True), user.id, user.id, limit, offset]
+    else:
+        ids = Email.objects.using(using).filter(
+            Q(from_user=user) | Q(recipients=user),
+            Q(subject__icontains=text) | Q(body__icontains=text),
+        ).order_by('-sent_at', '-id').values_list('id', flat=True).distinct()
+        return [(email_id, 0.0) for email_id in ids[offset:offset + limit]]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
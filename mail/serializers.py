@@ -1,17 +1,28 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate,get_user_model
-from mail.models import Attachment, Email
+from django.db.models import Count, IntegerField, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from mail.models import Attachment, Email, OutboundMessage, OutboundRecipient, Recipient
 
 User = get_user_model()
 
+# 详情页最多返回的收件人数，完整人数见 recipient_count
+RECIPIENT_PREVIEW_LIMIT = 100
+
+
+def _recipient_count():
+    counts = Recipient.objects.filter(email=OuterRef('pk')).order_by().values(
+        'email').annotate(c=Count('pk')).values('c')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
 
 class AttachmentSerializer(serializers.ModelSerializer):
     download_url = serializers.SerializerMethodField()
 
     class Meta:
         model = Attachment
-        fields = ['id', 'file', 'filename', 'uploaded_at', 'download_url']
+        fields = ['id', 'file', 'filename', 'size', 'uploaded_at', 'download_url']
         read_only_fields = ['id', 'uploaded_at']
 
     def get_download_url(self, obj):
@@ -49,20 +60,102 @@ class LoginSerializer(serializers.Serializer):
 
 class EmailSerializer(serializers.ModelSerializer):
     sender = serializers.ReadOnlyField(source='from_user.email')
+    # 只读取预取的前 RECIPIENT_PREVIEW_LIMIT 个收件人
     recipients = serializers.SlugRelatedField(
         many=True,
         slug_field='email', 
-        queryset=User.objects.all()
+        source='recipient_preview',
+        read_only=True
     )
+    recipient_count = serializers.IntegerField(read_only=True)
     attachments = AttachmentSerializer(many=True, read_only=True)
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = Email
-        fields = ['id', 'sender', 'recipients', 'subject',
-                  'body', 'sent_at', 'is_read', 'attachments']
+        fields = ['id', 'sender', 'recipients', 'recipient_count', 'subject',
+                  'body', 'body_fetched', 'sent_at', 'is_read', 'attachments']
+
+    def get_is_read(self, obj):
+        # 与列表页一致：当前用户是收件人时取自己收件记录的已读状态
+        is_read = getattr(obj, 'recipient_is_read', None)
+        return obj.is_read if is_read is None else is_read
+
+    @staticmethod
+    def setup_eager_loading(queryset, user=None):
+        # sender / recipients / attachments 一次性加载，避免逐行查询；
+        # 群发邮件的收件人可能上万，只取前 RECIPIENT_PREVIEW_LIMIT 个
+        recipients = User.objects.only('id', 'email')[:RECIPIENT_PREVIEW_LIMIT]
+        queryset = queryset.select_related('from_user').prefetch_related(
+            Prefetch('recipients', queryset=recipients, to_attr='recipient_preview'), 'attachments',
+        ).annotate(recipient_count=_recipient_count())
+        if user is not None:
+            own = Recipient.objects.filter(email=OuterRef('pk'), user=user)
+            queryset = queryset.annotate(recipient_is_read=Subquery(own.values('is_read')[:1]))
+        return queryset
 
     def create(self, validated_data):
         recipients = validated_data.pop('recipients')
         email = Email.objects.create(**validated_data)
-        email.recipients.set(recipients)
+        email.recipients.set(recipients, through_defaults={'sent_at': email.sent_at})
         return email
+
+
+class EmailSummarySerializer(serializers.ModelSerializer):
+    # 列表页使用的轻量表示：不含 body 和收件人列表，只带预先计算好的 snippet 和计数
+    sender = serializers.ReadOnlyField(source='from_user.email')
+    recipient_count = serializers.IntegerField(read_only=True)
+    attachment_count = serializers.IntegerField(read_only=True)
+    has_attachments = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
+    folder = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Email
+        fields = ['id', 'sender', 'recipient_count', 'subject', 'snippet',
+                  'sent_at', 'is_read', 'folder', 'attachment_count', 'has_attachments']
+
+    def get_has_attachments(self, obj):
+        return obj.attachment_count > 0
+
+    def get_is_read(self, obj):
+        # 当前用户是收件人时取自己收件记录的已读状态
+        is_read = getattr(obj, 'recipient_is_read', None)
+        return obj.is_read if is_read is None else is_read
+
+    def get_folder(self, obj):
+        return getattr(obj, 'recipient_folder', None)
+
+    @staticmethod
+    def setup_eager_loading(queryset, user=None):
+        # user 不为空时附带该用户自己的收件记录（已读、文件夹）；
+        # 收件箱查询已经 JOIN 了收件记录，由调用方直接标注
+        attachment_count = Attachment.objects.filter(
+            email=OuterRef('pk')).order_by().values('email').annotate(
+            c=Count('pk')).values('c')
+        queryset = queryset.select_related('from_user').only(
+            'id', 'from_user__email', 'subject', 'snippet', 'sent_at', 'is_read',
+        ).annotate(
+            recipient_count=_recipient_count(),
+            attachment_count=Coalesce(Subquery(attachment_count, output_field=IntegerField()), 0))
+        if user is not None:
+            own = Recipient.objects.filter(email=OuterRef('pk'), user=user)
+            queryset = queryset.annotate(
+                recipient_is_read=Subquery(own.values('is_read')[:1]),
+                recipient_folder=Subquery(own.values('folder')[:1]))
+        return queryset
+
+
+class OutboundRecipientSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OutboundRecipient
+        fields = ['address', 'status', 'smtp_code', 'error', 'delivered_at']
+
+
+class OutboundMessageSerializer(serializers.ModelSerializer):
+    recipients = OutboundRecipientSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = OutboundMessage
+        fields = ['id', 'subject', 'status', 'attempts', 'next_attempt_at',
+                  'last_error', 'created_at', 'finished_at', 'recipients']
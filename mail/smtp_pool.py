@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TLS_SSL = "ssl"
+TLS_STARTTLS = "starttls"
+TLS_NONE = "none"
+
+
+def tls_mode(use_ssl, port):
+    # 与原先的连接方式一致：465 端口直接 SSL，其余端口 STARTTLS
+    if use_ssl and port == 465:
+        return TLS_SSL
+    return TLS_STARTTLS
+
+
+class _Connection:
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.created_at = time.monotonic()
+        # last_used 为最近一次发信，决定空闲超时；last_checked 为最近一次确认连接可用
+        self.last_used = self.last_checked = self.created_at
+        self.messages = 0
+
+
+class SMTPPool:
+    # 按 (server, port, TLS 模式, 账号) 复用已登录的 SMTP 连接；
+    # 连接在使用期间只属于一个线程，归还后放回空闲列表
+    def __init__(self, max_idle=None, max_messages=None, noop_after=None, max_per_key=None):
+        self.max_idle = max_idle or getattr(settings, "SMTP_POOL_MAX_IDLE", 60)
+        self.max_messages = max_messages or getattr(settings, "SMTP_POOL_MAX_MESSAGES", 100)
+        self.noop_after = noop_after or getattr(settings, "SMTP_POOL_NOOP_AFTER", 15)
+        self.max_per_key = max_per_key or getattr(settings, "SMTP_POOL_MAX_PER_KEY", 4)
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ("hits", "misses", "noop_failures", "expired", "recycled", "discarded"), 0)
+
+    @staticmethod
+    def _key(host, port, mode, username, password):
+        # 密码参与 key，密码变更或绑定校验时不会误用旧会话
+        secret = hashlib.sha256((password or "").encode()).hexdigest() if username else ""
+        return host, int(port), mode, username or "", secret
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.smtp.close()
+
+    def _healthy(self, conn, now):
+        if now - conn.last_used > self.max_idle:
+            self._count("expired")
+            return False
+        if now - conn.last_checked > self.noop_after:
+            try:
+                code, _ = conn.smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                code = None
+            if code != 250:
+                self._count("noop_failures")
+                return False
+            conn.last_checked = now
+        return True
+
+    def _acquire(self, key):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle else None
+            if conn is None:
+                return None
+            if self._healthy(conn, time.monotonic()):
+                return conn
+            self._close(conn)
+
+    def _release(self, key, conn):
+        if conn.messages >= self.max_messages:
+            self._count("recycled")
+            self._close(conn)
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_key:
+                idle.append(conn)
+                return
+        self._close(conn)
+
+    @staticmethod
+    def _connect(host, port, mode, username, password, timeout):
+        logger.debug("SMTP pool: new connection to %s:%s (%s, %s)", host, port, mode, username)
+        if mode == TLS_SSL:
+            smtp = smtplib.SMTP_SSL(host, port, timeout=timeout)
+        else:
+            smtp = smtplib.SMTP(host, port, timeout=timeout)
+            if mode == TLS_STARTTLS:
+                smtp.starttls()
+        try:
+            if username:
+                smtp.login(username, password)
+        except Exception:
+            smtp.close()
+            raise
+        return _Connection(smtp)
+
+    @contextmanager
+    def connection(self, host, port, mode=TLS_NONE, username=None, password=None, timeout=60):
+        key = self._key(host, port, mode, username, password)
+        conn = self._acquire(key)
+        if conn is None:
+            self._count("misses")
+            conn = self._connect(host, port, mode, username, password, timeout)
+        else:
+            self._count("hits")
+        try:
+            yield conn.smtp
+        except smtplib.SMTPServerDisconnected:
+            self._count("discarded")
+            conn.smtp.close()
+            raise
+        except smtplib.SMTPException:
+            # 收件人被拒等协议错误后连接仍可用，RSET 后归还。
+            # SMTPException 是 OSError 的子类，必须先于 OSError 处理
+            try:
+                conn.smtp.rset()
+            except (smtplib.SMTPException, OSError):
+                self._count("discarded")
+                conn.smtp.close()
+            else:
+                self._release(key, conn)
+            raise
+        except OSError:
+            self._count("discarded")
+            conn.smtp.close()
+            raise
+        except BaseException:
+            self._count("discarded")
+            self._close(conn)
+            raise
+        else:
+            conn.messages += 1
+            conn.last_used = conn.last_checked = time.monotonic()
+            self._release(key, conn)
+
+    def reap(self):
+        # 关闭超时连接，对其余空闲连接发送 NOOP 保活；适合在 worker 空闲时调用
+        now = time.monotonic()
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for key, conns in idle.items():
+            for conn in conns:
+                if self._healthy(conn, now):
+                    self._release(key, conn)
+                else:
+                    self._close(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = sum(len(conns) for conns in self._idle.values())
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
+
+
+smtp_pool = SMTPPool()
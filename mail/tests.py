@@ -1,3 +1,1984 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import smtplib
+import socketserver
+import tempfile
+import threading
+import time
+from collections import Counter
+import unittest
+from datetime import timedelta
+from email import message_from_bytes, policy as email_policy
+from email.message import EmailMessage
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from django.contrib.auth.models import Group
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from mail import databases, mime_writer, presence, raw_store, search, uploads
+from mail.blobs import add_refs, collect_garbage, store_blob
+from mail.changes import changes_since, force_resync, prune_changes, record_changes, serialize_changes
+from mail.consumer import MailConsumer
+from mail.counters import get_counters, reconcile_counters
+from mail.downloads import parse_range
+from mail.fanout import deliver_internal, expand_list, resolve_recipients
+from mail.imap_idle import IdleClient, watch_account
+from mail.imap_response import body_parts, parse_fetch
+from mail.imap_sync import (
+    _build_message, _existing_uids, _fetch_batches, bulk_store, check_uid_validity, reparse_raw,
+    store_messages, sync_account)
+from mail.notify import Coalescer, _deliver
+from mail.outbox import claim_batch, deliver
+from mail.smtp_pool import SMTPPool
+from mail.ws_auth import JWTAuthMiddleware
+from mail.models import (
+    Attachment, Blob, BoundEmailAccount, DistributionList, Email, MailboxChange, MailboxState, OutboundMessage,
+    PendingExpunge, RawMessage, Recipient, UploadSession, User)
+from mail.utils import encrypt
+from mail.versions import PAGE_CACHE_ALIAS
+
+
+MEDIA_ROOT = tempfile.mkdtemp()
+# 测试环境没有 Redis：缓存和通道层换成进程内实现
+LOCAL_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'},
+    'mailbox_pages': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                      'LOCATION': 'tests-pages'},
+}
+LOCAL_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def make_raw(uid, attachment=b''):
+    message = EmailMessage()
+    message['Subject'] = f'msg {uid}'
+    message['From'] = 'x@ext.com'
+    message['Date'] = 'Mon, 20 Nov 2023 10:00:00 +0000'
+    message.set_content(f'hello body {uid}\n')
+    if attachment:
+        message.add_attachment(attachment, maintype='application', subtype='pdf',
+                               filename=f'f{uid}.pdf')
+    return message.as_bytes()
+
+
+def section_body(raw, section):
+    # BODY[section] 返回的是该部分未解码的内容；空 section 为整封邮件
+    if not section:
+        return raw
+    part = message_from_bytes(raw)
+    for index in section.split('.'):
+        part = part.get_payload()[int(index) - 1]
+    return part.get_payload().encode()
+
+
+def make_multipart_raw():
+    # multipart/mixed[multipart/alternative[text/plain, text/html], application/pdf]，
+    # 与 MULTIPART_STRUCTURE 对应：正文 1.1，附件 2
+    message = EmailMessage()
+    message['Subject'] = '季度报告'
+    message['From'] = 'Bob <bob@ext.com>'
+    message['Date'] = 'Mon, 20 Nov 2023 10:00:00 +0000'
+    message.set_content('第三季度的报告见附件。\n', cte='quoted-printable')
+    message.add_alternative('<p>第三季度的报告见附件。</p>', subtype='html', cte='quoted-printable')
+    message.add_attachment(PDF_DATA, maintype='application', subtype='pdf', filename='报告.pdf')
+    return message.as_bytes()
+
+
+PDF_DATA = b'%PDF-1.4 ' + bytes(range(256)) * 4
+SUBJECT_WORD = '=?utf-8?b?' + base64.b64encode('季度报告'.encode()).decode() + '?='
+# 服务器对 make_multipart_raw() 返回的 ENVELOPE 和 BODYSTRUCTURE
+MULTIPART_STRUCTURE = (
+    f'ENVELOPE ("Mon, 20 Nov 2023 10:00:00 +0000" "{SUBJECT_WORD}" '
+    '(("Bob" NIL "bob" "ext.com")) (("Bob" NIL "bob" "ext.com")) (("Bob" NIL "bob" "ext.com")) '
+    '((NIL NIL "alice" "example.com")) NIL NIL NIL "<q3@ext.com>") '
+    'BODYSTRUCTURE ((("text" "plain" ("charset" "utf-8") NIL NIL "quoted-printable" 120 2 NIL NIL NIL NIL)'
+    '("text" "html" ("charset" "utf-8") NIL NIL "quoted-printable" 160 1 NIL NIL NIL NIL) '
+    '"alternative" ("boundary" "===b1") NIL NIL NIL)'
+    '("application" "pdf" NIL NIL NIL "base64" 1400 NIL '
+    '("attachment" ("filename*" "utf-8\'\'%E6%8A%A5%E5%91%8A.pdf")) NIL NIL) '
+    '"mixed" ("boundary" "===b0") NIL NIL NIL)')
+
+
+class FakeIMAP:
+    # 只实现同步用到的 UID 命令；calls 记录每条命令供断言
+    capabilities = ('IMAP4REV1', 'UIDPLUS')
+
+    def __init__(self, messages, validity=7, structures=None):
+        self.messages = messages
+        self.validity = validity
+        # uid -> ENVELOPE 和 BODYSTRUCTURE 的响应片段，信封模式同步用
+        self.structures = structures or {}
+        self.calls = []
+
+    def login(self, *args):
+        pass
+
+    def logout(self):
+        pass
+
+    def select(self, mailbox, readonly=False):
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def response(self, name):
+        if name == 'UIDVALIDITY':
+            return name, [str(self.validity).encode()]
+        return name, [str(max(self.messages, default=0) + 1).encode()]
+
+    def _uids(self, spec):
+        top = max(self.messages, default=0)
+        uids = set()
+        for part in spec.split(','):
+            if ':' not in part:
+                uids.add(int(part))
+                continue
+            start, end = part.split(':')
+            end = top if end == '*' else int(end)
+            start, end = sorted((int(start), end))
+            uids |= set(range(start, end + 1))
+            # n:* 在 n 大于最大 UID 时仍包含最后一封
+            if part.endswith(':*'):
+                uids.add(top)
+        return sorted(uid for uid in uids if uid in self.messages)
+
+    def uid(self, command, *args):
+        self.calls.append((command, args))
+        if command == 'SEARCH':
+            return 'OK', [' '.join(map(str, self._uids(args[-1].split()[-1]))).encode()]
+        if command in ('STORE', 'EXPUNGE'):
+            return 'OK', []
+        spec, items = args
+        data = []
+        for n, uid in enumerate(self._uids(spec), 1):
+            raw = self.messages[uid]
+            partial = re.search(r'BODY\.PEEK\[([\d.]*)\]<(\d+)\.(\d+)>', items)
+            sections = re.findall(r'BODY\.PEEK\[([\d.]+)\](?!<)', items)
+            if partial:
+                section, start, length = partial.group(1), *map(int, partial.groups()[1:])
+                chunk = section_body(raw, section)[start:start + length]
+                meta = f'UID {uid} FLAGS (\\Seen) ' if 'FLAGS' in items else f'UID {uid} '
+                data += [(f'{n} ({meta}BODY[{section}]<{start}> {{{len(chunk)}}}'.encode(), chunk), b')']
+            elif sections:
+                for i, section in enumerate(sections):
+                    chunk = section_body(raw, section)
+                    prefix = f'{n} (UID {uid} ' if not i else ' '
+                    data.append((f'{prefix}BODY[{section}] {{{len(chunk)}}}'.encode(), chunk))
+                data.append(b')')
+            elif 'ENVELOPE' in items:
+                data.append(f'{n} (UID {uid} FLAGS () INTERNALDATE "20-Nov-2023 10:00:00 +0000" '
+                            f'RFC822.SIZE {len(raw)} {self.structures[uid]})'.encode())
+            elif 'BODY' not in items:
+                data.append(f'{n} (UID {uid} RFC822.SIZE {len(raw)} FLAGS (\\Seen))'.encode())
+            else:
+                data += [(f'{n} (UID {uid} INTERNALDATE "20-Nov-2023 10:00:00 +0000" '
+                          f'RFC822.SIZE {len(raw)} FLAGS (\\Seen) BODY[] {{{len(raw)}}}'.encode(), raw),
+                         b')']
+        return 'OK', data
+
+
+class IMAPWire:
+    # 线路层的 IMAP 服务器，UID 命令交给 FakeIMAP 处理。每次 IDLE 依次取 script 中的动作：
+    # 'exists' 推送 EXISTS，'close' 断开连接，None 等待客户端 DONE；可调用对象先执行再取其返回值。
+    # 只接受第一条连接，之后的连接直接断开，用来触发重连退避
+    def __init__(self, fake, script=()):
+        self.fake = fake
+        self.script = list(script)
+        self.commands = []
+        self.connections = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def encode(self, data):
+        out = b''
+        for item in data:
+            meta, literal = item if isinstance(item, tuple) else (item, None)
+            number = re.match(rb'(\d+) ', meta)
+            if number:
+                meta = b'* ' + number.group(1) + b' FETCH ' + meta[number.end():]
+            out += meta + b'\r\n' if literal is None else meta + b'\r\n' + literal
+        return out
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            if self.connections > 1:
+                return
+            writer.write(b'* OK ready\r\n')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                tag, command = line.rstrip(b'\r\n').decode().split(' ', 1)
+                self.commands.append(command)
+                name = command.split(' ')[0].upper()
+                if name == 'CAPABILITY':
+                    writer.write(b'* CAPABILITY IMAP4rev1 IDLE UIDPLUS\r\n')
+                elif name in ('SELECT', 'EXAMINE'):
+                    writer.write(b'* %s EXISTS\r\n' % self.fake.select('INBOX')[1][0])
+                    for key in (b'UIDVALIDITY', b'UIDNEXT'):
+                        writer.write(b'* OK [%s %s]\r\n' % (key, self.fake.response(key.decode())[1][0]))
+                elif name == 'UID':
+                    _, verb, spec, items = command.split(' ', 3)
+                    writer.write(self.encode(self.fake.uid(verb, spec, items)[1]))
+                elif name == 'IDLE':
+                    writer.write(b'+ idling\r\n')
+                    action = self.script.pop(0) if self.script else None
+                    if callable(action):
+                        action = action()
+                    if action == 'close':
+                        return
+                    if action == 'exists':
+                        writer.write(b'* %d EXISTS\r\n' % len(self.fake.messages))
+                    await writer.drain()
+                    self.commands.append((await reader.readline()).strip().decode())
+                writer.write(f'{tag} OK done\r\n'.encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+class FakeSMTP:
+    # 作为 open_smtp() 的返回值；refuse: {address: (code, message)}
+    def __init__(self, refuse=None):
+        self.refuse = refuse or {}
+        self.sent = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def fake_send_streaming(smtp, from_addr, to_addrs, chunks):
+    message = message_from_bytes(b''.join(chunks))
+    smtp.sent.append((message['Message-ID'], list(to_addrs)))
+    return {address: error for address, error in smtp.refuse.items() if address in to_addrs}
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # 最小的 SMTP 服务端，统计连接、登录、NOOP 和收到的邮件数；
+    # messages 保存去掉点填充后的 DATA 内容，wire 保存收到的原始 DATA 行
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.counts['connections'] += 1
+        self.reply('220 test')
+        in_data, data = False, []
+        for line in self.rfile:
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    server.counts['messages'] += 1
+                    server.messages.append(b''.join(data))
+                    self.reply(server.data_reply)
+                    continue
+                server.wire.append(line)
+                data.append(line[1:] if line.startswith(b'.') else line)
+                continue
+            command = line.decode().strip().upper()
+            server.commands.append(command)
+            if command.startswith('EHLO'):
+                self.reply('250-test')
+                self.reply('250 AUTH PLAIN')
+            elif command.startswith('AUTH'):
+                server.counts['logins'] += 1
+                self.reply('235 ok')
+            elif command.startswith('NOOP'):
+                server.counts['noops'] += 1
+                self.reply('250 ok')
+            elif command.startswith('DATA'):
+                in_data, data = True, []
+                self.reply('354 go')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            elif command.startswith('RCPT') and 'BAD' in command:
+                self.reply('550 no such user')
+            else:
+                self.reply('250 ok')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.counts = Counter()
+        self.commands = []
+        self.messages = []
+        self.wire = []
+        self.data_reply = '250 ok'
+
+
+class FlakyStream(io.BytesIO):
+    # 读到 fail_after 字节后模拟客户端断开
+    def __init__(self, data, fail_after):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.fail_after:
+            raise OSError('client gone')
+        return super().read(min(size, 10000))
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+class MailTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', 'alice@ymail.com', 'pw')
+        cls.bob = User.objects.create_user('bob', 'bob@ymail.com', 'pw')
+        cls.carol = User.objects.create_user('carol', 'carol@ymail.com', 'pw')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def bind_account(self, user=None):
+        return BoundEmailAccount.objects.create(
+            user=user or self.alice, email_address='alice@example.com',
+            smtp_server='smtp.example.com', smtp_port=465,
+            imap_server='imap.example.com', imap_port=993, password_encrypted=encrypt('pw'))
+
+    def make_emails(self, count, **kwargs):
+        kwargs.setdefault('from_user', self.bob)
+        emails = []
+        for i in range(count):
+            email = Email.objects.create(
+                subject=f'subject {i}', body='body', **kwargs)
+            email.recipients.add(
+                self.alice, self.carol, through_defaults={'sent_at': email.sent_at})
+            for n in range(2):
+                att = Attachment(email=email, filename=f'f{n}.txt')
+                att.file.save(f'f{n}.txt', ContentFile(b'x'), save=False)
+                att.save()
+            emails.append(email)
+        return emails
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=LOCAL_CACHES, CHANNEL_LAYERS=LOCAL_CHANNEL_LAYERS)
+class LocalServicesTestCase(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        # 测试之间主键会重复，清掉上一个测试留下的版本号和列表缓存
+        for alias in LOCAL_CACHES:
+            caches[alias].clear()
+
+
+class EmailQueryBudgetTests(LocalServicesTestCase):
+    # 列表/详情接口的查询次数必须与返回行数无关
+
+    def assertConstantQueries(self, url, make_rows):
+        # 收件人数和附件数都是子查询，一页只需一条查询。
+        # make_rows 直接写库不会让版本号失效，每次请求前清掉列表缓存
+        make_rows(3)
+        caches[PAGE_CACHE_ALIAS].clear()
+        with self.assertNumQueries(1) as small:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        make_rows(30)
+        caches[PAGE_CACHE_ALIAS].clear()
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_inbox(self):
+        self.assertConstantQueries(
+            '/api/emails/inbox/?page_size=100', self.make_emails)
+
+    def test_sent(self):
+        self.assertConstantQueries(
+            '/api/emails/sent/?page_size=100&recipient=carol',
+            lambda n: self.make_emails(n, from_user=self.alice))
+
+    def test_detail(self):
+        # 邮件、收件权限、收件人、附件各一条
+        email = self.make_emails(1)[0]
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/emails/{email.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['attachments']), 2)
+        self.assertEqual(response.data['recipient_count'], 2)
+
+    def test_summary_has_count_and_own_state(self):
+        email = self.make_emails(1)[0]
+        Recipient.objects.filter(email=email, user=self.alice).update(is_read=True, folder='archive')
+        response = self.client.get('/api/emails/inbox/?folder=archive')
+        row = response.data['results'][0]
+        self.assertNotIn('recipients', row)
+        self.assertEqual((row['recipient_count'], row['is_read'], row['folder']), (2, True, 'archive'))
+
+    def test_detail_is_read_per_viewer(self):
+        # 已读状态取当前用户自己的收件记录，不受其他收件人影响
+        email = self.make_emails(1)[0]
+        Recipient.objects.filter(email=email, user=self.carol).update(is_read=True)
+        self.assertFalse(self.client.get(f'/api/emails/{email.id}/').data['is_read'])
+        Recipient.objects.filter(email=email, user=self.alice).update(is_read=True)
+        Email.objects.filter(pk=email.pk).update(is_read=False)
+        self.assertTrue(self.client.get(f'/api/emails/{email.id}/').data['is_read'])
+
+    def test_detail_caps_recipients(self):
+        email = self.make_emails(1)[0]
+        users = [User.objects.create_user(f'u{i}', f'u{i}@ymail.com', 'pw') for i in range(5)]
+        email.recipients.add(*users)
+        with mock.patch('mail.serializers.RECIPIENT_PREVIEW_LIMIT', 3):
+            response = self.client.get(f'/api/emails/{email.id}/')
+        self.assertEqual(len(response.data['recipients']), 3)
+        self.assertEqual(response.data['recipient_count'], 7)
+
+    def test_detail_forbidden_for_others(self):
+        email = self.make_emails(1, from_user=self.carol)[0]
+        Recipient.objects.filter(email=email, user=self.alice).delete()
+        response = self.client.get(f'/api/emails/{email.id}/')
+        self.assertEqual(response.status_code, 403)
+
+    def test_external_fetch(self):
+        bound = BoundEmailAccount.objects.create(
+            user=self.alice, email_address='alice@example.com',
+            smtp_server='smtp.example.com', smtp_port=465,
+            imap_server='imap.example.com', imap_port=993,
+            password_encrypted=encrypt('secret'))
+        make_rows = lambda n: self.make_emails(
+            n, from_user=self.alice, is_internal=False, external_account=bound)
+        make_rows(3)
+        with self.assertNumQueries(4) as small:
+            response = self.client.get(
+                '/api/external-emails/imap/fetch-inbox/?limit=50')
+        self.assertEqual(response.status_code, 200)
+        make_rows(30)
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.client.get(
+                '/api/external-emails/imap/fetch-inbox/?limit=50')
+        self.assertEqual(len(response.data['results']), 33)
+
+
+@mock.patch('mail.notify.coalescer', mock.Mock())
+class ListingCacheTests(LocalServicesTestCase):
+    # 邮件列表的条件 GET：版本号未变时 304 或直接读缓存，相关写入提交后失效
+    url = '/api/emails/inbox/'
+
+    def setUp(self):
+        super().setUp()
+        self.emails = self.make_emails(2)
+
+    def etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def assertChanged(self, etag):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response.data['results']
+
+    def test_not_modified_and_cached_page(self):
+        etag = self.etag()
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data['results']), 2)
+        # 过滤条件不同，ETag 也不同
+        self.assertNotEqual(self.client.get(self.url + '?subject=x')['ETag'], etag)
+
+    def test_send_invalidates(self):
+        etag = self.etag()
+        self.client.force_authenticate(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/emails/send/', {
+                'subject': 'new', 'body': 'b', 'recipients': ['alice@ymail.com']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(len(self.assertChanged(etag)), 3)
+
+    def test_bulk_read_invalidates(self):
+        etag = self.etag()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/emails/bulk/read/',
+                                        {'ids': [self.emails[0].id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        rows = {r['id']: r['is_read'] for r in self.assertChanged(etag)}
+        self.assertEqual(rows, {self.emails[0].id: True, self.emails[1].id: False})
+
+    def test_sync_invalidates(self):
+        etag = self.etag()
+        bound = self.bind_account()
+        fake = FakeIMAP({1: make_raw(1)})
+        with mock.patch('mail.imap_sync.open_imap', return_value=fake), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(len(sync_account(bound)), 1)
+        # 外部邮件不在收件箱列表中，但同步同样让该用户的版本号失效
+        self.assertEqual(len(self.assertChanged(etag)), 2)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN 仅适用于 SQLite')
+class QueryPlanTests(LocalServicesTestCase):
+    # 热点查询必须走索引：不允许全表/全索引扫描，也不允许临时 B 树排序
+
+    def setUp(self):
+        super().setUp()
+        self.bound = BoundEmailAccount.objects.create(
+            user=self.alice, email_address='alice@example.com',
+            smtp_server='smtp.example.com', smtp_port=465,
+            imap_server='imap.example.com', imap_port=993,
+            password_encrypted=encrypt('secret'))
+        self.make_emails(3)
+        self.make_emails(3, from_user=self.alice)
+        self.make_emails(3, from_user=self.alice, is_internal=False, external_account=self.bound)
+        for i, email in enumerate(Email.objects.filter(external_account=self.bound)):
+            Email.objects.filter(pk=email.pk).update(external_uid=str(i + 1))
+
+    def assertIndexedPlan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            plan = [row[-1] for row in cursor.fetchall()]
+        # 截取收件人预览的窗口函数会生成 CO-ROUTINE，扫描它们只是遍历已按索引取出的行
+        coroutines = {step[len('CO-ROUTINE '):] for step in plan if step.startswith('CO-ROUTINE ')}
+        bad = [step for step in plan if 'TEMP B-TREE' in step or (
+            step.startswith('SCAN') and step[len('SCAN '):] not in coroutines)]
+        self.assertFalse(bad, '\n'.join([sql] + plan))
+
+    def assertIndexedRequest(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        selects = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        for sql in selects:
+            self.assertIndexedPlan(sql)
+        return response
+
+    def assertPagesIndexed(self, url):
+        response = self.assertIndexedRequest(url + 'page_size=2')
+        self.assertIsNotNone(response.data['next'])
+        self.assertIndexedRequest(response.data['next'])
+
+    def test_inbox_plan(self):
+        self.assertPagesIndexed('/api/emails/inbox/?')
+        self.assertIndexedRequest('/api/emails/inbox/?folder=archive')
+
+    def test_sent_plan(self):
+        self.assertPagesIndexed('/api/emails/sent/?')
+        self.assertIndexedRequest('/api/emails/sent/?recipient=carol')
+
+    def test_external_fetch_plan(self):
+        response = self.assertIndexedRequest('/api/external-emails/imap/fetch-inbox/?limit=2&offset=1')
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_detail_and_download_plan(self):
+        email = Email.objects.filter(from_user=self.bob).first()
+        self.assertIndexedRequest(f'/api/emails/{email.id}/')
+        attachment = email.attachments.first()
+        self.assertIndexedRequest(f'/api/attachments/{attachment.id}/download/')
+
+    def test_external_uid_plan(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(_existing_uids(self.bound, [1, 2, 9]), {'1', '2'})
+        sql = ctx.captured_queries[0]['sql']
+        self.assertIndexedPlan(sql)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            self.assertIn('external_account_id=? AND external_uid=?', cursor.fetchall()[0][-1])
+
+
+class KeysetPaginationTests(LocalServicesTestCase):
+
+    def walk(self, url):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+            url = response.data['next']
+        return pages
+
+    def assertTraversal(self, url, expected):
+        pages = self.walk(url)
+        forward = [row['id'] for page in pages for row in page['results']]
+        self.assertEqual(forward, expected)
+        # 从最后一页沿 previous 返回，每一页与前进时相同
+        url = pages[-1]['previous']
+        for page in reversed(pages[:-1]):
+            response = self.client.get(url)
+            self.assertEqual([r['id'] for r in response.data['results']],
+                             [r['id'] for r in page['results']])
+            url = response.data['previous']
+        self.assertIsNone(url)
+
+    def test_inbox_ties_across_pages(self):
+        emails = self.make_emails(7)
+        # 中间 5 封时间相同，跨越分页边界，顺序由 id 决定
+        tied = timezone.now() - timedelta(hours=1)
+        Email.objects.filter(id__in=[e.id for e in emails[1:6]]).update(sent_at=tied)
+        Recipient.objects.filter(email__in=emails[1:6]).update(sent_at=tied)
+        Email.objects.filter(id=emails[6].id).update(sent_at=tied - timedelta(hours=1))
+        Recipient.objects.filter(email=emails[6]).update(sent_at=tied - timedelta(hours=1))
+        expected = [emails[0].id] + sorted((e.id for e in emails[1:6]), reverse=True) + [emails[6].id]
+        self.assertTraversal('/api/emails/inbox/?page_size=2', expected)
+
+    def test_sent_traversal(self):
+        emails = self.make_emails(5, from_user=self.alice)
+        Email.objects.filter(id__in=[e.id for e in emails[:3]]).update(
+            sent_at=timezone.now() - timedelta(days=1))
+        expected = [e.id for e in sorted(
+            Email.objects.filter(from_user=self.alice), key=lambda e: (e.sent_at, e.id), reverse=True)]
+        self.assertTraversal('/api/emails/sent/?page_size=2', expected)
+
+    def test_sent_at_required(self):
+        with self.assertRaises(IntegrityError):
+            Email.objects.create(from_user=self.bob, subject='s', body='b', sent_at=None)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/emails/inbox/?cursor=bnVsbA').status_code, 404)
+
+    def test_malformed_cursor_values(self):
+        # 伪造的游标值返回 404，而不是在过滤时出错
+        ts = '2024-01-01T00:00:00+00:00'
+        for values in ([ts, 'abc'], [5, 1], [ts, [1]], [ts, None], ['not a date', 1],
+                       [ts, True], [ts], {'a': 1}):
+            cursor = base64.urlsafe_b64encode(json.dumps({'v': values, 'r': 0}).encode()).decode()
+            for url in ('/api/emails/inbox/', '/api/emails/sent/'):
+                with self.subTest(values=values, url=url):
+                    self.assertEqual(self.client.get(f'{url}?cursor={cursor}').status_code, 404)
+        cursor = base64.urlsafe_b64encode(json.dumps({'v': [ts, 1], 'r': 0}).encode()).decode()
+        self.assertEqual(self.client.get(f'/api/emails/inbox/?cursor={cursor}').status_code, 200)
+
+
+class SentAtBackfillMigrationTests(TransactionTestCase):
+    # 早期版本留下的 sent_at 为 NULL 的邮件在迁移时按 id 顺序补齐
+    migrate_from = [('mail', '0003_series_models')]
+    migrate_to = [('mail', '0004_sent_at_not_null')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_backfill(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        old = executor.loader.project_state(self.migrate_from).apps
+        OldUser, OldEmail = old.get_model('mail', 'User'), old.get_model('mail', 'Email')
+        OldRecipient = old.get_model('mail', 'Recipient')
+        alice = OldUser.objects.create(username='alice', email='alice@ymail.com')
+        bob = OldUser.objects.create(username='bob', email='bob@ymail.com')
+        dated = timezone.now() - timedelta(days=1)
+        head = OldEmail.objects.create(from_user=bob, subject='head', body='', sent_at=None)
+        first = OldEmail.objects.create(from_user=bob, subject='first', body='', sent_at=dated)
+        gap = OldEmail.objects.create(from_user=bob, subject='gap', body='', sent_at=None)
+        OldRecipient.objects.create(email=gap, user=alice, sent_at=None)
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        self.assertEqual(Email.objects.get(pk=head.pk).sent_at, dated)
+        self.assertEqual(Email.objects.get(pk=gap.pk).sent_at, dated)
+        self.assertEqual(Email.objects.get(pk=first.pk).sent_at, dated)
+        self.assertEqual(Recipient.objects.get(email_id=gap.pk).sent_at, dated)
+
+        client = APIClient()
+        client.force_authenticate(User.objects.get(pk=bob.pk))
+        with override_settings(CACHES=LOCAL_CACHES):
+            response = client.get('/api/emails/sent/?page_size=2')
+            self.assertEqual([r['id'] for r in response.data['results']], [gap.pk, first.pk])
+            response = client.get(response.data['next'])
+        self.assertEqual([r['id'] for r in response.data['results']], [head.pk])
+
+
+class SnippetBackfillMigrationTests(TransactionTestCase):
+    # snippet 字段加入之前的邮件在迁移时按正文补齐预览
+    migrate_from = [('mail', '0004_sent_at_not_null')]
+    migrate_to = [('mail', '0005_backfill_snippet')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_backfill(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        old = executor.loader.project_state(self.migrate_from).apps
+        OldUser, OldEmail = old.get_model('mail', 'User'), old.get_model('mail', 'Email')
+        bob = OldUser.objects.create(username='bob', email='bob@ymail.com')
+        # 历史模型没有 save() 中的预览生成，相当于旧数据
+        legacy = OldEmail.objects.create(from_user=bob, subject='legacy', body='hello\n\n  world')
+        empty = OldEmail.objects.create(from_user=bob, subject='empty', body='')
+        kept = OldEmail.objects.create(from_user=bob, subject='kept', body='body', snippet='custom')
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        snippets = dict(Email.objects.values_list('id', 'snippet'))
+        self.assertEqual(snippets[legacy.pk], 'hello world')
+        self.assertEqual(snippets[empty.pk], '')
+        self.assertEqual(snippets[kept.pk], 'custom')
+
+
+class SearchTests(LocalServicesTestCase):
+
+    def test_rebuild_indexes_existing_emails(self):
+        # 模拟搜索功能上线前已有的邮件：邮件存在但没有索引
+        emails = self.make_emails(3)
+        Email.objects.filter(id=emails[0].id).update(subject='quarterly report')
+        search.remove_emails([e.id for e in emails])
+        self.assertEqual(search.search_emails(self.alice, 'quarterly'), [])
+
+        out = io.StringIO()
+        call_command('rebuild_search_index', '--batch-size', '2', stdout=out)
+        self.assertIn('indexed 3 emails', out.getvalue())
+        self.assertEqual([i for i, _ in search.search_emails(self.alice, 'quarterly')],
+                         [emails[0].id])
+
+    def test_rebuild_drops_deleted_emails(self):
+        email = self.make_emails(1)[0]
+        search.index_emails([email.id])
+        Email.objects.filter(id=email.id).delete()
+        search.rebuild_index()
+        self.assertEqual(search.search_emails(self.alice, 'subject'), [])
+
+    def test_cjk_substring(self):
+        # 中文不以空格分词，按子串检索；两个字的词走逐行比较
+        emails = self.make_emails(3)
+        Email.objects.filter(id=emails[0].id).update(subject='第三季度财务报告')
+        Email.objects.filter(id=emails[1].id).update(body='请查收季度总结')
+        search.index_emails([e.id for e in emails])
+
+        def hits(q):
+            return sorted(i for i, _ in search.search_emails(self.alice, q))
+        self.assertEqual(hits('季度财务'), [emails[0].id])
+        self.assertEqual(hits('季度'), sorted([emails[0].id, emails[1].id]))
+        self.assertEqual(hits('报告 财务'), [emails[0].id])
+        self.assertEqual(hits('季度 总结'), [emails[1].id])
+        self.assertEqual(hits('SUBJ'), [emails[1].id, emails[2].id])
+        self.assertEqual(hits('年度'), [])
+
+    def test_upgrades_unicode61_index(self):
+        # 旧表按 unicode61 分词，启动迁移时删掉重建
+        email = self.make_emails(1)[0]
+        Email.objects.filter(id=email.id).update(subject='季度报告')
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {search.FTS_TABLE}")
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {search.FTS_TABLE} USING fts5("
+                "subject, body, sender, attachments, tokenize = 'unicode61 remove_diacritics 2')")
+        search.create_search_index()
+        self.assertEqual([i for i, _ in search.search_emails(self.alice, '季度报')], [email.id])
+
+    def test_invalid_paging_params(self):
+        emails = self.make_emails(3)
+        search.index_emails([e.id for e in emails])
+        response = self.client.get('/api/emails/search/?q=subject&limit=abc&offset=-5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 3)
+        response = self.client.get('/api/emails/search/?q=subject&limit=1&offset=x')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_external_inbox_invalid_paging_params(self):
+        self.bind_account()
+        response = self.client.get('/api/external-emails/imap/fetch-inbox/?limit=ten&offset=')
+        self.assertEqual(response.status_code, 200)
+
+
+class BlobTests(LocalServicesTestCase):
+
+    def upload(self, email, name, data):
+        return self.client.post(f'/api/emails/{email.id}/attachments/upload/',
+                                {'file': SimpleUploadedFile(name, data)}, format='multipart')
+
+    def test_refcount_and_gc(self):
+        first, second = (Email.objects.create(from_user=self.alice, subject='s', body='b')
+                         for _ in range(2))
+        response = self.upload(first, 'x.pdf', b'PDF' * 1000)
+        self.assertEqual(response.status_code, 201)
+        self.upload(second, 'y.pdf', b'PDF' * 1000)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(set(Attachment.objects.filter(blob=blob).values_list('file', flat=True)),
+                         {blob.file.name})
+
+        # 转发附件只增加引用，不复制文件
+        response = self.client.post('/api/emails/send/', {
+            'subject': 's', 'body': 'b', 'recipients': ['bob@ymail.com'],
+            'attachments': [response.data['id']]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 3)
+
+        Email.objects.all().delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 0)
+        # 宽限期内不回收
+        self.assertEqual(collect_garbage()[0], 0)
+        # 引用数漂移时 --reconcile 先按附件表重算
+        Blob.objects.update(touched_at=timezone.now() - timedelta(days=2), ref_count=5)
+        call_command('gc_blobs', '--reconcile', stdout=io.StringIO())
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(os.path.exists(blob.file.path))
+
+    def test_imap_attachments_share_blob(self):
+        bound = self.bind_account()
+        fake = FakeIMAP({uid: make_raw(uid, b'A' * 200) for uid in (1, 2, 3)})
+        with mock.patch('mail.imap_sync.open_imap', return_value=fake):
+            self.assertEqual(len(sync_account(bound)), 3)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 3)
+        with blob.file.open('rb') as f:
+            self.assertEqual(f.read(), b'A' * 200)
+
+    @override_settings(IMAP_STREAM_THRESHOLD=100, IMAP_STREAM_CHUNK_SIZE=64)
+    def test_streamed_imap_attachments_share_blob(self):
+        self.test_imap_attachments_share_blob()
+
+    def test_store_blob_is_atomic(self):
+        blob = store_blob(b'same' * 100)
+        directory = os.path.dirname(blob.file.path)
+        # 行已建好但文件字段还是空：另一个请求正在写入时的状态
+        Blob.objects.filter(pk=blob.pk).update(file='')
+        os.remove(blob.file.path)
+        again = store_blob(b'same' * 100)
+        self.assertEqual((again.pk, again.file.name), (blob.pk, blob.file.name))
+        with again.file.open('rb') as f:
+            self.assertEqual(f.read(), b'same' * 100)
+        self.assertFalse([n for n in os.listdir(directory) if n.startswith('.tmp-')])
+
+        # 读到行之后另一个请求先写好了文件：条件更新不覆盖它的结果
+        stale = Blob.objects.get(pk=blob.pk)
+        stale.file.name = ''
+        Blob.objects.filter(pk=blob.pk).update(file='blobs/other')
+        with mock.patch.object(Blob.objects, 'get_or_create', return_value=(stale, False)):
+            store_blob(b'same' * 100)
+        self.assertEqual(Blob.objects.get(pk=blob.pk).file.name, 'blobs/other')
+
+    def test_forward_placeholder_fetches_first(self):
+        bound = self.bind_account()
+        external = Email.objects.create(from_user=self.alice, subject='s', body='b',
+                                        is_internal=False, external_account=bound, external_uid='1')
+        placeholder = Attachment.objects.create(
+            email=external, filename='a.bin', imap_section='2', imap_encoding='base64', size=3)
+
+        def fetch(attachment):
+            blob = store_blob(b'abc')
+            attachment.blob, attachment.file = blob, blob.file.name
+            attachment.save(update_fields=['blob', 'file'])
+            add_refs([blob.pk])
+            return attachment
+
+        with mock.patch('mail.imap_sync.fetch_attachment', side_effect=fetch) as fetched:
+            response = self.client.post('/api/emails/send/', {
+                'subject': 's', 'body': 'b', 'recipients': ['bob@ymail.com'],
+                'attachments': [placeholder.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(fetched.call_count, 1)
+        copy = Attachment.objects.exclude(pk=placeholder.pk).get()
+        self.assertEqual(copy.blob_id, Attachment.objects.get(pk=placeholder.pk).blob_id)
+        self.assertEqual(copy.blob.ref_count, 2)
+
+
+@mock.patch('mail.outbox.send_streaming', fake_send_streaming)
+class OutboxTests(LocalServicesTestCase):
+
+    def run_outbox(self, **kwargs):
+        with mock.patch('mail.outbox.open_smtp', **kwargs):
+            for message in claim_batch():
+                deliver(message)
+
+    def send(self, recipients):
+        response = self.client.post('/api/emails/send/', {
+            'subject': 's', 'body': 'b', 'recipients': recipients}, format='json')
+        self.assertEqual(response.status_code, 202)
+        return response.data['id']
+
+    def test_partial_retry(self):
+        message_id = self.send(['x@ext.com', 'y@ext.com', 'z@ext.com'])
+        first = FakeSMTP(refuse={'y@ext.com': (450, b'try later'), 'z@ext.com': (550, b'no user')})
+        self.run_outbox(return_value=first)
+        data = self.client.get(f'/api/emails/outbox/{message_id}/').data
+        # 4xx 等待重试，5xx 直接失败
+        self.assertEqual(data['status'], 'queued')
+        self.assertEqual({r['address']: r['status'] for r in data['recipients']},
+                         {'x@ext.com': 'sent', 'y@ext.com': 'pending', 'z@ext.com': 'failed'})
+
+        # 未到重试时间不会被领取
+        self.assertEqual(claim_batch(), [])
+        OutboundMessage.objects.update(next_attempt_at=timezone.now())
+        second = FakeSMTP()
+        self.run_outbox(return_value=second)
+        # 重试只投递未成功的收件人，Message-ID 不变
+        self.assertEqual(second.sent, [(first.sent[0][0], ['y@ext.com'])])
+        data = self.client.get(f'/api/emails/outbox/{message_id}/').data
+        self.assertEqual(data['status'], 'partial')
+
+    def test_connection_error_backoff(self):
+        message_id = self.send(['x@ext.com'])
+        self.run_outbox(side_effect=ConnectionRefusedError('refused'))
+        message = OutboundMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), ('queued', 1))
+        self.assertGreater(message.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        OutboundMessage.objects.update(next_attempt_at=timezone.now())
+        with self.settings(OUTBOX_MAX_ATTEMPTS=2):
+            self.run_outbox(side_effect=ConnectionRefusedError('refused'))
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'failed')
+        self.assertIn('refused', message.last_error)
+
+        other = APIClient()
+        other.force_authenticate(self.bob)
+        self.assertEqual(other.get(f'/api/emails/outbox/{message_id}/').status_code, 404)
+
+
+class MimeStreamingTests(SimpleTestCase):
+    # compose + send_streaming 对着本地 SMTP 服务端收发，检查线路上的实际内容
+
+    def setUp(self):
+        self.server = SMTPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.smtp = smtplib.SMTP('127.0.0.1', self.server.server_address[1])
+        self.addCleanup(self.smtp.close)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # 大于 READ_SIZE，附件分多块编码发送
+        self.data = os.urandom(3 * mime_writer.READ_SIZE + 100)
+        self.path = os.path.join(directory, 'big.bin')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def send(self, body, to=('bob@example.com',), attachments=()):
+        chunks = mime_writer.compose('a@example.com', ', '.join(to), '测试', body, attachments)
+        return mime_writer.send_streaming(self.smtp, 'a@example.com', list(to), chunks)
+
+    def content(self, part):
+        # 解析后的正文保留线路上的 CRLF
+        return part.get_content().replace('\r\n', '\n')
+
+    def test_dot_stuffing_and_attachment(self):
+        body = '.leading dot\n..two dots\n中文正文\n.'
+        chunks = list(mime_writer.compose('a@example.com', 'bob@example.com', '测试', body,
+                                          [(self.path, '数据.bin')]))
+        self.assertGreater(len(chunks), 3)
+        refused = mime_writer.send_streaming(self.smtp, 'a@example.com', ['bob@example.com'], iter(chunks))
+        self.assertEqual(refused, {})
+        raw, = self.server.messages
+        # 以点开头的行在线路上都被填充，服务端还原后与 compose 的输出一致
+        self.assertEqual(raw, b''.join(chunks))
+        self.assertTrue(all(not line.startswith(b'.') or line.startswith(b'..')
+                            for line in self.server.wire))
+        self.assertIn(b'..leading dot\r\n', self.server.wire)
+        self.assertIn(b'...two dots\r\n', self.server.wire)
+        message = message_from_bytes(raw, policy=email_policy.default)
+        text, attachment = message.iter_parts()
+        self.assertEqual(self.content(text), body + '\n')
+        self.assertEqual(attachment.get_filename(), '数据.bin')
+        self.assertEqual(attachment.get_content(), self.data)
+        # 整封邮件是 7bit，不需要 8BITMIME
+        self.assertTrue(raw.isascii())
+        self.assertIn('MAIL FROM:<A@EXAMPLE.COM>', self.server.commands)
+
+    def test_chunk_boundaries(self):
+        # 点落在块的开头：前一块以换行结束
+        chunks = [b'Subject: x\r\n\r\nline\r\n', b'.dot\r\n', b'\r', b'\n.cr\r\n', b'end']
+        mime_writer.send_streaming(self.smtp, 'a@example.com', ['bob@example.com'], iter(chunks))
+        self.assertEqual(self.server.messages, [b''.join(chunks) + b'\r\n'])
+        self.assertIn(b'..dot\r\n', self.server.wire)
+        self.assertIn(b'..cr\r\n', self.server.wire)
+
+    def test_plain_body_without_attachments(self):
+        self.send('.中文\n')
+        message = message_from_bytes(self.server.messages[0], policy=email_policy.default)
+        self.assertEqual(self.content(message), '.中文\n')
+        self.assertEqual(message['Content-Transfer-Encoding'], 'quoted-printable')
+
+    def test_rcpt_and_data_errors(self):
+        # 部分收件人被拒：照常发送，返回被拒的地址
+        refused = self.send('hi', to=('bob@example.com', 'bad@example.com'))
+        self.assertEqual(list(refused), ['bad@example.com'])
+        self.assertEqual(refused['bad@example.com'][0], 550)
+        # 全部被拒：不发送 DATA
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.send('hi', to=('bad@example.com',))
+        self.assertEqual(self.server.commands.count('DATA'), 1)
+        # DATA 结束后被拒
+        self.server.data_reply = '554 rejected'
+        with self.assertRaises(smtplib.SMTPDataError) as ctx:
+            self.send('hi')
+        self.assertEqual(ctx.exception.smtp_code, 554)
+        # 出错后连接已 RSET，可以继续发送
+        self.server.data_reply = '250 ok'
+        self.assertEqual(self.send('again'), {})
+        self.assertEqual(len(self.server.messages), 3)
+
+
+class SMTPPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = SMTPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.pool = SMTPPool(max_idle=0.5, max_messages=3, noop_after=0.1, max_per_key=2)
+        self.addCleanup(self.pool.close_all)
+
+    def send(self, to='x@example.com', password='pw'):
+        message = EmailMessage()
+        message['From'] = 'a@example.com'
+        message['To'] = to
+        message['Subject'] = 's'
+        message.set_content('hi')
+        port = self.server.server_address[1]
+        with self.pool.connection('127.0.0.1', port, 'none', 'user', password) as smtp:
+            smtp.send_message(message)
+
+    def test_reuse_and_recycle(self):
+        for _ in range(5):
+            self.send()
+        # 每个连接最多发 3 封：5 封用 2 个连接、2 次登录
+        counts = self.server.counts
+        self.assertEqual((counts['connections'], counts['logins'], counts['messages']), (2, 2, 5))
+        self.assertEqual(self.pool.stats()['recycled'], 1)
+
+        # 密码不同的账号不复用连接
+        self.send(password='other')
+        self.assertEqual(counts['logins'], 3)
+
+    def test_noop_probe_after_idle(self):
+        self.send()
+        time.sleep(0.2)
+        # 空闲超过 noop_after 后先 NOOP 探测，连接仍可用则复用
+        self.send()
+        self.assertEqual((self.server.counts['noops'], self.server.counts['connections']), (1, 1))
+
+    def test_refused_recipient_keeps_connection(self):
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.send(to='BAD@example.com')
+        self.send()
+        self.assertEqual(self.server.counts['connections'], 1)
+
+    def test_reap_expired(self):
+        self.send()
+        time.sleep(0.6)
+        self.pool.reap()
+        stats = self.pool.stats()
+        self.assertEqual(stats['idle'], 0)
+        self.assertEqual(stats['expired'], 1)
+
+
+class DistributionListTests(LocalServicesTestCase):
+    # 分发列表展开：直接成员 + 组成员，去重，按 version 缓存，成员变化时失效
+
+    def setUp(self):
+        super().setUp()
+        self.team = Group.objects.create(name='team')
+        self.team.user_set.add(self.bob, self.carol)
+        self.dl = DistributionList.objects.create(name='all', address='all@ymail.com')
+        self.dl.members.add(self.alice, self.bob)
+        self.dl.groups.add(self.team)
+
+    def expand(self):
+        self.dl.refresh_from_db()
+        return sorted(expand_list(self.dl))
+
+    def test_expands_members_and_groups_once(self):
+        # bob 既是直接成员又在组里，只出现一次；停用的用户不展开
+        dave = User.objects.create_user('dave', 'dave@ymail.com', 'pw', is_active=False)
+        self.team.user_set.add(dave)
+        self.assertEqual(self.expand(), sorted([self.alice.id, self.bob.id, self.carol.id]))
+
+    def test_resolve_recipients(self):
+        user_ids, external = resolve_recipients(
+            [' all@ymail.com', 'bob@ymail.com', 'x@example.com', '', None, 'all@ymail.com '])
+        self.assertEqual(user_ids, {self.alice.id, self.bob.id, self.carol.id})
+        self.assertEqual(external, {'x@example.com'})
+
+    def test_cache_hit(self):
+        self.expand()
+        with self.assertNumQueries(0):
+            self.assertEqual(expand_list(self.dl), expand_list(self.dl))
+        # 版本号相同就信任缓存，绕过信号的直接改动不可见
+        DistributionList.members.through.objects.filter(user=self.alice).delete()
+        self.assertIn(self.alice.id, self.expand())
+
+    def test_membership_changes_invalidate(self):
+        dave = User.objects.create_user('dave', 'dave@ymail.com', 'pw')
+        self.expand()
+        # 分发列表成员
+        self.dl.members.remove(self.alice)
+        self.assertNotIn(self.alice.id, self.expand())
+        dave.distribution_lists.add(self.dl)
+        self.assertIn(dave.id, self.expand())
+        # 组成员（从组和用户两侧）
+        self.team.user_set.remove(self.carol)
+        self.assertNotIn(self.carol.id, self.expand())
+        self.carol.groups.add(self.team)
+        self.assertIn(self.carol.id, self.expand())
+        self.carol.groups.clear()
+        self.assertNotIn(self.carol.id, self.expand())
+        # 分发列表的组
+        self.dl.groups.clear()
+        self.assertEqual(self.expand(), sorted([self.bob.id, dave.id]))
+        # 删除用户：级联删除不发 m2m_changed，由 pre_delete 处理
+        dave.delete()
+        self.assertEqual(self.expand(), [self.bob.id])
+
+    def test_unrelated_changes_keep_cache(self):
+        other = DistributionList.objects.create(name='other', address='other@ymail.com')
+        self.dl.refresh_from_db()
+        version = self.dl.version
+        other.members.add(self.carol)
+        Group.objects.create(name='idle').user_set.add(self.alice)
+        self.dl.refresh_from_db()
+        self.assertEqual(self.dl.version, version)
+
+
+class ChangeFeedTests(LocalServicesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.emails = []
+        for i in range(3):
+            email = Email.objects.create(from_user=self.bob, subject=f's{i}', body='x')
+            deliver_internal(email, {self.alice.id, self.bob.id})
+            self.emails.append(email)
+        record_changes([(self.alice.id, 'read', self.emails[0].id),
+                        (self.alice.id, 'deleted', self.emails[1].id)])
+        self.deleted_id = self.emails[1].id
+        self.emails[1].delete()
+
+    def test_sequence_per_user(self):
+        changes, last_seq, more = changes_since(self.alice.id, 1)
+        self.assertEqual([(c['seq'], c['kind']) for c in changes],
+                         [(2, 'new'), (3, 'new'), (4, 'read'), (5, 'deleted')])
+        self.assertEqual((last_seq, more), (5, False))
+        # bob 的序列号独立递增
+        self.assertEqual(changes_since(self.bob.id, 0)[1], 3)
+        # 已删除邮件的 new 变更不带摘要，由后面的 deleted 覆盖
+        kinds = [(c['kind'], c['email_id']) for c in serialize_changes(self.alice.id, changes)]
+        self.assertNotIn(('new', self.deleted_id), kinds)
+        self.assertEqual(kinds[-1], ('deleted', self.deleted_id))
+
+    def test_paging(self):
+        changes, last_seq, more = changes_since(self.alice.id, 0, limit=2)
+        self.assertEqual([c['seq'] for c in changes], [1, 2])
+        self.assertTrue(more)
+        self.assertEqual(changes_since(self.alice.id, 5), ([], 5, False))
+
+    def test_resync(self):
+        # 客户端的序列号超前（数据被重建）或已被清理时返回 None
+        self.assertIsNone(changes_since(self.alice.id, 99)[0])
+        force_resync([self.alice.id])
+        changes, last_seq, _ = changes_since(self.alice.id, 5)
+        self.assertIsNone(changes)
+        self.assertEqual(changes_since(self.alice.id, last_seq), ([], last_seq, False))
+
+    def test_prune(self):
+        MailboxChange.objects.filter(user=self.alice, seq__lte=3).update(
+            created_at=timezone.now() - timedelta(days=365))
+        self.assertEqual(prune_changes(), 3)
+        self.assertEqual(MailboxState.objects.get(user=self.alice).pruned_seq, 3)
+        self.assertIsNone(changes_since(self.alice.id, 2)[0])
+        self.assertEqual([c['seq'] for c in changes_since(self.alice.id, 3)[0]], [4, 5])
+
+
+@override_settings(CACHES=LOCAL_CACHES, CHANNEL_LAYERS=LOCAL_CHANNEL_LAYERS)
+class MailConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.alice = User.objects.create_user('alice', 'alice@ymail.com', 'pw')
+        self.app = JWTAuthMiddleware(URLRouter([path('ws/mailbox/', MailConsumer.as_asgi())]))
+
+    def connect(self, token):
+        communicator = ApplicationCommunicator(self.app, {
+            'type': 'websocket', 'path': '/ws/mailbox/', 'headers': [], 'subprotocols': [],
+            'query_string': b'token=' + token.encode()})
+        return communicator
+
+    async def receive(self, communicator):
+        return json.loads((await communicator.receive_output(2))['text'])
+
+    def test_sync(self):
+        email = Email.objects.create(from_user=self.alice, subject='s', body='x')
+        deliver_internal(email, {self.alice.id})
+        token = str(AccessToken.for_user(self.alice))
+
+        async def session():
+            communicator = self.connect(token)
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual((await communicator.receive_output(2))['type'], 'websocket.accept')
+            self.assertEqual((await self.receive(communicator))['type'], 'counters')
+            replies = []
+            for since in (0, 99):
+                await communicator.send_input({'type': 'websocket.receive',
+                                               'text': json.dumps({'type': 'sync', 'since': since})})
+                replies.append(await self.receive(communicator))
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(1)
+            return replies
+
+        changes, resync = asyncio.run(session())
+        self.assertEqual(changes['seq'], 1)
+        self.assertEqual(changes['changes'][0]['email']['subject'], 's')
+        self.assertEqual(resync, {'type': 'resync', 'seq': 1})
+
+    def test_counters_event(self):
+        # 合并后的 counters 事件只是通知，连接收到后自己读取当前计数
+        email = Email.objects.create(from_user=self.alice, subject='s', body='x')
+        deliver_internal(email, {self.alice.id})
+        token = str(AccessToken.for_user(self.alice))
+
+        async def session():
+            communicator = self.connect(token)
+            await communicator.send_input({'type': 'websocket.connect'})
+            await communicator.receive_output(2)
+            await self.receive(communicator)
+            await sync_to_async(_deliver)({(self.alice.id, 'counters'): [{'type': 'counters'}] * 2})
+            reply = await self.receive(communicator)
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(1)
+            return reply
+
+        reply = asyncio.run(session())
+        self.assertEqual(reply, {'type': 'counters', 'counters': get_counters(self.alice.id)})
+        self.assertEqual(reply['counters']['inbox'], {'total': 1, 'unread': 1})
+
+    def test_rejects_bad_token(self):
+        async def session():
+            communicator = self.connect('garbage')
+            await communicator.send_input({'type': 'websocket.connect'})
+            return await communicator.receive_output(2)
+
+        self.assertEqual(asyncio.run(session())['type'], 'websocket.close')
+
+
+class BulkMailboxTests(LocalServicesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.emails = self.make_emails(6)
+        self.ids = [e.id for e in self.emails]
+        get_counters(self.alice.id)
+
+    def bulk(self, action, **data):
+        response = self.client.post(f'/api/emails/bulk/{action}/', data, format='json')
+        return response.data.get('count') if response.status_code == 200 else response.status_code
+
+    def test_read_move_delete(self):
+        self.assertEqual(self.bulk('read', ids=self.ids[:2]), 2)
+        # 已读状态按收件人保存，不影响 carol
+        self.assertFalse(Recipient.objects.get(email=self.emails[0], user=self.carol).is_read)
+        self.assertEqual(self.bulk('read', filter={}), 4)
+        self.assertEqual(get_counters(self.alice.id)['inbox'], {'total': 6, 'unread': 0})
+
+        self.assertEqual(self.bulk('unread', filter={'subject': 'subject 1'}), 1)
+        self.assertEqual(self.bulk('move', filter={'unread': True}, folder='archive'), 1)
+        self.assertEqual(get_counters(self.alice.id)['inbox'], {'total': 5, 'unread': 0})
+        archive = self.client.get('/api/emails/inbox/?folder=archive').data['results']
+        self.assertEqual([r['id'] for r in archive], [self.emails[1].id])
+
+        self.assertEqual(self.bulk('delete', ids=self.ids[:3]), 3)
+        # 只删除 alice 的收件记录，邮件仍属于其他人
+        self.assertEqual(Email.objects.count(), 6)
+        self.assertEqual(get_counters(self.alice.id)['inbox'], {'total': 3, 'unread': 0})
+        self.assertEqual(reconcile_counters(), 0)
+
+        kinds = [c['kind'] for c in changes_since(self.alice.id, 0)[0]]
+        self.assertEqual(kinds.count('read'), 6)
+        # 移入归档 1 条，删除 3 条
+        self.assertEqual(kinds.count('deleted'), 4)
+
+    def test_large_selection_forces_resync(self):
+        with mock.patch('mail.bulk.BULK_CHANGE_LIMIT', 3):
+            self.assertEqual(self.bulk('read', filter={}), 6)
+        state = MailboxState.objects.get(user=self.alice)
+        self.assertEqual(state.pruned_seq, state.last_seq)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.bulk('frob', ids=[]), 404)
+        self.assertEqual(self.bulk('read'), 400)
+        self.assertEqual(self.bulk('read', ids=['x']), 400)
+        self.assertEqual(self.bulk('read', filter={'before': 'x'}), 400)
+        self.assertEqual(self.bulk('move', ids=self.ids, folder='nope'), 400)
+        self.assertEqual(self.bulk('move', mailbox='external', ids=self.ids, folder='inbox'), 400)
+
+    def test_external_delete_expunges_on_next_sync(self):
+        bound = self.bind_account()
+        fake = FakeIMAP({uid: make_raw(uid) for uid in range(1, 7)})
+        with mock.patch('mail.imap_sync.open_imap', return_value=fake):
+            sync_account(bound)
+        external = dict(Email.objects.filter(external_account=bound).values_list('external_uid', 'id'))
+        self.assertEqual(self.bulk('unread', mailbox='external', filter={}), 6)
+        self.assertEqual(self.bulk('read', mailbox='external', ids=[external['2'], external['3']]), 2)
+        self.assertEqual(self.bulk('delete', mailbox='external', ids=[external['4'], external['5']]), 2)
+        self.assertEqual(get_counters(self.alice.id)['external'], {'total': 4, 'unread': 2})
+        self.assertEqual(PendingExpunge.objects.count(), 2)
+        self.assertFalse(RawMessage.objects.filter(account=bound, uid__in=[4, 5]).exists())
+
+        fake.calls.clear()
+        with mock.patch('mail.imap_sync.open_imap', return_value=fake):
+            sync_account(bound)
+        # 标记和删除合并为按 UID 区间的少量命令
+        self.assertEqual([c for c in fake.calls if c[0] in ('STORE', 'EXPUNGE')], [
+            ('STORE', ('2:3', '+FLAGS.SILENT', r'(\Seen)')),
+            ('STORE', ('1,6', '-FLAGS.SILENT', r'(\Seen)')),
+            ('STORE', ('4:5', '+FLAGS.SILENT', r'(\Deleted)')),
+            ('EXPUNGE', ('4:5',)),
+        ])
+        self.assertFalse(PendingExpunge.objects.exists())
+        self.assertFalse(Email.objects.filter(imap_flags_dirty=True).exists())
+        self.assertEqual(reconcile_counters(), 0)
+
+
+class AttachmentDownloadTests(LocalServicesTestCase):
+    data = bytes(range(256)) * 400
+
+    def setUp(self):
+        super().setUp()
+        email = Email.objects.create(from_user=self.alice, subject='s', body='b')
+        response = self.client.post(f'/api/emails/{email.id}/attachments/upload/',
+                                    {'file': SimpleUploadedFile('r.pdf', self.data)},
+                                    format='multipart')
+        self.url = f'/api/attachments/{response.data["id"]}/download/'
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-500', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-500', 100), (0, 99))
+        self.assertIs(parse_range('bytes=100-', 100), False)
+        self.assertIs(parse_range('bytes=5-2', 100), False)
+        self.assertIs(parse_range('bytes=-0', 100), False)
+        # 多区间和其他单位按没有 Range 处理
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 100))
+        self.assertIsNone(parse_range('items=0-1', 100))
+        self.assertIsNone(parse_range('bytes=-', 100))
+        self.assertIsNone(parse_range(None, 100))
+
+    def test_full_and_conditional(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('attachment; filename="r.pdf"', response['Content-Disposition'])
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+    def test_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.data[100:200])
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(self.body(self.client.get(self.url, HTTP_RANGE='bytes=-10')), self.data[-10:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1,5-6').status_code, 200)
+
+    def test_if_range(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        # 文件已变化（ETag 不同）或弱 ETag 时返回完整文件
+        for value in ('"other"', f'W/{etag}', 'Mon, 01 Jan 2001 00:00:00 GMT'):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=value)
+            self.assertEqual(response.status_code, 200, value)
+
+    @override_settings(ATTACHMENT_OFFLOAD='x-accel')
+    def test_offload(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['X-Accel-Redirect'].startswith('/protected-media/'))
+        self.assertEqual(response.content, b'')
+
+    def test_permission(self):
+        other = APIClient()
+        other.force_authenticate(self.bob)
+        self.assertEqual(other.get(self.url).status_code, 403)
+
+
+@override_settings(ATTACHMENT_MAX_SIZE=500_000)
+class ResumableUploadTests(LocalServicesTestCase):
+    data = os.urandom(300_000)
+
+    def setUp(self):
+        super().setUp()
+        email = Email.objects.create(from_user=self.alice, subject='s', body='b')
+        self.base = f'/api/emails/{email.id}/attachments/uploads/'
+
+    def start(self, size=None, **data):
+        response = self.client.post(self.base, {
+            'filename': 'big.bin', 'size': len(self.data) if size is None else size, **data},
+            format='json')
+        return response, f'/api/attachments/uploads/{response.data.get("upload_id")}/'
+
+    def put(self, url, data, offset):
+        return self.client.put(url, data, content_type='application/octet-stream',
+                               HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resume_after_interruption(self):
+        self.assertEqual(self.start(size=600_000)[0].status_code, 413)
+        response, url = self.start(sha256=hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.put(url, self.data[:100_000], 0).data['offset'], 100_000)
+
+        # 偏移不一致时返回 409 和服务端的当前偏移
+        response = self.put(url, self.data[:10], 0)
+        self.assertEqual((response.status_code, response.data['offset']), (409, 100_000))
+
+        # 连接中断：已写入的部分保留，客户端查询偏移后续传
+        session = UploadSession.objects.get()
+        with self.assertRaises(OSError):
+            uploads.write_chunk(session, 100_000, FlakyStream(self.data[100_000:], 50_000))
+        offset = self.client.get(url).data['offset']
+        self.assertEqual(offset, 150_000)
+        # 续传的请求落到另一个进程，没有缓存的哈希状态
+        uploads._hashers.clear()
+        self.assertEqual(self.put(url, self.data[offset:], offset).data['offset'], len(self.data))
+        self.assertEqual(self.put(url, b'x', len(self.data)).status_code, 413)
+
+        response = self.client.post(url + 'complete/')
+        self.assertEqual(response.status_code, 201)
+        attachment = Attachment.objects.get(pk=response.data['id'])
+        self.assertEqual(attachment.size, len(self.data))
+        with attachment.file.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_dedupe_and_checksum(self):
+        for _ in range(2):
+            _, url = self.start()
+            self.put(url, self.data, 0)
+            self.assertEqual(self.client.post(url + 'complete/').status_code, 201)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+        _, url = self.start(size=3, sha256='0' * 64)
+        self.put(url, b'abc', 0)
+        self.assertEqual(self.client.post(url + 'complete/').status_code, 422)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_incomplete_and_ownership(self):
+        _, url = self.start(size=3)
+        self.assertEqual(self.client.post(url + 'complete/').status_code, 409)
+        other = APIClient()
+        other.force_authenticate(self.bob)
+        self.assertEqual(other.get(url).status_code, 404)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertFalse(UploadSession.objects.exists())
+
+
+class RawStoreTests(LocalServicesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        override = self.settings(RAW_MESSAGE_DIR=directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        # 映射缓存按段号索引，不能跨目录复用
+        raw_store._maps.clear()
+        self.addCleanup(raw_store._maps.clear)
+        self.bound = self.bind_account()
+        self.bound.uid_validity = 7
+        self.bound.save()
+        self.raws = {uid: make_raw(uid, b'A' * 100) for uid in range(1, 6)}
+
+    def store(self):
+        spool = tempfile.SpooledTemporaryFile()
+        spool.write(self.raws[5])
+        # bytes 和流入时落盘的临时文件两种来源
+        messages = [(uid, b'FLAGS ()', self.raws[uid]) for uid in range(1, 5)]
+        store_messages(self.bound, messages + [(5, b'FLAGS ()', spool)], 5)
+
+    def test_store_and_replay(self):
+        self.store()
+        for uid, raw in self.raws.items():
+            self.assertEqual(raw_store.get_raw(self.bound, uid), raw)
+        self.assertEqual([entry.uid for entry, _ in raw_store.replay()], [1, 2, 3, 4, 5])
+
+        Email.objects.update(subject='', body='')
+        self.assertEqual(reparse_raw(batch_size=2), 5)
+        self.assertFalse(Email.objects.filter(subject='').exists())
+        out = io.StringIO()
+        call_command('replay_raw_messages', stdout=out)
+        self.assertIn('verified 5', out.getvalue())
+
+    def test_crc_detects_corruption(self):
+        self.store()
+        entry = RawMessage.objects.get(uid=1)
+        with open(raw_store._segment_path(entry.segment), 'r+b') as f:
+            f.seek(entry.offset + raw_store._HEADER.size + 3)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xff]))
+        raw_store._maps.clear()
+        with self.assertRaises(raw_store.RawStoreError):
+            raw_store.get_raw(self.bound, 1)
+        # 其他记录不受影响
+        self.assertEqual(raw_store.get_raw(self.bound, 2), self.raws[2])
+
+    def test_index_follows_deletes(self):
+        self.store()
+        email = Email.objects.get(external_account=self.bound, external_uid='2')
+        self.client.post('/api/emails/bulk/delete/', {'mailbox': 'external', 'ids': [email.id]},
+                         format='json')
+        self.assertFalse(RawMessage.objects.filter(uid=2).exists())
+        check_uid_validity(self.bound, 8)
+        self.assertFalse(RawMessage.objects.exists())
+
+    def test_rollover_and_drop_dead_segments(self):
+        with mock.patch.object(raw_store, 'SEGMENT_SIZE', 10):
+            self.store()
+        self.assertEqual(sorted(RawMessage.objects.values_list('segment', flat=True)), [1, 2, 3, 4, 5])
+        RawMessage.objects.filter(uid__in=[1, 3]).delete()
+        # 宽限期内不删除
+        self.assertEqual(raw_store.drop_dead_segments(), 0)
+        self.assertEqual(raw_store.drop_dead_segments(grace=-10), 2)
+        self.assertEqual(raw_store._segments(), [2, 4, 5])
+        self.assertEqual(raw_store.get_raw(self.bound, 2), self.raws[2])
+
+
+# 事务中的读取总是走主库，所以不能用 TestCase
+@override_settings(CACHES=LOCAL_CACHES, DATABASE_REPLICAS=['replica'], DATABASE_REPLICA_STICKY=5)
+class ReplicaRouterTests(TransactionTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.router = databases.ReplicaRouter()
+        self.alice = User.objects.create_user('alice', 'alice@ymail.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@ymail.com', 'pw')
+
+    def request(self, method='GET', user=None, write=False, atomic=False):
+        # 返回视图中读取 Email 时选中的数据库
+        request = getattr(RequestFactory(), method.lower())('/')
+        if user is not None:
+            request.user = user
+        seen = []
+
+        def view(request):
+            if write:
+                self.router.db_for_write(Email)
+            if atomic:
+                with transaction.atomic():
+                    seen.append(self.router.db_for_read(Email))
+            else:
+                seen.append(self.router.db_for_read(Email))
+            return HttpResponse()
+
+        databases.ReplicaRoutingMiddleware(view)(request)
+        return seen[0]
+
+    def test_routing(self):
+        self.assertEqual(self.router.db_for_read(Email), databases.PRIMARY)
+        self.assertEqual(self.request(user=self.alice), 'replica')
+        self.assertEqual(self.request('POST', user=self.alice), databases.PRIMARY)
+        self.assertEqual(self.request(atomic=True, user=self.alice), databases.PRIMARY)
+        # 认证之前不知道用户，读副本
+        self.assertEqual(self.request(), 'replica')
+
+    def test_read_your_writes(self):
+        self.assertEqual(self.request(user=self.alice, write=True), databases.PRIMARY)
+        # 写过之后 STICKY 秒内该用户读主库，其他用户不受影响
+        self.assertEqual(self.request(user=self.alice), databases.PRIMARY)
+        self.assertEqual(self.request(user=self.bob), 'replica')
+        databases.pin_primary([self.bob.id])
+        self.assertEqual(self.request(user=self.bob), databases.PRIMARY)
+        caches['default'].clear()
+        self.assertEqual(self.request(user=self.alice), 'replica')
+
+    def test_without_replicas(self):
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.request(user=self.alice), databases.PRIMARY)
+            client = APIClient()
+            client.force_authenticate(self.alice)
+            self.assertEqual(client.get('/api/emails/inbox/').status_code, 200)
+
+
+class BulkStoreTests(LocalServicesTestCase):
+
+    def build(self, uid):
+        return _build_message(self.bound, uid, make_raw(uid, b'P' * 50), [])
+
+    def test_duplicate_uids_are_not_new(self):
+        # 另一个 worker 已经存下 UID 1；本批的 UID 1 和重复的 UID 2 都不能再挂附件、计数和变更
+        self.bound = self.bind_account()
+        first = bulk_store(self.bound, [self.build(1)], 1)
+        last_seq = changes_since(self.alice.id, 0)[1]
+        with mock.patch('mail.imap_sync.notify_users') as notify:
+            new_ids = bulk_store(self.bound, [self.build(1), self.build(2), self.build(2)], 2)
+        self.assertEqual(len(new_ids), 1)
+        self.assertNotIn(first[0], new_ids)
+        self.assertEqual(notify.call_args[0][1]['count'], 1)
+        self.assertEqual(Email.objects.filter(external_account=self.bound).count(), 2)
+        self.assertEqual(Attachment.objects.filter(email_id=first[0]).count(), 1)
+        self.assertEqual(Attachment.objects.filter(email_id=new_ids[0]).count(), 1)
+        # 两封邮件附件内容相同，共用一个 blob
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+        self.assertEqual(get_counters(self.alice.id)['external']['total'], 2)
+        self.assertEqual(reconcile_counters(), 0)
+        changes = changes_since(self.alice.id, last_seq)[0]
+        self.assertEqual([c['email_id'] for c in changes], new_ids)
+
+
+class UidValidityTests(LocalServicesTestCase):
+
+    def test_reset_cleans_up_like_a_delete(self):
+        bound = self.bind_account()
+        fake = FakeIMAP({uid: make_raw(uid) for uid in (1, 2, 3)})
+        with mock.patch('mail.imap_sync.open_imap', return_value=fake):
+            sync_account(bound)
+        ids = list(Email.objects.filter(external_account=bound).values_list('id', flat=True))
+        search.index_emails(ids)
+        get_counters(self.alice.id)
+        PendingExpunge.objects.create(account=bound, uid=2)
+        last_seq = changes_since(self.alice.id, 0)[1]
+
+        bound.refresh_from_db()
+        check_uid_validity(bound, bound.uid_validity + 1)
+        self.assertFalse(Email.objects.filter(external_account=bound).exists())
+        self.assertEqual(get_counters(self.alice.id)['external'], {'total': 0, 'unread': 0})
+        self.assertEqual(reconcile_counters(), 0)
+        self.assertEqual(search.search_emails(self.alice, 'msg'), [])
+        changes = changes_since(self.alice.id, last_seq)[0]
+        self.assertEqual(sorted(c['email_id'] for c in changes if c['kind'] == 'deleted'), sorted(ids))
+        # 旧 UID 在新的 UIDVALIDITY 下无意义，不能再推送删除
+        self.assertFalse(PendingExpunge.objects.exists())
+        self.assertFalse(RawMessage.objects.filter(account=bound).exists())
+        bound.refresh_from_db()
+        self.assertEqual(bound.last_uid, 0)
+
+
+class NewMailNotificationTests(LocalServicesTestCase):
+
+    def sync(self, bound, fake):
+        # 返回 (提交前的 new_mail 通知, 提交后的 new_mail 通知)
+        with mock.patch('mail.notify.coalescer') as coalescer, \
+                mock.patch('mail.imap_sync.open_imap', return_value=fake):
+            with self.captureOnCommitCallbacks() as callbacks:
+                sync_account(bound)
+            before = coalescer.add.call_args_list[:]
+            for callback in callbacks:
+                callback()
+        new_mail = lambda calls: [c.args for c in calls if c.args[1]['type'] == 'new_mail']
+        return new_mail(before), new_mail(coalescer.add.call_args_list)
+
+    def test_sync_notifies_after_commit(self):
+        bound = self.bind_account()
+        fake = FakeIMAP({uid: make_raw(uid) for uid in (1, 2, 3)})
+        before, events = self.sync(bound, fake)
+        self.assertEqual(before, [])
+        # 一批新邮件合并为一条通知
+        self.assertEqual(events, [([self.alice.id], {
+            'type': 'new_mail', 'subject': 'msg 3', 'from_email': 'x@ext.com', 'count': 3})])
+        # 没有新邮件时不通知
+        self.assertEqual(self.sync(bound, fake), ([], []))
+
+
+@override_settings(CACHES=LOCAL_CACHES, CHANNEL_LAYERS=LOCAL_CHANNEL_LAYERS)
+class CoalescerTests(TransactionTestCase):
+    new_mail = {'type': 'new_mail', 'subject': 's', 'from_email': 'x@ext.com'}
+
+    def setUp(self):
+        caches['default'].clear()
+        self.alice = User.objects.create_user('alice', 'alice@ymail.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@ymail.com', 'pw')
+
+    @override_settings(NOTIFY_COALESCE_WINDOW=60)
+    def test_window_merges_until_flush(self):
+        coalescer = Coalescer()
+        with mock.patch('mail.notify._deliver') as deliver:
+            coalescer.add([self.alice.id, self.bob.id], self.new_mail)
+            coalescer.add([self.alice.id], dict(self.new_mail, subject='last'))
+            coalescer.add([self.alice.id], {'type': 'counters'})
+            # 窗口未结束前不发送
+            deliver.assert_not_called()
+            coalescer.flush()
+        pending = deliver.call_args.args[0]
+        self.assertEqual(len(pending[(self.alice.id, 'new_mail')]), 2)
+        self.assertEqual(set(pending), {(self.alice.id, 'new_mail'), (self.bob.id, 'new_mail'),
+                                        (self.alice.id, 'counters')})
+        self.assertIsNone(coalescer._timer)
+        # 窗口已清空，再次 flush 不重复发送
+        with mock.patch('mail.notify._deliver') as deliver:
+            coalescer.flush()
+        deliver.assert_not_called()
+
+    @override_settings(NOTIFY_COALESCE_WINDOW=0.05)
+    def test_timer_flushes_window(self):
+        sent = threading.Event()
+        with mock.patch('mail.notify._executor') as executor:
+            executor.submit.side_effect = lambda fn, pending: sent.set()
+            Coalescer().add([self.alice.id], self.new_mail)
+            self.assertTrue(sent.wait(2))
+
+    @override_settings(NOTIFY_COALESCE_WINDOW=0)
+    def test_zero_window_sends_immediately(self):
+        with mock.patch('mail.notify._executor') as executor:
+            Coalescer().add([self.alice.id], self.new_mail)
+        executor.submit.assert_called_once()
+
+    def test_flush_at_exit(self):
+        # 一次性命令结束时发送窗口中的事件，不依赖守护线程上的定时器
+        with mock.patch('mail.notify.coalescer') as coalescer:
+            call_command('sync_imap', stdout=io.StringIO())
+        coalescer.flush.assert_called_once()
+
+    def test_only_online_users_receive(self):
+        presence.mark_online(self.alice.id)
+        layer = get_channel_layer()
+
+        async def session():
+            alice = await layer.new_channel()
+            bob = await layer.new_channel()
+            await layer.group_add('user_alice', alice)
+            await layer.group_add('user_bob', bob)
+            await sync_to_async(_deliver)({
+                (self.alice.id, 'new_mail'): [self.new_mail, dict(self.new_mail, subject='last')],
+                (self.bob.id, 'new_mail'): [self.new_mail],
+            })
+            received = await asyncio.wait_for(layer.receive(alice), 1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(bob), 0.1)
+            return received
+
+        self.assertEqual(asyncio.run(session()), dict(self.new_mail, subject='last', count=2))
+
+
+@mock.patch('mail.notify.coalescer', mock.Mock())
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHES=LOCAL_CACHES, CHANNEL_LAYERS=LOCAL_CHANNEL_LAYERS)
+class ImapIdleTests(TransactionTestCase):
+    # 同步在另一个线程中执行，需要真实提交
+
+    def setUp(self):
+        caches['default'].clear()
+        self.alice = User.objects.create_user('alice', 'alice@ymail.com', 'pw')
+
+    def bind(self, port):
+        return BoundEmailAccount.objects.create(
+            user=self.alice, email_address='alice@example.com',
+            smtp_server='smtp.example.com', smtp_port=465, use_ssl=False,
+            imap_server='127.0.0.1', imap_port=port, password_encrypted=encrypt('pw'))
+
+    def test_idle_exchange(self):
+        wire = IMAPWire(FakeIMAP({1: make_raw(1)}), ['exists', None])
+
+        async def session():
+            client = IdleClient(await sync_to_async(self.bind)(await wire.start()))
+            await client.connect()
+            status = await client.select()
+            has_new = await client.idle()
+            timed_out = await client.idle(timeout=0.05)
+            await client.close()
+            wire.server.close()
+            return client, status, has_new, timed_out
+
+        client, status, has_new, timed_out = asyncio.run(session())
+        self.assertIn('UIDPLUS', client.capabilities)
+        self.assertEqual((status, client.exists), ((7, 2), 1))
+        self.assertEqual((has_new, timed_out), (True, False))
+        # 两次 IDLE 都以 DONE 结束
+        self.assertEqual(wire.commands[3:], ['IDLE', 'DONE', 'IDLE', 'DONE', 'LOGOUT'])
+
+    @mock.patch('mail.imap_idle.RECONNECT_MIN_DELAY', 0.01)
+    @mock.patch('mail.imap_idle.RECONNECT_MAX_DELAY', 0.04)
+    def test_watch_syncs_on_session_and_backs_off(self):
+        fake = FakeIMAP({1: make_raw(1)})
+        arrive = lambda: fake.messages.update({2: make_raw(2)}) or 'exists'
+        wire = IMAPWire(fake, [arrive, 'close'])
+
+        async def session(logs):
+            bound = await sync_to_async(self.bind)(await wire.start())
+            task = asyncio.create_task(watch_account(bound.id))
+            for _ in range(200):
+                if len(logs.records) >= 4:
+                    break
+                await asyncio.sleep(0.02)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            wire.server.close()
+
+        # 同步复用 IDLE 所在的会话，不另外登录
+        with mock.patch('mail.imap_sync.open_imap', side_effect=AssertionError), \
+                self.assertLogs('mail.imap_idle', 'ERROR') as logs:
+            asyncio.run(session(logs))
+        self.assertEqual(sorted(Email.objects.values_list('external_uid', flat=True)), ['1', '2'])
+        self.assertEqual(wire.commands.count('DONE'), 1)
+        self.assertIn('UID FETCH 2:* (UID RFC822.SIZE)', wire.commands)
+        # 成功同步后从最小间隔开始退避，之后每次翻倍直到上限
+        self.assertEqual([r.args[1] for r in logs.records[:4]], [0.01, 0.02, 0.04, 0.04])
+
+
+class EnvelopeSyncTests(LocalServicesTestCase):
+    # 信封模式：同步时只取 ENVELOPE / BODYSTRUCTURE，正文和附件在首次访问时拉取
+
+    def setUp(self):
+        super().setUp()
+        self.bound = self.bind_account()
+        self.raw = make_multipart_raw()
+        self.fake = FakeIMAP({1: self.raw}, structures={1: MULTIPART_STRUCTURE})
+        with mock.patch('mail.imap_sync.open_imap', return_value=self.fake):
+            self.new_ids = sync_account(self.bound, mode='envelope')
+        self.email = Email.objects.get()
+
+    def test_body_parts(self):
+        structure = parse_fetch([f'1 ({MULTIPART_STRUCTURE})'.encode()])[0]['BODYSTRUCTURE']
+        self.assertEqual([(p['section'], p['type'], p['encoding'], p['disposition'], p['filename'])
+                          for p in body_parts(structure)], [
+            ('1.1', 'text/plain', 'quoted-printable', '', ''),
+            ('1.2', 'text/html', 'quoted-printable', '', ''),
+            ('2', 'application/pdf', 'base64', 'attachment', '报告.pdf'),
+        ])
+
+    def test_envelope_creates_placeholders(self):
+        self.assertEqual(self.new_ids, [self.email.id])
+        self.assertEqual((self.email.subject, self.email.from_external), ('季度报告', 'Bob <bob@ext.com>'))
+        self.assertEqual((self.email.body, self.email.body_fetched, self.email.is_read), ('', False, False))
+        self.assertEqual(self.email.imap_body_parts,
+                         [{'section': '1.1', 'encoding': 'quoted-printable', 'charset': 'utf-8'}])
+        attachment = Attachment.objects.get(email=self.email)
+        self.assertTrue(attachment.is_placeholder)
+        self.assertIsNone(attachment.blob_id)
+        self.assertEqual((attachment.filename, attachment.imap_section, attachment.imap_encoding,
+                          attachment.size), ('报告.pdf', '2', 'base64', 1400))
+        # 同步阶段没有下载任何正文
+        self.assertFalse([args for command, args in self.fake.calls if 'BODY.PEEK' in args[-1]])
+
+    def test_first_open_fetches_body(self):
+        url = f'/api/emails/{self.email.id}/'
+        self.fake.calls.clear()
+        with mock.patch('mail.imap_sync.open_imap', return_value=self.fake):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['body'], '第三季度的报告见附件。\n')
+            self.assertTrue(response.data['body_fetched'])
+            self.assertEqual(self.fake.calls, [('FETCH', ('1', '(UID BODY.PEEK[1.1])'))])
+            # 之后的打开直接读库
+            self.client.get(url)
+        self.assertEqual(len(self.fake.calls), 1)
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.snippet, '第三季度的报告见附件。')
+        # 正文拉取后写入搜索索引
+        self.assertEqual([r[0] for r in search.search_emails(self.alice, '第三季度')], [self.email.id])
+
+    @override_settings(IMAP_STREAM_CHUNK_SIZE=256)
+    def test_placeholder_download(self):
+        attachment = Attachment.objects.get(email=self.email)
+        with mock.patch('mail.imap_sync.open_imap', return_value=self.fake):
+            response = self.client.get(f'/api/attachments/{attachment.id}/download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), PDF_DATA)
+        attachment.refresh_from_db()
+        self.assertFalse(attachment.is_placeholder)
+
+
+class ImapFetchTests(LocalServicesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bound = self.bind_account()
+
+    def sync(self, fake, **kwargs):
+        fake.calls.clear()
+        with mock.patch('mail.imap_sync.open_imap', return_value=fake):
+            new_ids = sync_account(self.bound, **kwargs)
+        fetches = [args for command, args in fake.calls if command == 'FETCH']
+        self.assertNotIn('SEARCH', [command for command, _ in fake.calls])
+        return new_ids, fetches
+
+    def test_batches(self):
+        self.assertEqual(list(_fetch_batches([(1, 10), (2, 10), (3, 10)], 2, 100, 50)),
+                         [[(1, 10), (2, 10)], [(3, 10)]])
+        self.assertEqual(list(_fetch_batches([(1, 30), (2, 30), (3, 30)], 10, 70, 50)),
+                         [[(1, 30), (2, 30)], [(3, 30)]])
+        # 流式拉取的大邮件不计入字节数
+        self.assertEqual(list(_fetch_batches([(1, 40), (2, 500), (3, 40)], 10, 50, 50)),
+                         [[(1, 40), (2, 500)], [(3, 40)]])
+
+    def test_one_fetch_per_batch(self):
+        fake = FakeIMAP({uid: make_raw(uid) for uid in [*range(1, 26), 40]})
+        new_ids, fetches = self.sync(fake, batch_size=10)
+        self.assertEqual(len(new_ids), 26)
+        # 一条 FETCH 取大小，之后每批一条 FETCH 取正文和标记
+        self.assertEqual(fetches, [
+            ('1:*', '(UID RFC822.SIZE)'),
+            ('1:10', '(UID FLAGS INTERNALDATE BODY.PEEK[])'),
+            ('11:20', '(UID FLAGS INTERNALDATE BODY.PEEK[])'),
+            ('21:25,40', '(UID FLAGS INTERNALDATE BODY.PEEK[])'),
+        ])
+        self.assertFalse(Email.objects.filter(is_read=False).exists())
+
+        # UIDNEXT 没有变化时不发 FETCH
+        self.assertEqual(self.sync(fake), ([], []))
+        fake.messages[41] = make_raw(41)
+        new_ids, fetches = self.sync(fake)
+        self.assertEqual(len(new_ids), 1)
+        self.assertEqual(fetches, [('41:*', '(UID RFC822.SIZE)'),
+                                   ('41', '(UID FLAGS INTERNALDATE BODY.PEEK[])')])
+
+    def test_byte_cap(self):
+        fake = FakeIMAP({uid: make_raw(uid) for uid in range(1, 6)})
+        size = max(len(raw) for raw in fake.messages.values())
+        with self.settings(IMAP_FETCH_BATCH_BYTES=2 * size):
+            new_ids, fetches = self.sync(fake)
+        self.assertEqual(len(new_ids), 5)
+        self.assertEqual([spec for spec, _ in fetches[1:]], ['1:2', '3:4', '5'])
+
+    @override_settings(IMAP_STREAM_THRESHOLD=5000, IMAP_STREAM_CHUNK_SIZE=4096)
+    def test_large_messages_streamed(self):
+        fake = FakeIMAP({1: make_raw(1), 2: make_raw(2, b'B' * 20000), 3: make_raw(3)})
+        new_ids, fetches = self.sync(fake)
+        self.assertEqual(len(new_ids), 3)
+        self.assertEqual(fetches[1], ('1,3', '(UID FLAGS INTERNALDATE BODY.PEEK[])'))
+        # 大邮件的标记随第一段取回，之后只取正文分段
+        self.assertEqual(fetches[2], ('2', '(UID FLAGS INTERNALDATE BODY.PEEK[]<0.4096>)'))
+        self.assertTrue(all(items.startswith('(BODY.PEEK[]<') for _, items in fetches[3:]))
+        email = Email.objects.get(external_uid='2')
+        self.assertTrue(email.is_read)
+        with email.attachments.get().file.open('rb') as f:
+            self.assertEqual(f.read(), b'B' * 20000)
+
+    def test_empty_mailbox(self):
+        new_ids, fetches = self.sync(FakeIMAP({}))
+        self.assertEqual((new_ids, fetches), ([], []))
 
-# Create your tests here.
@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from mail.blobs import adopt_blob, attach_blob
+from mail.models import Blob, UploadSession
+
+logger = logging.getLogger(__name__)
+
+# 从请求体读取的块大小
+READ_SIZE = 64 * 1024
+# 持有写锁超过该时间的请求视为已中断
+UPLOAD_LOCK_TIMEOUT = timedelta(minutes=10)
+# 超过该时间没有新分片的会话由 gc_blobs 清理
+UPLOAD_SESSION_TTL = timedelta(hours=24)
+# 进程内保留的增量哈希状态数
+HASHER_CACHE_SIZE = 256
+
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    def __init__(self, message, status, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def max_upload_size():
+    return getattr(settings, "ATTACHMENT_MAX_SIZE", 200 * 1024 * 1024)
+
+
+def _path(session):
+    return Blob.file.field.storage.path(session.part_name)
+
+
+def _take_hasher(session, offset):
+    # 同一进程连续收到的分片沿用上次的哈希状态；否则（换了 worker 或进程重启）补算已写入部分
+    with _hashers_lock:
+        entry = _hashers.pop(session.token, None)
+    if entry is not None and entry[0] == offset:
+        return entry[1]
+    hasher = hashlib.sha256()
+    remaining = offset
+    with open(_path(session), "rb") as f:
+        while remaining > 0:
+            data = f.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher
+
+
+def _keep_hasher(session, offset, hasher):
+    with _hashers_lock:
+        _hashers[session.token] = (offset, hasher)
+        while len(_hashers) > HASHER_CACHE_SIZE:
+            _hashers.popitem(last=False)
+
+
+def _forget_hasher(session):
+    with _hashers_lock:
+        _hashers.pop(session.token, None)
+
+
+def start(user, email_obj, filename, size, sha256=""):
+    # 声明的大小超过上限时直接拒绝，不接收任何数据
+    if size < 0:
+        raise UploadError("文件大小无效", 400)
+    if size > max_upload_size():
+        raise UploadError("附件超过大小限制", 413)
+    session = UploadSession.objects.create(
+        user=user, email=email_obj, filename=filename, size=size, sha256=sha256.lower())
+    path = _path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    return session
+
+
+def _claim(session, offset):
+    stale = timezone.now() - UPLOAD_LOCK_TIMEOUT
+    return UploadSession.objects.filter(pk=session.pk, received=offset).filter(
+        Q(locked_at__isnull=True) | Q(locked_at__lt=stale),
+    ).update(locked_at=timezone.now()) == 1
+
+
+def _current_offset(session):
+    return UploadSession.objects.filter(pk=session.pk).values_list(
+        "received", flat=True).first()
+
+
+def write_chunk(session, offset, stream, length=None):
+    # 从 offset 开始把请求体直接写入存储中的临时文件，同时更新哈希；
+    # 连接中断时保留已写入的部分，客户端从新的 offset 续传
+    if offset != session.received:
+        raise UploadError("偏移量不匹配", 409, offset=session.received)
+    remaining = session.size - offset
+    if length is not None and length > remaining:
+        raise UploadError("超出声明的文件大小", 413, offset=offset)
+    if not _claim(session, offset):
+        raise UploadError("该上传正在写入", 409, offset=_current_offset(session))
+
+    hasher = _take_hasher(session, offset)
+    written = 0
+    try:
+        with open(_path(session), "r+b") as f:
+            f.seek(offset)
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                if written + len(data) > remaining:
+                    raise UploadError("超出声明的文件大小", 413)
+                f.write(data)
+                hasher.update(data)
+                written += len(data)
+    finally:
+        session.received = offset + written
+        UploadSession.objects.filter(pk=session.pk).update(
+            received=session.received, locked_at=None, updated_at=timezone.now())
+        _keep_hasher(session, session.received, hasher)
+    return session.received
+
+
+def finish(session):
+    # 校验大小和哈希后把临时文件改名为 blob，创建附件
+    if session.received != session.size:
+        raise UploadError("上传未完成", 409, offset=session.received)
+    if not _claim(session, session.size):
+        raise UploadError("该上传正在处理", 409, offset=session.received)
+    try:
+        hasher = _take_hasher(session, session.size)
+        digest = hasher.hexdigest()
+        if session.sha256 and session.sha256 != digest:
+            abort(session)
+            raise UploadError("文件校验和不匹配", 422)
+        blob = adopt_blob(session.part_name, digest, session.size)
+        attachment = attach_blob(session.email, blob, session.filename)
+    except Exception:
+        UploadSession.objects.filter(pk=session.pk).update(locked_at=None)
+        raise
+    _forget_hasher(session)
+    session.delete()
+    return attachment
+
+
+def abort(session):
+    _forget_hasher(session)
+    Blob.file.field.storage.delete(session.part_name)
+    session.delete()
+
+
+def expire_uploads(ttl=UPLOAD_SESSION_TTL):
+    # 删除长时间没有进展的会话及其临时文件，返回数量
+    expired = 0
+    for session in UploadSession.objects.filter(updated_at__lt=timezone.now() - ttl).iterator():
+        abort(session)
+        expired += 1
+    return expired
@@ -1,7 +1,7 @@
 from django.conf.urls.static import static
 from django.conf import settings
 from django.urls import path
-from .views import DownloadAttachmentView, UploadAttachmentView, BindExternalEmailAccountView, GetEmailDetailView, ListEmailView, SendEmailByPosifixView, FetchExternalInboxView, RegisterUserView, LoginUserView, SendEmailWithBoundAccountView, ListSentEmailView
+from .views import DownloadAttachmentView, UploadAttachmentView, BindExternalEmailAccountView, GetEmailDetailView, ListEmailView, SendEmailByPosifixView, FetchExternalInboxView, RegisterUserView, LoginUserView, SendEmailWithBoundAccountView, ListSentEmailView, SearchEmailView, OutboundMessageDetailView, MailboxCountersView, BulkMailboxView, UploadSessionCreateView, UploadSessionView, UploadSessionCompleteView
 from rest_framework_simplejwt.views import TokenRefreshView
 
 
@@ -12,11 +12,22 @@ urlpatterns = [
     path('emails/inbox/', ListEmailView.as_view(), name='email-inbox'),
     path('emails/sent/', ListSentEmailView.as_view(), name='email-sent'),
     path('emails/send/', SendEmailByPosifixView.as_view(), name='email-send'),
+    path('emails/search/', SearchEmailView.as_view(), name='email-search'),
+    path('emails/counters/', MailboxCountersView.as_view(), name='email-counters'),
+    path('emails/bulk/<str:action>/', BulkMailboxView.as_view(), name='email-bulk'),
+    path('emails/outbox/<int:message_id>/',
+         OutboundMessageDetailView.as_view(), name='outbox-detail'),
     path('emails/<int:email_id>/',
          GetEmailDetailView.as_view(), name='email-detail'),
 
     path('emails/<int:email_id>/attachments/upload/',
          UploadAttachmentView.as_view(), name='upload-attachment'),
+    path('emails/<int:email_id>/attachments/uploads/',
+         UploadSessionCreateView.as_view(), name='upload-session-create'),
+    path('attachments/uploads/<uuid:token>/',
+         UploadSessionView.as_view(), name='upload-session'),
+    path('attachments/uploads/<uuid:token>/complete/',
+         UploadSessionCompleteView.as_view(), name='upload-session-complete'),
     path('attachments/<int:attachment_id>/download/',
          DownloadAttachmentView.as_view(), name='attachment-download'),
 
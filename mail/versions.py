@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+import time
+
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.response import Response
+
+from mail.databases import pin_primary
+
+logger = logging.getLogger(__name__)
+
+# 每个用户一个邮箱版本号，保存在共享缓存中；影响该用户邮件列表的写入提交后让它失效。
+# 版本号参与 ETag 和列表缓存 key，旧版本的缓存不会再被命中，只等 LRU 淘汰
+PAGE_CACHE_ALIAS = "mailbox_pages"
+
+
+def _key(user_id):
+    return f"mail:mailbox-version:{user_id}"
+
+
+def get_version(user_id):
+    # 缓存中没有时生成新值：失效后取到的版本号不会与之前的重复。缓存不可用时返回 None
+    key = _key(user_id)
+    try:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, time.time_ns(), None)
+            version = cache.get(key)
+    except Exception as e:
+        logger.warning("邮箱版本号读取失败，跳过列表缓存: %s", e)
+        return None
+    return version
+
+
+def _invalidate(user_ids):
+    # 副本追上之前这些用户读主库，否则可能把旧数据缓存到新版本号下
+    pin_primary(user_ids)
+    try:
+        cache.delete_many([_key(user_id) for user_id in user_ids])
+    except Exception:
+        logger.exception("邮箱版本号失效失败")
+
+
+def bump_versions(user_ids):
+    # 事务提交后一次 delete_many 让这些用户的版本号失效
+    user_ids = list(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: _invalidate(user_ids))
+
+
+def cached_listing(request, scope, build):
+    # 邮件列表的条件 GET：版本号未变时 If-None-Match 直接返回 304，
+    # 否则按 (用户, 版本, 过滤条件, 游标) 读取缓存的序列化结果，未命中才调用 build
+    version = get_version(request.user.id)
+    if version is None:
+        return build()
+    params = sorted(request.query_params.lists())
+    digest = hashlib.sha256(json.dumps(
+        [scope, request.get_host(), params]).encode()).hexdigest()[:32]
+    etag = quote_etag(f"{request.user.id}-{version}-{digest}")
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+        return Response(status=304, headers=headers)
+
+    page_cache = caches[PAGE_CACHE_ALIAS]
+    key = f"mail:page:{request.user.id}:{version}:{digest}"
+    data = page_cache.get(key)
+    if data is None:
+        response = build()
+        if response.status_code != 200:
+            return response
+        data = response.data
+        page_cache.set(key, data)
+    return Response(data, headers=headers)
@@ -1,26 +1,35 @@
-from django.utils import timezone
-from email.message import EmailMessage
-import email
 from email.header import decode_header
-from email.utils import parsedate_to_datetime
+from email.utils import getaddresses
 import imaplib
 import os
-import smtplib
-from django.http import FileResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, permissions
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.core.files.base import ContentFile
-from mail.utils import decrypt, encrypt, safe_decode_header, send_smtp_email
-from .serializers import RegisterSerializer, LoginSerializer, EmailSerializer
+from rest_framework.utils.urls import replace_query_param
+from mail.utils import decrypt, encrypt
+from .serializers import RegisterSerializer, LoginSerializer, EmailSerializer, EmailSummarySerializer, AttachmentSerializer, OutboundMessageSerializer
+from .pagination import InboxPagination, KeysetPagination
+from .search import index_emails, search_emails
+from .blobs import attach_blob, copy_attachments, fetch_placeholders, store_blob
+from .fanout import deliver_internal, resolve_recipients
+from .counters import adjust, get_counters, mailbox_deltas
+from .versions import bump_versions, cached_listing
+from . import bulk
+from .notify import notify_users
+from .outbox import enqueue
+from .smtp_pool import smtp_pool, tls_mode
+from .mime_writer import compose, send_streaming
+from .imap_sync import fetch_attachment, fetch_email_body
+from .downloads import serve_file
+from . import uploads
 from django.contrib.auth import get_user_model
-from .models import Attachment, BoundEmailAccount, Email
+from .models import Attachment, BoundEmailAccount, Email, OutboundMessage, Recipient, UploadSession
 from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAuthenticated
 from django.utils.timezone import now
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
 User = get_user_model()
 
 
@@ -50,7 +59,21 @@ class ListEmailView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
-        qs = Email.objects.filter(recipients=request.user)
+        # 轮询时邮箱没有变化只需一次缓存查询
+        return cached_listing(request, 'inbox', lambda: self.list(request))
+
+    def list(self, request):
+        folder = request.query_params.get('folder', Recipient.FOLDER_INBOX)
+        if folder not in bulk.FOLDERS:
+            return Response({'error': '未知的文件夹'}, status=400)
+        # 已读状态取当前用户自己的收件记录
+        qs = EmailSummarySerializer.setup_eager_loading(
+            Email.objects.filter(recipient_states__user=request.user,
+                                 recipient_states__folder=folder)
+        ).annotate(recipient_is_read=F('recipient_states__is_read'),
+                   recipient_folder=F('recipient_states__folder'),
+                   recipient_sent_at=F('recipient_states__sent_at'),
+                   recipient_email_id=F('recipient_states__email_id'))
 
         sender = request.query_params.get('sender')
         subject = request.query_params.get('subject')
@@ -60,28 +83,36 @@ class ListEmailView(APIView):
         if subject:
             qs = qs.filter(subject__icontains=subject)
 
-        qs = qs.order_by('-sent_at')
-        serializer = EmailSerializer(qs, many=True)
-        return Response(serializer.data)
+        paginator = InboxPagination()
+        page = paginator.paginate_queryset(qs, request, view=self)
+        serializer = EmailSummarySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class ListSentEmailView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
-        qs = Email.objects.filter(from_user=request.user)
+        return cached_listing(request, 'sent', lambda: self.list(request))
+
+    def list(self, request):
+        qs = EmailSummarySerializer.setup_eager_loading(
+            Email.objects.filter(from_user=request.user), request.user)
 
         recipient = request.query_params.get('recipient')
         subject = request.query_params.get('subject')
 
         if recipient:
-            qs = qs.filter(recipients__username__icontains=recipient)
+            # 用 EXISTS 而不是 JOIN + DISTINCT，保持按 (from_user, sent_at, id) 索引顺序读取
+            qs = qs.filter(Exists(Recipient.objects.filter(
+                email=OuterRef('pk'), user__username__icontains=recipient)))
         if subject:
             qs = qs.filter(subject__icontains=subject)
 
-        qs = qs.order_by('-sent_at')
-        serializer = EmailSerializer(qs.distinct(), many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(qs, request, view=self)
+        serializer = EmailSummarySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 # class EmailCreateView(APIView):
@@ -111,11 +142,121 @@ class UploadAttachmentView(APIView):
         if not file:
             return Response({"error": "No file provided"}, status=400)
 
-        attachment = Attachment.objects.create(
-            email=email,
-            file=file,
-            filename=file.name
-        )
+        # 上传时已计算 SHA-256，相同内容只保存一份
+        attachment = attach_blob(email, store_blob(file), file.name)
+        index_emails([email.id])
+        # 列表中的附件数变化
+        bump_versions([email.from_user_id, *email.recipients.values_list('id', flat=True)])
+        return Response(AttachmentSerializer(attachment, context={"request": request}).data,
+                        status=status.HTTP_201_CREATED)
+
+
+def _int_param(request, name, default, lo, hi=None):
+    # 与 KeysetPagination.get_page_size 相同：非法值用默认值，越界值截到范围内
+    try:
+        value = int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+    value = max(value, lo)
+    return min(value, hi) if hi is not None else value
+
+
+def _upload_state(session):
+    return {"upload_id": str(session.token), "offset": session.received, "size": session.size}
+
+
+def _upload_error(e):
+    data = {"error": str(e)}
+    if e.offset is not None:
+        data["offset"] = e.offset
+    return Response(data, status=e.status)
+
+
+class UploadSessionCreateView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    # 分片上传第一步：声明文件名、大小（可选 sha256），返回 upload_id
+    def post(self, request, email_id):
+        try:
+            email = Email.objects.get(id=email_id, from_user=request.user)
+        except Email.DoesNotExist:
+            return Response({"error": "Email not found or permission denied"}, status=404)
+
+        filename = request.data.get("filename")
+        try:
+            size = int(request.data.get("size"))
+        except (TypeError, ValueError):
+            return Response({"error": "size 必须是整数"}, status=400)
+        if not filename:
+            return Response({"error": "文件名不能为空"}, status=400)
+
+        try:
+            session = uploads.start(request.user, email, filename, size,
+                                    request.data.get("sha256") or "")
+        except uploads.UploadError as e:
+            return _upload_error(e)
+        return Response(_upload_state(session), status=status.HTTP_201_CREATED)
+
+
+class UploadSessionView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_session(self, request, token):
+        return UploadSession.objects.filter(token=token, user=request.user).first()
+
+    def get(self, request, token):
+        # 续传前查询服务器已收到的字节数
+        session = self.get_session(request, token)
+        if session is None:
+            return Response({"error": "上传不存在或已过期"}, status=404)
+        return Response(_upload_state(session))
+
+    def put(self, request, token):
+        # 请求体为原始字节，Upload-Offset 头（或 ?offset=）给出起始偏移；不经过上传处理器
+        session = self.get_session(request, token)
+        if session is None:
+            return Response({"error": "上传不存在或已过期"}, status=404)
+        try:
+            offset = int(request.headers.get("Upload-Offset", request.query_params.get("offset", "")))
+        except ValueError:
+            return Response({"error": "缺少 Upload-Offset"}, status=400)
+        length = request.headers.get("Content-Length")
+
+        try:
+            uploads.write_chunk(session, offset, request._request,
+                                int(length) if length else None)
+        except uploads.UploadError as e:
+            return _upload_error(e)
+        except OSError:
+            # 客户端断开，已写入的部分保留
+            return Response({"error": "上传中断", "offset": session.received}, status=400)
+        return Response(_upload_state(session))
+
+    def delete(self, request, token):
+        session = self.get_session(request, token)
+        if session is None:
+            return Response({"error": "上传不存在或已过期"}, status=404)
+        uploads.abort(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionCompleteView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, token):
+        session = UploadSession.objects.select_related("email").filter(
+            token=token, user=request.user).first()
+        if session is None:
+            return Response({"error": "上传不存在或已过期"}, status=404)
+        try:
+            attachment = uploads.finish(session)
+        except uploads.UploadError as e:
+            return _upload_error(e)
+        email = session.email
+        index_emails([email.id])
+        bump_versions([email.from_user_id, *email.recipients.values_list('id', flat=True)])
+        return Response(AttachmentSerializer(attachment, context={"request": request}).data,
+                        status=status.HTTP_201_CREATED)
 
 
 class DownloadAttachmentView(APIView):
@@ -125,7 +266,7 @@ class DownloadAttachmentView(APIView):
         try:
             # 查询附件对象
             attachment = Attachment.objects.select_related(
-                "email__from_user").get(pk=attachment_id)
+                "email__from_user", "email__external_account", "blob").get(pk=attachment_id)
         except Attachment.DoesNotExist:
             return Response(
                 {"detail": f"Attachment with id {attachment_id} not found."},
@@ -138,6 +279,15 @@ class DownloadAttachmentView(APIView):
         ):
             return Response({"detail": "Permission denied."}, status=status.HTTP_403_FORBIDDEN)
 
+        if attachment.is_placeholder:
+            try:
+                fetch_attachment(attachment)
+            except Exception as e:
+                return Response(
+                    {"detail": f"Failed to fetch attachment from IMAP: {str(e)}"},
+                    status=status.HTTP_502_BAD_GATEWAY
+                )
+
         file_path = attachment.file.path
         if not os.path.exists(file_path):
             return Response(
@@ -146,7 +296,9 @@ class DownloadAttachmentView(APIView):
             )
 
         try:
-            return FileResponse(open(file_path, 'rb'), as_attachment=True, filename=attachment.filename)
+            # 内容寻址的附件直接用 sha256 作为强 ETag
+            return serve_file(request, file_path, attachment.filename,
+                              etag=attachment.blob.sha256 if attachment.blob_id else None)
         except Exception as e:
             return Response(
                 {"detail": f"Unexpected error while opening file: {str(e)}"},
@@ -170,56 +322,106 @@ class SendEmailByPosifixView(APIView):
         if not recipients:
             return Response({'error': '收件人不能为空'}, status=400)
 
-        internal_users = User.objects.filter(email__in=recipients)
-        internal_emails = set(u.email for u in internal_users)
-        external_emails = set(recipients) - internal_emails
+        # 分发列表地址展开为成员，展开结果有缓存
+        user_ids, external_emails = resolve_recipients(recipients)
 
         attachments = []
         for att_id in attachment_ids:
             try:
-                att = Attachment.objects.get(pk=att_id)
-                attachments.append((att.file.path, att.filename))
+                attachments.append(Attachment.objects.get(pk=att_id))
             except Attachment.DoesNotExist:
                 continue
 
-        if internal_users.exists():
-            email_obj = Email.objects.create(
-                from_user=request.user,
-                subject=subject,
-                body=body,
-                is_internal=True
-            )
-            email_obj.recipients.set(internal_users)
-            for att_path, filename in attachments:
-                Attachment.objects.create(
-                    email=email_obj, file=att_path, filename=filename)
-
-            channel_layer = get_channel_layer()
-            for user in internal_users:
-                async_to_sync(channel_layer.group_send)(
-                    f"user_{user.username}",  # 与 MailConsumer 中 group 名称对应
-                    {
-                        "type": "new_mail",
-                        "subject": subject,
-                        "from_email": request.user.email,
-                    }
-                )
-
-        if external_emails:
+        if user_ids:
+            # 占位附件在事务之外拉取，不在 IMAP 往返期间占着写锁
             try:
-                send_smtp_email(
-                    from_user_email=request.user.email,
-                    to_external=", ".join(external_emails),
+                fetch_placeholders(attachments)
+            except Exception as e:
+                return Response({"error": f"附件拉取失败: {str(e)}"}, status=500)
+            with transaction.atomic():
+                email_obj = Email.objects.create(
+                    from_user=request.user,
                     subject=subject,
                     body=body,
-                    attachments=attachments,
+                    is_internal=True,
+                    sent_at=now()
                 )
-            except Exception as e:
-                return Response({'error': f'外部邮件发送失败: {str(e)}'}, status=500)
+                deliver_internal(email_obj, user_ids)
+                copy_attachments(attachments, email_obj)
+                index_emails([email_obj.id])
+
+            # 提交后由后台线程分批推送
+            notify_users(user_ids, {
+                "type": "new_mail",
+                "subject": subject,
+                "from_email": request.user.email,
+            })
+
+        if external_emails:
+            # 外部邮件只入队，由 send_outbox worker 投递，不在请求中等待 SMTP
+            outbound = enqueue(request.user, sorted(external_emails), subject, body, attachments)
+            return Response({
+                'message': '邮件已加入发送队列',
+                'id': outbound.id,
+                'status': outbound.status,
+            }, status=202)
 
         return Response({'message': '邮件发送成功'}, status=200)
 
 
+class MailboxCountersView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        # 读取物化的计数行，不扫描邮件表
+        return Response(get_counters(request.user.id))
+
+
+class BulkMailboxView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    # 按 ids 或 filter 选出邮件后一条 UPDATE / DELETE 完成，不逐封处理
+    def post(self, request, action):
+        data = request.data
+        ids = data.get('ids')
+        filters = data.get('filter')
+        if ids is not None:
+            try:
+                ids = [int(i) for i in ids]
+            except (TypeError, ValueError):
+                return Response({'error': 'ids 必须是邮件 id 列表'}, status=400)
+        if filters is not None and not isinstance(filters, dict):
+            return Response({'error': 'filter 必须是对象'}, status=400)
+
+        try:
+            queryset = bulk.select(request.user, data.get('mailbox', bulk.INBOX), ids, filters)
+            if action == 'read':
+                count = bulk.mark_read(request.user, queryset, True)
+            elif action == 'unread':
+                count = bulk.mark_read(request.user, queryset, False)
+            elif action == 'delete':
+                count = bulk.delete(request.user, queryset)
+            elif action == 'move':
+                count = bulk.move(request.user, queryset, data.get('folder'))
+            else:
+                return Response({'error': '不支持的操作'}, status=404)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        return Response({'count': count})
+
+
+class OutboundMessageDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, message_id):
+        try:
+            outbound = OutboundMessage.objects.prefetch_related('recipients').get(
+                pk=message_id, user=request.user)
+        except OutboundMessage.DoesNotExist:
+            return Response({'error': '发送记录不存在'}, status=404)
+        return Response(OutboundMessageSerializer(outbound).data)
+
+
 class BindExternalEmailAccountView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -246,13 +448,10 @@ class BindExternalEmailAccountView(APIView):
             return Response({"error": f"IMAP 登录失败: {str(e)}"}, status=400)
 
         try:
-            if use_ssl and smtp_port == 465:
-                smtp = smtplib.SMTP_SSL(smtp_server, smtp_port)
-            else:
-                smtp = smtplib.SMTP(smtp_server, smtp_port)
-                smtp.starttls()
-            smtp.login(email, password)
-            smtp.quit()
+            # 校验通过的会话留在连接池中，随后的发信可以直接复用
+            with smtp_pool.connection(smtp_server, smtp_port, tls_mode(use_ssl, smtp_port),
+                                      email, password):
+                pass
         except Exception as e:
             return Response({"error": f"SMTP 登录失败: {str(e)}"}, status=400)
 
@@ -276,138 +475,77 @@ class FetchExternalInboxView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
+        # 只读数据库；真正的 IMAP 拉取由 sync_imap 后台任务完成
         user = request.user
-        limit = int(request.query_params.get("limit", 10))
-        offset = int(request.query_params.get("offset", 0))
+        limit = _int_param(request, "limit", 10, 1, 100)
+        offset = _int_param(request, "offset", 0, 0)
 
         try:
             bound = BoundEmailAccount.objects.get(user=user)
         except BoundEmailAccount.DoesNotExist:
             return Response({"error": "未绑定邮箱"}, status=400)
 
-        password = decrypt(bound.password_encrypted)
+        # 查询并分页返回用户邮箱
+        qs = EmailSerializer.setup_eager_loading(Email.objects.filter(
+            from_user=user, is_internal=False)).order_by('-sent_at')
+        emails = qs[offset:offset + limit]
+        serializer = EmailSerializer(emails, many=True)
+        return Response({
+            "sync_status": bound.sync_status,
+            "last_synced_at": bound.last_synced_at,
+            "sync_error": bound.sync_error,
+            "results": serializer.data,
+        })
 
-        try:
-            if bound.use_ssl:
-                imap = imaplib.IMAP4_SSL(bound.imap_server, bound.imap_port)
-            else:
-                imap = imaplib.IMAP4(bound.imap_server, bound.imap_port)
-
-            imap.login(bound.email_address, password)
-            imap.select("INBOX")
-
-            result, data = imap.search(None, "ALL")
-            mail_ids = data[0].split()
-
-            fetched_uids = set(Email.objects.filter(
-                external_account=bound).values_list("external_uid", flat=True))
-
-            for mail_id in reversed(mail_ids):
-                uid = mail_id.decode()
-                if uid in fetched_uids:
-                    continue
-
-                result, msg_data = imap.fetch(mail_id, "(RFC822)")
-                if not msg_data or not msg_data[0] or not msg_data[0][1]:
-                    continue  # 跳过无效邮件
-
-                raw_email = msg_data[0][1]
-                msg = email.message_from_bytes(raw_email)
-
-                subject = safe_decode_header(msg["Subject"])
-                from_ = safe_decode_header(msg.get("From"))
-                date_str = msg.get("Date")
-                date_ = timezone.now()  # 默认值
-                if date_str:
-                    try:
-                        date_ = parsedate_to_datetime(date_str)
-                        if date_.tzinfo is None:  # 如果没有时区，补全 UTC
-                            date_ = date_.replace(tzinfo=timezone.utc)
-                    except Exception as e:
-                        print(f"⚠️ 解析日期失败: {date_str}, error: {e}")
-                flags = imap.fetch(mail_id, '(FLAGS)')[1][0].decode()
-                is_read = "\\Seen" in flags
-
-                body = ""
-                attachments = []
-
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        content_type = part.get_content_type()
-                        content_disposition = str(
-                            part.get("Content-Disposition"))
-                        charset = part.get_content_charset() or 'utf-8'
-
-                        if content_type == "text/plain" and "attachment" not in content_disposition:
-                            try:
-                                body += part.get_payload(decode=True).decode(
-                                    charset, errors="ignore")
-                            except Exception:
-                                body += part.get_payload(decode=True).decode(
-                                    "utf-8", errors="ignore")
-                        elif "attachment" in content_disposition:
-                            # filename = safe_decode_header(part.get_filename()) or "unknown"
-                            filename = part.get_filename()
-                            if filename:
-                                filename = safe_decode_header(filename)
-                            else:
-                                filename = "unknown"
-                            content = part.get_payload(decode=True)
-                            attachments.append((filename, content))
-                else:
-                    charset = msg.get_content_charset() or 'utf-8'
-                    try:
-                        body = msg.get_payload(decode=True).decode(
-                            charset, errors="ignore")
-                    except Exception:
-                        body = msg.get_payload(decode=True).decode(
-                            "utf-8", errors="ignore")
 
-                email_obj = Email.objects.create(
-                    from_user=user,
-                    from_external=from_,
-                    subject=subject,
-                    body=body,
-                    is_internal=False,
-                    is_read=is_read,
-                    sent_at=date_,
-                    external_uid=uid,
-                    external_account=bound
-                )
+class SearchEmailView(APIView):
+    permission_classes = [IsAuthenticated]
 
-                for filename, content in attachments:
-                    att = Attachment(
-                        email=email_obj,
-                        filename=filename
-                    )
-                    att.file.save(filename, ContentFile(content))
-                    att.save()
+    def get(self, request):
+        q = request.query_params.get("q", "").strip()
+        limit = _int_param(request, "limit", 20, 1, 100)
+        offset = _int_param(request, "offset", 0, 0)
+        if not q:
+            return Response({"error": "搜索关键词不能为空"}, status=400)
 
-            imap.logout()
+        hits = search_emails(request.user, q, limit=limit + 1, offset=offset)
+        has_next = len(hits) > limit
+        hits = hits[:limit]
 
-            # 查询并分页返回用户邮箱
-            qs = Email.objects.filter(
-                from_user=user, is_internal=False).order_by('-sent_at')
-            emails = qs[offset:offset + limit]
-            serializer = EmailSerializer(emails, many=True)
-            return Response(serializer.data)
+        ids = [email_id for email_id, _ in hits]
+        emails = EmailSummarySerializer.setup_eager_loading(
+            Email.objects.filter(id__in=ids), request.user).in_bulk(ids)
+        page = [emails[i] for i in ids if i in emails]
 
-        except Exception as e:
-            return Response({"error": f"IMAP 拉取失败: {str(e)}"}, status=500)
+        url = request.build_absolute_uri()
+        return Response({
+            "next": replace_query_param(url, "offset", offset + limit) if has_next else None,
+            "previous": replace_query_param(url, "offset", max(offset - limit, 0)) if offset else None,
+            "results": EmailSummarySerializer(page, many=True).data,
+        })
 
 
 class GetEmailDetailView(APIView):
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, pk):
+    def get(self, request, email_id):
         try:
-            email = Email.objects.prefetch_related("attachments").get(pk=pk)
+            email = EmailSerializer.setup_eager_loading(
+                Email.objects.all(), request.user).get(pk=email_id)
         except Email.DoesNotExist:
             return Response({"error": "邮件不存在"}, status=404)
 
-        if email.from_user != request.user and not email.recipients.filter(id=request.user.id).exists():
+        # 收件人列表只预取了一部分，权限按收件记录单独查询
+        if email.from_user_id != request.user.id and not Recipient.objects.filter(
+                email=email, user=request.user).exists():
             return Response({"error": "无权限查看此邮件"}, status=403)
 
+        if not email.body_fetched and email.external_account_id:
+            try:
+                fetch_email_body(email)
+            except Exception as e:
+                return Response({"error": f"IMAP 拉取失败: {str(e)}"}, status=500)
+
         serializer = EmailSerializer(email)
         return Response(serializer.data)
 
@@ -436,54 +574,44 @@ class SendEmailWithBoundAccountView(APIView):
 
         password = decrypt(bound.password_encrypted)
 
-        msg = EmailMessage()
-        msg["From"] = bound.email_address
-        msg["To"] = ", ".join(to_emails) if isinstance(
+        to_header = ", ".join(to_emails) if isinstance(
             to_emails, list) else to_emails
-        msg["Subject"] = subject
-        msg.set_content(body or "")
+        recipients = getaddresses([to_header])
 
         attachment = []
 
         for att_id in attachments_ids:
             try:
                 att = Attachment.objects.get(id=att_id, email__from_user=user)
-                with open(att.file.path, "rb") as f:
-                    file_data = f.read()
-                    msg.add_attachment(
-                        file_data, maintype="application", subtype="octet-stream", filename=att.filename)
-                attachment.append(att)
+                if os.path.exists(att.file.path):
+                    attachment.append(att)
             except Exception:
                 continue
 
+        # 附件在写入 DATA 时逐块读取并 base64 编码，不整体载入内存
+        chunks = compose(bound.email_address, to_header, subject, body,
+                         [(att.file.path, att.filename) for att in attachment])
         try:
-            if bound.use_ssl and bound.smtp_port == 465:
-                server = smtplib.SMTP_SSL(bound.smtp_server, bound.smtp_port)
-            else:
-                server = smtplib.SMTP(bound.smtp_server, bound.smtp_port)
-                server.starttls()
-
-            server.login(bound.email_address, password)
-            server.send_message(msg)
-            server.quit()
+            with smtp_pool.connection(bound.smtp_server, bound.smtp_port,
+                                      tls_mode(bound.use_ssl, bound.smtp_port),
+                                      bound.email_address, password) as server:
+                send_streaming(server, bound.email_address,
+                               [address for _, address in recipients if address], chunks)
         except Exception as e:
             return Response({"error": f"邮件发送失败: {str(e)}"}, status=500)
 
-        email_obj = Email.objects.create(
-            from_user=user,
-            subject=subject,
-            body=body or "",
-            is_internal=False,
-            sent_at=now(),
-            to_external=", ".join(to_emails) if isinstance(
-                to_emails, list) else to_emails
-        )
-
-        for att in attachment:
-            Attachment.objects.create(
-                email=email_obj,
-                file=att.file,
-                filename=att.filename
+        with transaction.atomic():
+            email_obj = Email.objects.create(
+                from_user=user,
+                subject=subject,
+                body=body or "",
+                is_internal=False,
+                sent_at=now(),
+                to_external=to_header
             )
 
+            copy_attachments(attachment, email_obj)
+            index_emails([email_obj.id])
+            adjust(mailbox_deltas(email_obj))
+
         return Response({"message": "邮件发送成功"})
@@ -0,0 +1,40 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+
+def _raw_token(scope):
+    # 浏览器 WebSocket 无法设置请求头，token 放在查询参数中；其他客户端可用 Authorization 头
+    token = parse_qs(scope.get("query_string", b"").decode()).get("token")
+    if token:
+        return token[0]
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            parts = value.decode().split()
+            if len(parts) == 2 and parts[0] == "Bearer":
+                return parts[1]
+    return None
+
+
+@database_sync_to_async
+def _user_for_token(raw):
+    auth = JWTAuthentication()
+    try:
+        return auth.get_user(auth.get_validated_token(raw))
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware:
+    # 与 REST 接口使用同一套 SimpleJWT access token，认证结果放在 scope["user"]
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        raw = _raw_token(scope)
+        user = await _user_for_token(raw) if raw else AnonymousUser()
+        return await self.inner(dict(scope, user=user), receive, send)
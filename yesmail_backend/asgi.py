@@ -9,10 +9,6 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-
-from django.core.asgi import get_asgi_application
-from mail.routing import websocket_urlpatterns
 
 from django.core.asgi import get_asgi_application
 
@@ -20,10 +16,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'yesmail_backend.settings')
 
 application = get_asgi_application()
 
+# 需要在 Django 初始化之后导入：consumer 依赖 models
+from mail.routing import websocket_urlpatterns  # noqa: E402
+from mail.ws_auth import JWTAuthMiddleware  # noqa: E402
 
 application = ProtocolTypeRouter({
     "http": application,
-    "websocket": AuthMiddlewareStack(
+    "websocket": JWTAuthMiddleware(
         URLRouter(
             websocket_urlpatterns
         )
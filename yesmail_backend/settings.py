@@ -59,6 +59,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mail.databases.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'yesmail_backend.urls'
@@ -84,11 +85,41 @@ WSGI_APPLICATION = 'yesmail_backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# 连接在请求之间复用 CONN_MAX_AGE 秒，复用前检查是否可用；
+# Postgres 多进程部署时连接数较多，可在前面加 pgbouncer 并把 CONN_MAX_AGE 设为 0
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        # 写锁被占用时等待的秒数，超时才报 database is locked
+        'OPTIONS': {'timeout': 20},
+    },
+    # 只读副本示例：
+    # 'replica1': {
+    #     'ENGINE': 'django.db.backends.sqlite3',
+    #     'NAME': BASE_DIR / 'replica1.sqlite3',
+    #     'CONN_MAX_AGE': 60,
+    #     'CONN_HEALTH_CHECKS': True,
+    #     'TEST': {'MIRROR': 'default'},
+    # },
+}
+
+# 写入主库，HTTP 读请求分到 DATABASE_REPLICAS 中的副本（见 mail/databases.py）；
+# 用户写入后 DATABASE_REPLICA_STICKY 秒内读主库，应大于副本的复制延迟
+DATABASE_ROUTERS = ['mail.databases.ReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_STICKY = 5
+
+# 每个 SQLite 连接建立时执行的 PRAGMA：WAL 下读写互不阻塞，
+# synchronous=NORMAL 只在检查点时 fsync；cache_size 为负数时单位是 KiB
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
 }
 
 
@@ -137,6 +168,12 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# 上传时顺带计算 SHA-256，附件按内容去重存储
+FILE_UPLOAD_HANDLERS = [
+    'mail.blobs.HashingMemoryFileUploadHandler',
+    'mail.blobs.HashingTemporaryFileUploadHandler',
+]
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 
 AUTH_USER_MODEL = 'mail.User'
@@ -151,3 +188,63 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# 在线状态、分发列表展开等跨进程共享的数据放在 Redis 中
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/1",
+    },
+    # 邮件列表的序列化结果，进程内 LRU：满了以后淘汰最久未访问的 1/CULL_FREQUENCY
+    "mailbox_pages": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "mailbox-pages",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 5000, "CULL_FREQUENCY": 10},
+    },
+}
+
+# 在线状态 TTL（秒），MailConsumer 每 TTL/2 刷新一次
+PRESENCE_TTL = 120
+# 同一用户在该窗口（秒）内的多条通知合并为一条
+NOTIFY_COALESCE_WINDOW = 1.0
+
+# 邮箱变更记录保留天数，更早的序列号重连时需要全量刷新
+MAILBOX_CHANGE_RETENTION_DAYS = 30
+
+# IMAP 同步每次 UID FETCH 的邮件数量和正文总字节数
+IMAP_FETCH_BATCH_SIZE = 100
+IMAP_FETCH_BATCH_BYTES = 20 * 1024 * 1024
+# "full" 下载完整邮件；"envelope" 只同步信封，正文和附件在首次访问时拉取
+IMAP_SYNC_MODE = "full"
+# 超过该大小的邮件分段拉取并流式解析，附件直接写入存储
+IMAP_STREAM_THRESHOLD = 5 * 1024 * 1024
+IMAP_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# 发件箱 worker（send_outbox）投递到本地 Postfix
+OUTBOX_SMTP_HOST = "localhost"
+OUTBOX_SMTP_PORT = 25
+OUTBOX_MAX_ATTEMPTS = 8
+# 重试间隔：OUTBOX_RETRY_BASE * 2^(attempts-1) 秒，最长 OUTBOX_RETRY_MAX
+OUTBOX_RETRY_BASE = 60
+OUTBOX_RETRY_MAX = 3600
+
+# SMTP 连接池：空闲超过 MAX_IDLE 秒关闭，单连接最多发送 MAX_MESSAGES 封，
+# 空闲超过 NOOP_AFTER 秒的连接复用前先 NOOP 检查
+SMTP_POOL_MAX_IDLE = 60
+SMTP_POOL_MAX_MESSAGES = 100
+SMTP_POOL_NOOP_AFTER = 15
+SMTP_POOL_MAX_PER_KEY = 4
+
+# 附件下载交给前端代理发送："x-accel"（nginx X-Accel-Redirect）或 "x-sendfile"；None 时由 Django 发送。
+# x-accel 模式下 ATTACHMENT_ACCEL_PREFIX 需要在 nginx 中配置为指向 MEDIA_ROOT 的 internal location
+ATTACHMENT_OFFLOAD = None
+ATTACHMENT_ACCEL_PREFIX = "/protected-media/"
+
+# 单个附件的大小上限（字节），分片上传在声明大小时即拒绝超限文件
+ATTACHMENT_MAX_SIZE = 200 * 1024 * 1024
+
+# 原始邮件段文件目录，None 时为 MEDIA_ROOT/raw_messages；
+# 压缩方式 "zstd"（需要安装 zstandard，未安装时退回 zlib）或 "zlib"
+RAW_MESSAGE_DIR = None
+RAW_MESSAGE_CODEC = "zstd"